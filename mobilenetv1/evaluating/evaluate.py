@@ -15,13 +15,12 @@ import torch.utils.data.distributed
 
 sys.path.append("../../")
 from utils.utils import *
+from utils.device import add_device_arguments, setup_device, data_parallel, to_device, memory_format, inference_mode
+from utils.device import amp_dtype, autocast, grad_scaler
 from torchvision import datasets, transforms
 from torch.autograd import Variable
 from mobilenet_v1 import MobileNetV1, channel_scale
 
-os.environ["CUDA_VISIBLE_DEVICES"] = '0,1'
-print("Using GPU No:", os.environ["CUDA_VISIBLE_DEVICES"])
-
 parser = argparse.ArgumentParser("MobileNetV1")
 parser.add_argument('--batch_size', type=int, default=2048, help='batch size')
 parser.add_argument('--epochs', type=int, default=320, help='num of training epochs')
@@ -34,7 +33,11 @@ parser.add_argument('--label_smooth', type=float, default=0.1, help='label smoot
 parser.add_argument('--print_freq', type=float, default=1, help='report frequency')
 parser.add_argument('-j', '--workers', default=40, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
+add_device_arguments(parser, gpus='0,1')
 args = parser.parse_args()
+device = setup_device(args)
+# autocast dtype of the forward passes, None in fp32
+dtype = amp_dtype(args, device)
 
 CLASSES = 1000
 
@@ -50,8 +53,6 @@ CLASSES = 1000
 # logging.getLogger().addHandler(fh)
 
 def main():
-    if not torch.cuda.is_available():
-        sys.exit(1)
     start_t = time.time()
 
     cudnn.benchmark = True
@@ -62,12 +63,12 @@ def main():
     network_encoding_vector = [19, 21, 7, 14, 21, 13, 24, 19, 22, 28, 23, 22, 20]
     model = MobileNetV1(network_encoding_vector)
     # logging.info(model)
-    model = nn.DataParallel(model).cuda()
+    model = data_parallel(to_device(model, device, args.channels_last), device)
 
     criterion = nn.CrossEntropyLoss()
-    criterion = criterion.cuda()
+    criterion = criterion.to(device)
     criterion_smooth = CrossEntropyLabelSmooth(CLASSES, args.label_smooth)
-    criterion_smooth = criterion_smooth.cuda()
+    criterion_smooth = criterion_smooth.to(device)
 
     # split the weight parameter that need weight decay
     all_parameters = model.parameters()
@@ -89,6 +90,7 @@ def main():
     # define the learning rate scheduler
     # we use the linear learning rate here
     scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step : (1.0-step/args.epochs), last_epoch=-1)
+    scaler = grad_scaler(device, dtype)
     start_epoch = 0
     best_top1_acc= 0
 
@@ -96,7 +98,7 @@ def main():
     checkpoint_tar = os.path.join(args.save, 'checkpoint.pth.tar')
     if os.path.exists(checkpoint_tar):
         # logging.info('loading checkpoint {} ..........'.format(checkpoint_tar))
-        checkpoint = torch.load(checkpoint_tar)
+        checkpoint = torch.load(checkpoint_tar, map_location=device)
         start_epoch = checkpoint['epoch']
         best_top1_acc = checkpoint['best_top1_acc']
         model.load_state_dict(checkpoint['state_dict'])
@@ -128,7 +130,7 @@ def main():
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
+        num_workers=args.workers, pin_memory=device.type == 'cuda')
 
     # load validation data
     val_loader = torch.utils.data.DataLoader(
@@ -139,14 +141,14 @@ def main():
             normalize,
         ])),
         batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+        num_workers=args.workers, pin_memory=device.type == 'cuda')
 
     # train the model
     epoch = start_epoch + 1
     while epoch < args.epochs:
         start_time = time.time()
 
-        train_obj, train_top1_acc,  train_top5_acc = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler)
+        train_obj, train_top1_acc,  train_top5_acc = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler, scaler)
         valid_obj, valid_top1_acc, valid_top5_acc = validate(epoch, val_loader, model, criterion, args)
         print('Training: Top-1 Accuracy = {:.3f} and Top-5 Accuracy = {:.3f}'.format(train_top1_acc, train_top5_acc))
         print('Validation: Top-1 Accuracy = {:.3f} and Top-5 Accuracy = {:.3f}'.format(valid_top1_acc, valid_top5_acc))
@@ -171,7 +173,7 @@ def main():
         print('Evaluation took {} hours {} mins and {} secs\n'.format(now_time.tm_hour, now_time.tm_min, now_time.tm_sec))
 
 
-def train(epoch, train_loader, model, criterion, optimizer, scheduler):
+def train(epoch, train_loader, model, criterion, optimizer, scheduler, scaler):
     print("\nEpoch", epoch)
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
@@ -194,12 +196,13 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
 
     for i, (images, target) in enumerate(train_loader):
         data_time.update(time.time() - end)
-        images = images.cuda()
-        target = target.cuda()
+        images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+        target = target.to(device, non_blocking=True)
 
         # compute outputy
-        logits = model(images)
-        loss = criterion(logits, target)
+        with autocast(device, dtype):
+            logits = model(images)
+            loss = criterion(logits, target)
 
         # measure accuracy and record loss
         prec1, prec5 = accuracy(logits, target, topk=(1, 5))
@@ -210,8 +213,9 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -235,11 +239,11 @@ def validate(epoch, val_loader, model, criterion, args):
 
     # switch to evaluation mode
     model.eval()
-    with torch.no_grad():
+    with inference_mode(), autocast(device, dtype):
         end = time.time()
         for i, (images, target) in enumerate(val_loader):
-            images = images.cuda()
-            target = target.cuda()
+            images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+            target = target.to(device, non_blocking=True)
 
             # compute output
             logits = model(images)
@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,6 +9,10 @@ import math
 
 import numpy as np
 
+from utils.weight_cache import cached_weight
+from utils.hypernet import generate_weight
+from utils.static_net import static_conv, static_bn
+
 channel_scale = []
 for i in range(31):
     channel_scale += [(10 + i * 3)/100]
@@ -34,23 +39,38 @@ class conv_3x3(nn.Module):
             oup = int(self.base_oup * oup_scale)
             self.first_bn.append(nn.BatchNorm2d(oup))
 
-    def forward(self, x, oup_scale_id):
+    def generate_weights(self, oup_scale_id, device):
 
         oup_scale = channel_scale[oup_scale_id]
 
         oup = int(self.base_oup * oup_scale)
 
-        scale_tensor = torch.FloatTensor([oup_scale/self.max_scale]).to(x.device)
+        scale_tensor = torch.FloatTensor([oup_scale/self.max_scale]).to(device)
+
+        # generated weights are memoized per scale ids when gradients are disabled
+        conv1_weight = cached_weight(self, ('conv1', oup_scale_id), device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup_channel, self.base_inp, 3, 3), oup, self.base_inp))
+
+        return conv1_weight
+
+    def forward(self, x, oup_scale_id):
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup_channel, self.base_inp, 3, 3)
+        conv1_weight = self.generate_weights(oup_scale_id, x.device)
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=1)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu(out)
 
         return out
 
+    def materialize(self, oup_scale_id):
+        conv1_weight = self.generate_weights(oup_scale_id, self.fc12.weight.device)
+
+        return nn.Sequential(
+            static_conv(conv1_weight, stride=self.stride, padding=1),
+            static_bn(self.first_bn[oup_scale_id]),
+            nn.ReLU(inplace=True))
+
 class dw3x3_pw1x1(nn.Module):
     def __init__(self, base_inp, base_oup, stride):
         super(dw3x3_pw1x1, self).__init__()
@@ -83,7 +103,7 @@ class dw3x3_pw1x1(nn.Module):
             self.second_bn.append(nn.BatchNorm2d(oup, affine=False))
 
 
-    def forward(self, x, inp_scale_id, oup_scale_id):
+    def generate_weights(self, inp_scale_id, oup_scale_id, device):
 
         inp_scale = channel_scale[inp_scale_id]
         oup_scale = channel_scale[oup_scale_id]
@@ -91,24 +111,44 @@ class dw3x3_pw1x1(nn.Module):
         inp = int(self.base_inp * inp_scale)
         oup = int(self.base_oup * oup_scale)
 
-        scale_tensor = torch.FloatTensor([inp_scale/self.max_scale, oup_scale/self.max_scale]).to(x.device)
+        scale_tensor = torch.FloatTensor([inp_scale/self.max_scale, oup_scale/self.max_scale]).to(device)
+
+        # generated weights are memoized per scale ids when gradients are disabled
+        scale_ids = (inp_scale_id, oup_scale_id)
+        depconv3x3_weight = cached_weight(self, ('depconv3x3',) + scale_ids, device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_inp_channel, 1, 3, 3), inp, 1))
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        depconv3x3_weight = self.fc12(fc11_out).view(self.max_inp_channel, 1, 3, 3)
+        conv1x1_weight = cached_weight(self, ('conv1x1',) + scale_ids, device,
+            lambda: generate_weight(self.fc21, self.fc22, scale_tensor, (self.max_oup_channel, self.max_inp_channel, 1, 1), oup, inp))
 
-        fc21_out = F.relu(self.fc21(scale_tensor))
-        conv1x1_weight = self.fc22(fc21_out).view(self.max_oup_channel, self.max_inp_channel, 1, 1)
+        return depconv3x3_weight, conv1x1_weight
 
-        out = F.conv2d(x, depconv3x3_weight[:inp, :, :, :], bias=None, stride=self.stride, padding=1, groups=inp)
+    def forward(self, x, inp_scale_id, oup_scale_id):
+
+        depconv3x3_weight, conv1x1_weight = self.generate_weights(inp_scale_id, oup_scale_id, x.device)
+        inp = depconv3x3_weight.size(0)
+
+        out = F.conv2d(x, depconv3x3_weight, bias=None, stride=self.stride, padding=1, groups=inp)
         out = self.first_bn[inp_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv1x1_weight[:oup, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv1x1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.second_bn[oup_scale_id](out)
         out = F.relu(out)
 
         return out
 
+    def materialize(self, inp_scale_id, oup_scale_id):
+        depconv3x3_weight, conv1x1_weight = self.generate_weights(inp_scale_id, oup_scale_id, self.fc12.weight.device)
+
+        return nn.Sequential(
+            static_conv(depconv3x3_weight, stride=self.stride, padding=1, groups=depconv3x3_weight.size(0)),
+            static_bn(self.first_bn[inp_scale_id]),
+            nn.ReLU(inplace=True),
+            static_conv(conv1x1_weight),
+            static_bn(self.second_bn[oup_scale_id]),
+            nn.ReLU(inplace=True))
+
 class MobileNetV1(nn.Module):
     def __init__(self, input_size=224, num_classes=1000):
         super(MobileNetV1, self).__init__()
@@ -129,15 +169,22 @@ class MobileNetV1(nn.Module):
         self.pool1 = nn.AvgPool2d(7)
         self.fc = nn.Linear(1024, 1000)
 
-    def forward(self, x, rngs):
+    def block_scale_ids(self, rngs):
 
-        for i, block in enumerate(self.feature):
+        block_ids = []
+        for i in range(len(self.feature)):
             if i == 0:
-                x = block(x, rngs[0])
+                block_ids += [(rngs[0],)]
             elif i == 13:
-                x = block(x, rngs[i-1], -1)
+                block_ids += [(rngs[i-1], -1)]
             else:
-                x = block(x, rngs[i-1], rngs[i])
+                block_ids += [(rngs[i-1], rngs[i])]
+        return block_ids
+
+    def forward(self, x, rngs):
+
+        for block, scale_ids in zip(self.feature, self.block_scale_ids(rngs)):
+            x = block(x, *scale_ids)
 
         x = self.pool1(x)
         x = x.view(-1, 1024)
@@ -145,6 +192,12 @@ class MobileNetV1(nn.Module):
 
         return x
 
+    def materialize(self, rngs):
+        """Static network with the generated weights and current batchnorm statistics of rngs"""
+        with torch.no_grad():
+            layers = [block.materialize(*scale_ids) for block, scale_ids in zip(self.feature, self.block_scale_ids(rngs))]
+            return nn.Sequential(*layers, copy.deepcopy(self.pool1), nn.Flatten(), copy.deepcopy(self.fc))
+
 if __name__ == "__main__":
     model = MobileNetV1()
     print(model)
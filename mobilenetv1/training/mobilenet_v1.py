@@ -8,6 +8,8 @@ import math
 
 import numpy as np
 
+from utils.hypernet import generate_weight
+
 channel_scale = []
 for i in range(31):
     channel_scale += [(10 + i * 3)/100]
@@ -42,10 +44,9 @@ class conv_3x3(nn.Module):
 
         scale_tensor = torch.FloatTensor([oup_scale/self.max_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup_channel, self.base_inp, 3, 3)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup_channel, self.base_inp, 3, 3), oup, self.base_inp)
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=1)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu(out)
 
@@ -93,17 +94,15 @@ class dw3x3_pw1x1(nn.Module):
 
         scale_tensor = torch.FloatTensor([inp_scale/self.max_scale, oup_scale/self.max_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        depconv3x3_weight = self.fc12(fc11_out).view(self.max_inp_channel, 1, 3, 3)
+        depconv3x3_weight = generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_inp_channel, 1, 3, 3), inp, 1)
 
-        fc21_out = F.relu(self.fc21(scale_tensor))
-        conv1x1_weight = self.fc22(fc21_out).view(self.max_oup_channel, self.max_inp_channel, 1, 1)
+        conv1x1_weight = generate_weight(self.fc21, self.fc22, scale_tensor, (self.max_oup_channel, self.max_inp_channel, 1, 1), oup, inp)
 
-        out = F.conv2d(x, depconv3x3_weight[:inp, :, :, :], bias=None, stride=self.stride, padding=1, groups=inp)
+        out = F.conv2d(x, depconv3x3_weight, bias=None, stride=self.stride, padding=1, groups=inp)
         out = self.first_bn[inp_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv1x1_weight[:oup, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv1x1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.second_bn[oup_scale_id](out)
         out = F.relu(out)
 
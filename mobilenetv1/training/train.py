@@ -15,6 +15,10 @@ import torch.utils.data.distributed
 
 sys.path.append("../../")
 from utils.utils import *
+from utils.device import add_device_arguments, setup_device, data_parallel, to_device, memory_format, inference_mode
+from utils.device import amp_dtype, autocast, grad_scaler
+from utils.bn_calibration import finite_stats, running_stats
+from utils.distributed import add_distributed_arguments, init_distributed, distributed_model, no_sync, is_main_process, reduce_meters, close_distributed
 from torchvision import datasets, transforms
 from torch.autograd import Variable
 from mobilenet_v1 import MobileNetV1, channel_scale
@@ -29,9 +33,16 @@ parser.add_argument('--save', type=str, default='./models', help='path for savin
 parser.add_argument('--data', metavar='DIR', help='path to dataset')
 parser.add_argument('--label_smooth', type=float, default=0.1, help='label smoothing')
 parser.add_argument('--print_freq', type=float, default=1, help='report frequency')
+parser.add_argument('--num_subnets', type=int, default=1, help='sub-networks trained on every batch with accumulated gradients, the largest and the smallest first when above 1')
 parser.add_argument('-j', '--workers', default=40, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
+add_device_arguments(parser, gpus='2,3')
+add_distributed_arguments(parser)
 args = parser.parse_args()
+device = setup_device(args)
+device = init_distributed(args, device)
+# autocast dtype of the forward passes, None in fp32
+dtype = amp_dtype(args, device)
 
 CLASSES = 1000
 
@@ -45,12 +56,7 @@ if not os.path.exists('log'):
 # fh.setFormatter(logging.Formatter(log_format))
 # logging.getLogger().addHandler(fh)
 
-os.environ["CUDA_VISIBLE_DEVICES"] = '2,3'
-print("Using GPU No:", os.environ["CUDA_VISIBLE_DEVICES"])
-
 def main():
-    if not torch.cuda.is_available():
-        sys.exit(1)
     start_t = time.time()
 
     cudnn.benchmark = True
@@ -59,12 +65,14 @@ def main():
 
     model = MobileNetV1()
     logging.info(model)
-    model = nn.DataParallel(model).cuda()
+    model = to_device(model, device, args.channels_last)
+    # the affine first batchnorms of the other channel scales get no gradient at a step
+    model = distributed_model(model, device, find_unused_parameters=True) if args.distributed else data_parallel(model, device)
 
     criterion = nn.CrossEntropyLoss()
-    criterion = criterion.cuda()
+    criterion = criterion.to(device)
     criterion_smooth = CrossEntropyLabelSmooth(CLASSES, args.label_smooth)
-    criterion_smooth = criterion_smooth.cuda()
+    criterion_smooth = criterion_smooth.to(device)
 
     all_parameters = model.parameters()
     weight_parameters = []
@@ -82,12 +90,13 @@ def main():
         )
 
     scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step : (1.0-step/args.epochs), last_epoch=-1)
+    scaler = grad_scaler(device, dtype)
     start_epoch = 0
     best_top1_acc= 0
     checkpoint_tar = os.path.join(args.save, 'checkpoint.pth.tar')
     if os.path.exists(checkpoint_tar):
         # logging.info('loading checkpoint {} ..........'.format(checkpoint_tar))
-        checkpoint = torch.load(checkpoint_tar)
+        checkpoint = torch.load(checkpoint_tar, map_location=device)
         start_epoch = checkpoint['epoch']
         best_top1_acc = checkpoint['best_top1_acc']
         model.load_state_dict(checkpoint['state_dict'])
@@ -114,46 +123,68 @@ def main():
         traindir,
         transform=train_transforms)
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
-
-    val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
+    val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
             normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+        ]))
+
+    # under torchrun every rank loads its shard of the images, args.batch_size is split between the ranks
+    train_sampler, val_sampler = None, None
+    if args.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=args.batch_size // args.world_size, shuffle=(train_sampler is None),
+        sampler=train_sampler, num_workers=args.workers, pin_memory=device.type == 'cuda')
+
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=args.batch_size // args.world_size, shuffle=False,
+        sampler=val_sampler, num_workers=args.workers, pin_memory=device.type == 'cuda')
 
     epoch = start_epoch
     while epoch < args.epochs:
         start_time = time.time()
-        train_obj, train_top1_acc,  train_top5_acc, epoch = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler)
-        valid_obj, valid_top1_acc, valid_top5_acc = validate(epoch, val_loader, model, criterion, args)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        # the same scale ids on all the ranks
+        rng = np.random.RandomState(args.seed + epoch)
+        train_obj, train_top1_acc,  train_top5_acc, epoch = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler, scaler, rng)
+        valid_obj, valid_top1_acc, valid_top5_acc = validate(epoch, val_loader, model, criterion, args, rng)
+        if not finite_stats(running_stats(model)):
+            print('Warning: non-finite batchnorm running statistics after epoch {}'.format(epoch))
         print('Training: Top-1 Accuracy = {:.3f} and Top-5 Accuracy = {:.3f}'.format(train_top1_acc, train_top5_acc))
         print('Validation: Top-1 Accuracy = {:.3f} and Top-5 Accuracy = {:.3f}'.format(valid_top1_acc, valid_top5_acc))
 
         is_best = False
         if valid_top1_acc > best_top1_acc:
-        best_top1_acc = valid_top1_acc
-        is_best = True
+            best_top1_acc = valid_top1_acc
+            is_best = True
 
-        save_checkpoint({
-        'epoch': epoch,
-        'state_dict': model.state_dict(),
-        'best_top1_acc': best_top1_acc,
-        'optimizer' : optimizer.state_dict(),
-        }, is_best, args.save)
+        if is_main_process():
+            save_checkpoint({
+                'epoch': epoch,
+                'state_dict': model.state_dict(),
+                'best_top1_acc': best_top1_acc,
+                'optimizer' : optimizer.state_dict(),
+                }, is_best, args.save)
 
         epoch += 1
         now_time = time.gmtime(time.time() - start_time)
         print('Training took {} mins and {} secs\n'.format(now_time.tm_min, now_time.tm_sec))
+    close_distributed()
+
 
+# scale ids of a random sub-network, or of the one with all its scales at scale_id
+def sample_scale_ids(rng, scale_id=None):
+    if scale_id is None:
+        return rng.randint(low=0, high=len(channel_scale), size=13)
+    return np.full(13, scale_id)
 
-def train(epoch, train_loader, model, criterion, optimizer, scheduler):
+
+def train(epoch, train_loader, model, criterion, optimizer, scheduler, scaler, rng):
     print("\nEpoch", epoch)
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
@@ -172,25 +203,29 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
 
     for i, (images, target) in enumerate(train_loader):
         data_time.update(time.time() - end)
-        images = images.cuda()
-        target = target.cuda()
-
-        # compute output
-        scale_ids = np.random.randint(low=0, high=len(channel_scale), size=13)
-        logits = model(images, scale_ids)
-        loss = criterion(logits, target)
-
-        # measure accuracy and record loss
-        prec1, prec5 = accuracy(logits, target, topk=(1, 5))
-        n = images.size(0)
-        losses.update(loss.item(), n)   #accumulated loss
-        top1.update(prec1.item(), n)
-        top5.update(prec5.item(), n)
-
-        # compute gradient and do SGD step
+        images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+        target = target.to(device, non_blocking=True)
+
+        # compute output and gradient of every sub-network on the loaded batch, then do one SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        for k, scale_id in enumerate(sandwich_scale_ids(args.num_subnets, len(channel_scale))):
+            scale_ids = sample_scale_ids(rng, scale_id)
+            # the gradients are only averaged over the ranks after the last sub-network
+            with no_sync(model, k < args.num_subnets - 1):
+                with autocast(device, dtype):
+                    logits = model(images, scale_ids)
+                    loss = criterion(logits, target)
+                scaler.scale(loss / args.num_subnets).backward()
+
+            # measure accuracy and record loss
+            prec1, prec5 = accuracy(logits, target, topk=(1, 5))
+            n = images.size(0)
+            losses.update(loss.item(), n)   #accumulated loss
+            top1.update(prec1.item(), n)
+            top5.update(prec5.item(), n)
+        # with fp16, the steps of overflowed gradients are skipped and the loss scale lowered
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -199,10 +234,11 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
     #   if i % args.print_freq == 0:
     #       progress.display(i)
 
+    reduce_meters([losses, top1, top5], device)
     return losses.avg, top1.avg, top5.avg, epoch
 
 
-def validate(epoch, val_loader, model, criterion, args):
+def validate(epoch, val_loader, model, criterion, args, rng):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
@@ -215,12 +251,12 @@ def validate(epoch, val_loader, model, criterion, args):
 
     model.eval()
 
-    scale_ids = np.random.randint(low=0, high=len(channel_scale), size=13)
-    with torch.no_grad():
+    scale_ids = sample_scale_ids(rng)
+    with inference_mode(), autocast(device, dtype):
         end = time.time()
         for i, (images, target) in enumerate(val_loader):
-            images = images.cuda()
-            target = target.cuda()
+            images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+            target = target.to(device, non_blocking=True)
 
             # compute output
             logits = model(images, scale_ids)
@@ -243,6 +279,7 @@ def validate(epoch, val_loader, model, criterion, args):
         # print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
         #       .format(top1=top1, top5=top5))
 
+    reduce_meters([losses, top1, top5], device)
     return losses.avg, top1.avg, top5.avg
 
 
@@ -86,8 +86,11 @@ def print_model_parm_flops(one_shot_model):
             foo(c)
 
     foo(one_shot_model)
-    input = Variable(torch.rand(3,224,224).unsqueeze(0), requires_grad = True).cuda()
-    out = one_shot_model(input)
+    # the input follows the model, whichever device it is on
+    device = next(one_shot_model.parameters()).device
+    input = torch.rand(3,224,224).unsqueeze(0).to(device)
+    with torch.no_grad():
+        out = one_shot_model(input)
 
     total_flops = (sum(list_conv) + sum(list_linear) + sum(list_bn) + sum(list_relu) + sum(list_pooling))
     M_flops = total_flops / 1e6
@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,6 +9,10 @@ import math
 
 import numpy as np
 
+from utils.weight_cache import cached_weight
+from utils.hypernet import generate_weight
+from utils.static_net import static_conv, static_bn, Residual
+
 mid_channel_scale = []
 for i in range(31):
     mid_channel_scale += [(10 + i * 3)/100]
@@ -38,21 +43,36 @@ class conv2d_3x3(nn.Module):
             oup = int(self.base_oup * oup_scale)
             self.first_bn.append(nn.BatchNorm2d(oup, affine=False))
 
-    def forward(self, x, oup_scale_id):
+    def generate_weights(self, oup_scale_id, device):
 
         oup_scale = overall_channel_scale[oup_scale_id]
         oup = int(self.base_oup * oup_scale)
-        scale_tensor = torch.FloatTensor([oup_scale/self.max_overall_scale]).to(x.device)
+        scale_tensor = torch.FloatTensor([oup_scale/self.max_overall_scale]).to(device)
+
+        # generated weights are memoized per scale ids when gradients are disabled
+        conv1_weight = cached_weight(self, ('conv1', oup_scale_id), device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup_channel, self.base_inp, 3, 3), oup, self.base_inp))
+
+        return conv1_weight
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup_channel, self.base_inp, 3, 3)
+    def forward(self, x, oup_scale_id):
+
+        conv1_weight = self.generate_weights(oup_scale_id, x.device)
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=1)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu6(out)
 
         return out
 
+    def materialize(self, oup_scale_id):
+        conv1_weight = self.generate_weights(oup_scale_id, self.fc12.weight.device)
+
+        return nn.Sequential(
+            static_conv(conv1_weight, stride=self.stride, padding=1),
+            static_bn(self.first_bn[oup_scale_id]),
+            nn.ReLU6(inplace=True))
+
 class conv2d_1x1(nn.Module):
     def __init__(self, base_inp, base_oup, stride):
         super(conv2d_1x1, self).__init__()
@@ -74,23 +94,38 @@ class conv2d_1x1(nn.Module):
             inp = int(self.base_inp * inp_scale)
             self.first_bn.append(nn.BatchNorm2d(base_oup, affine=False))
 
-    def forward(self, x, inp_scale_id):
+    def generate_weights(self, inp_scale_id, device):
 
         inp_scale = overall_channel_scale[inp_scale_id]
 
         inp = int(self.base_inp * inp_scale)
 
-        scale_tensor = torch.FloatTensor([inp_scale/self.max_overall_scale]).to(x.device)
+        scale_tensor = torch.FloatTensor([inp_scale/self.max_overall_scale]).to(device)
+
+        # generated weights are memoized per scale ids when gradients are disabled
+        conv1_weight = cached_weight(self, ('conv1', inp_scale_id), device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_tensor, (self.base_oup, self.max_inp_channel, 1, 1), self.base_oup, inp))
+
+        return conv1_weight
+
+    def forward(self, x, inp_scale_id):
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.base_oup, self.max_inp_channel, 1, 1)
+        conv1_weight = self.generate_weights(inp_scale_id, x.device)
 
-        out = F.conv2d(x, conv1_weight[:, :inp, :, :], bias=None, stride=self.stride, padding=0)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=0)
         out = self.first_bn[inp_scale_id](out)
         out = F.relu6(out)
 
         return out
 
+    def materialize(self, inp_scale_id):
+        conv1_weight = self.generate_weights(inp_scale_id, self.fc12.weight.device)
+
+        return nn.Sequential(
+            static_conv(conv1_weight, stride=self.stride),
+            static_bn(self.first_bn[inp_scale_id]),
+            nn.ReLU6(inplace=True))
+
 class bottleneck(nn.Module):
     def __init__(self, base_inp, base_oup, stride, expand_ratio=6):
         super(bottleneck, self).__init__()
@@ -132,7 +167,7 @@ class bottleneck(nn.Module):
             self.bn3.append(nn.BatchNorm2d(oup, affine=False))
 
 
-    def forward(self, x, mid_scale_id, inp_scale_id, oup_scale_id):
+    def generate_weights(self, mid_scale_id, inp_scale_id, oup_scale_id, device):
 
         mid_scale = mid_channel_scale[mid_scale_id]
         inp_scale = overall_channel_scale[inp_scale_id]
@@ -142,26 +177,35 @@ class bottleneck(nn.Module):
         inp = int(self.max_inp * inp_scale)
         oup = int(self.max_oup * oup_scale)
 
-        scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(x.device)
+        scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(device)
 
-        fc11_out = F.relu(self.fc11(scale_ratio_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_mid, self.max_inp, 1, 1)
+        # generated weights are memoized per scale ids when gradients are disabled
+        scale_ids = (mid_scale_id, inp_scale_id, oup_scale_id)
+        conv1_weight = cached_weight(self, ('conv1',) + scale_ids, device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_ratio_tensor, (self.max_mid, self.max_inp, 1, 1), mid, inp))
 
-        fc21_out = F.relu(self.fc21(scale_ratio_tensor))
-        conv2_weight = self.fc22(fc21_out).view(self.max_mid, 1, 3, 3)
+        conv2_weight = cached_weight(self, ('conv2',) + scale_ids, device,
+            lambda: generate_weight(self.fc21, self.fc22, scale_ratio_tensor, (self.max_mid, 1, 3, 3), mid, 1))
 
-        fc31_out = F.relu(self.fc31(scale_ratio_tensor))
-        conv3_weight = self.fc32(fc31_out).view(self.max_oup, self.max_mid, 1, 1)
+        conv3_weight = cached_weight(self, ('conv3',) + scale_ids, device,
+            lambda: generate_weight(self.fc31, self.fc32, scale_ratio_tensor, (self.max_oup, self.max_mid, 1, 1), oup, mid))
 
-        out = F.conv2d(x, conv1_weight[:mid, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        return conv1_weight, conv2_weight, conv3_weight
+
+    def forward(self, x, mid_scale_id, inp_scale_id, oup_scale_id):
+
+        conv1_weight, conv2_weight, conv3_weight = self.generate_weights(mid_scale_id, inp_scale_id, oup_scale_id, x.device)
+        mid = conv2_weight.size(0)
+
+        out = F.conv2d(x, conv1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn1[mid_scale_id](out)
         out = F.relu6(out)
 
-        out = F.conv2d(out, conv2_weight[:mid, :, :, :], bias=None, stride=self.stride, padding=1, groups=mid)
+        out = F.conv2d(out, conv2_weight, bias=None, stride=self.stride, padding=1, groups=mid)
         out = self.bn2[mid_scale_id](out)
         out = F.relu6(out)
 
-        out = F.conv2d(out, conv3_weight[:oup, :mid, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv3_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn3[oup_scale_id](out)
 
         if self.max_inp == self.max_oup:
@@ -170,6 +214,25 @@ class bottleneck(nn.Module):
         else:
             return out
 
+    def materialize(self, mid_scale_id, inp_scale_id, oup_scale_id):
+        conv1_weight, conv2_weight, conv3_weight = \
+            self.generate_weights(mid_scale_id, inp_scale_id, oup_scale_id, self.fc12.weight.device)
+
+        body = nn.Sequential(
+            static_conv(conv1_weight),
+            static_bn(self.bn1[mid_scale_id]),
+            nn.ReLU6(inplace=True),
+            static_conv(conv2_weight, stride=self.stride, padding=1, groups=conv2_weight.size(0)),
+            static_bn(self.bn2[mid_scale_id]),
+            nn.ReLU6(inplace=True),
+            static_conv(conv3_weight),
+            static_bn(self.bn3[oup_scale_id]))
+
+        if self.max_inp == self.max_oup:
+            return Residual(body)
+        else:
+            return body
+
 
 
 class MobileNetV2(nn.Module):
@@ -219,16 +282,22 @@ class MobileNetV2(nn.Module):
         self.pool1 = nn.AvgPool2d(7)
         self.fc = nn.Linear(1280, 1000)
 
-    def forward(self, x, stage_oup_scale_ids, mid_scale_ids):
-
+    def block_scale_ids(self, stage_oup_scale_ids, mid_scale_ids):
 
-        for i, block in enumerate(self.feature):
+        block_ids = []
+        for i in range(len(self.feature)):
             if i == 0 :
-                x = block(x, stage_oup_scale_ids[i])
+                block_ids += [(stage_oup_scale_ids[i],)]
             elif i == 18 :
-                x = block(x, stage_oup_scale_ids[i-1])
+                block_ids += [(stage_oup_scale_ids[i-1],)]
             else :
-                x = block(x, mid_scale_ids[i-1], stage_oup_scale_ids[i-1], stage_oup_scale_ids[i])
+                block_ids += [(mid_scale_ids[i-1], stage_oup_scale_ids[i-1], stage_oup_scale_ids[i])]
+        return block_ids
+
+    def forward(self, x, stage_oup_scale_ids, mid_scale_ids):
+
+        for block, scale_ids in zip(self.feature, self.block_scale_ids(stage_oup_scale_ids, mid_scale_ids)):
+            x = block(x, *scale_ids)
 
         #print(x.shape, flush=True)
         x = self.pool1(x)
@@ -237,6 +306,12 @@ class MobileNetV2(nn.Module):
 
         return x
 
+    def materialize(self, stage_oup_scale_ids, mid_scale_ids):
+        """Static network with the generated weights and current batchnorm statistics of the scale ids"""
+        with torch.no_grad():
+            layers = [block.materialize(*scale_ids) for block, scale_ids in zip(self.feature, self.block_scale_ids(stage_oup_scale_ids, mid_scale_ids))]
+            return nn.Sequential(*layers, copy.deepcopy(self.pool1), nn.Flatten(), copy.deepcopy(self.fc))
+
 if __name__ == "__main__":
     model = MobileNetV1()
     print(model)
@@ -8,6 +8,8 @@ import math
 
 import numpy as np
 
+from utils.hypernet import generate_weight
+
 mid_channel_scale = []
 for i in range(31):
     mid_channel_scale += [(10 + i * 3)/100]
@@ -44,10 +46,9 @@ class conv2d_3x3(nn.Module):
         oup = int(self.base_oup * oup_scale)
         scale_tensor = torch.FloatTensor([oup_scale/self.max_overall_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup_channel, self.base_inp, 3, 3)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup_channel, self.base_inp, 3, 3), oup, self.base_inp)
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=1)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu6(out)
 
@@ -82,10 +83,9 @@ class conv2d_1x1(nn.Module):
 
         scale_tensor = torch.FloatTensor([inp_scale/self.max_overall_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.base_oup, self.max_inp_channel, 1, 1)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_tensor, (self.base_oup, self.max_inp_channel, 1, 1), self.base_oup, inp)
 
-        out = F.conv2d(x, conv1_weight[:, :inp, :, :], bias=None, stride=self.stride, padding=0)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=0)
         out = self.first_bn[inp_scale_id](out)
         out = F.relu6(out)
 
@@ -144,24 +144,21 @@ class bottleneck(nn.Module):
 
         scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_ratio_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_mid, self.max_inp, 1, 1)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_ratio_tensor, (self.max_mid, self.max_inp, 1, 1), mid, inp)
 
-        fc21_out = F.relu(self.fc21(scale_ratio_tensor))
-        conv2_weight = self.fc22(fc21_out).view(self.max_mid, 1, 3, 3)
+        conv2_weight = generate_weight(self.fc21, self.fc22, scale_ratio_tensor, (self.max_mid, 1, 3, 3), mid, 1)
 
-        fc31_out = F.relu(self.fc31(scale_ratio_tensor))
-        conv3_weight = self.fc32(fc31_out).view(self.max_oup, self.max_mid, 1, 1)
+        conv3_weight = generate_weight(self.fc31, self.fc32, scale_ratio_tensor, (self.max_oup, self.max_mid, 1, 1), oup, mid)
 
-        out = F.conv2d(x, conv1_weight[:mid, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn1[mid_scale_id](out)
         out = F.relu6(out)
 
-        out = F.conv2d(out, conv2_weight[:mid, :, :, :], bias=None, stride=self.stride, padding=1, groups=mid)
+        out = F.conv2d(out, conv2_weight, bias=None, stride=self.stride, padding=1, groups=mid)
         out = self.bn2[mid_scale_id](out)
         out = F.relu6(out)
 
-        out = F.conv2d(out, conv3_weight[:oup, :mid, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv3_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn3[oup_scale_id](out)
 
         if self.max_inp == self.max_oup:
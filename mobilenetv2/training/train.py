@@ -15,13 +15,17 @@ import torch.utils.data.distributed
 
 sys.path.append("../../")
 # from utils.utils import *
+from utils.device import add_device_arguments, setup_device, data_parallel, to_device, memory_format, inference_mode
+from utils.device import amp_dtype, autocast, grad_scaler
+from utils.bn_calibration import finite_stats, running_stats
+from utils.distributed import add_distributed_arguments, init_distributed, distributed_model, no_sync, is_main_process, reduce_meters, close_distributed
 from utils.utils import CrossEntropyLabelSmooth, Lighting, AverageMeter, ProgressMeter
-from utils.utils import save_checkpoint, accuracy
+from utils.utils import save_checkpoint, accuracy, sandwich_scale_ids
 from torchvision import datasets, transforms
 from torch.autograd import Variable
-from resnet import ResNet50, channel_scale
+from mobilenet_v2 import MobileNetV2, mid_channel_scale, overall_channel_scale
 
-parser = argparse.ArgumentParser("ResNet50")
+parser = argparse.ArgumentParser("MobileNetV2")
 parser.add_argument('--batch_size', type=int, default=256, help='batch size')
 parser.add_argument('--epochs', type=int, default=32, help='num of training epochs')
 parser.add_argument('--learning_rate', type=float, default=0.1, help='init learning rate')
@@ -31,12 +35,19 @@ parser.add_argument('--save', type=str, default='./models', help='path for savin
 parser.add_argument('--data', metavar='DIR', help='path to dataset')
 parser.add_argument('--label_smooth', type=float, default=0.1, help='label smoothing')
 parser.add_argument('--print_freq', type=float, default=1, help='report frequency')
+parser.add_argument('--num_subnets', type=int, default=1, help='sub-networks trained on every batch with accumulated gradients, the largest and the smallest first when above 1')
 parser.add_argument('-j', '--workers', default=40, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
+add_device_arguments(parser)
+add_distributed_arguments(parser)
 args = parser.parse_args()
+device = setup_device(args)
+device = init_distributed(args, device)
+# autocast dtype of the forward passes, None in fp32
+dtype = amp_dtype(args, device)
 
 CLASSES = 1000
-stage_repeat=[1,3,4,6,3]
+stage_repeat=[1,1,2,3,4,3,3,1]
 
 if not os.path.exists('log'):
     os.mkdir('log')
@@ -51,22 +62,21 @@ if not os.path.exists('log'):
 
 
 def main():
-    if not torch.cuda.is_available():
-        sys.exit(1)
     start_time = time.time()
 
     cudnn.benchmark = True
     cudnn.enabled=True
     # logging.info("args = %s", args)
 
-    model = ResNet50()
+    model = MobileNetV2()
     logging.info(model)
-    model = nn.DataParallel(model).cuda()
+    model = to_device(model, device, args.channels_last)
+    model = distributed_model(model, device) if args.distributed else data_parallel(model, device)
 
     criterion = nn.CrossEntropyLoss()
-    criterion = criterion.cuda()
+    criterion = criterion.to(device)
     criterion_smooth = CrossEntropyLabelSmooth(CLASSES, args.label_smooth)
-    criterion_smooth = criterion_smooth.cuda()
+    criterion_smooth = criterion_smooth.to(device)
 
     all_parameters = model.parameters()
     weight_parameters = []
@@ -85,13 +95,14 @@ def main():
 
     #scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step : (1.0-step/args.epochs), last_epoch=-1)
     scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[args.epochs//4, args.epochs//2, args.epochs//4*3], gamma=0.1)
+    scaler = grad_scaler(device, dtype)
     start_epoch = 0
     best_top1_acc= 0
     checkpoint_tar = os.path.join(args.save, 'checkpoint.pth.tar')
     if os.path.exists(checkpoint_tar):
         try:
             logging.info('loading checkpoint {} ..........'.format(checkpoint_tar))
-            checkpoint = torch.load(checkpoint_tar)
+            checkpoint = torch.load(checkpoint_tar, map_location=device)
             start_epoch = checkpoint['epoch']
             best_top1_acc = checkpoint['best_top1_acc']
             model.load_state_dict(checkpoint['state_dict'])
@@ -122,26 +133,39 @@ def main():
         traindir,
         transform=train_transforms)
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
-
-    val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
+    val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
             normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+        ]))
+
+    # under torchrun every rank loads its shard of the images, args.batch_size is split between the ranks
+    train_sampler, val_sampler = None, None
+    if args.distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle=False)
+
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=args.batch_size // args.world_size, shuffle=(train_sampler is None),
+        sampler=train_sampler, num_workers=args.workers, pin_memory=device.type == 'cuda')
+
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=args.batch_size // args.world_size, shuffle=False,
+        sampler=val_sampler, num_workers=args.workers, pin_memory=device.type == 'cuda')
 
     epoch = start_epoch
     while epoch < args.epochs:
         start_epoch_time = time.time()
-        
-        train_obj, train_top1_acc,  train_top5_acc, epoch = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler)
-        valid_obj, valid_top1_acc, valid_top5_acc = validate(epoch, val_loader, model, criterion, args)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        # the same scale ids on all the ranks
+        rng = np.random.RandomState(args.seed + epoch)
+
+        train_obj, train_top1_acc,  train_top5_acc, epoch = train(epoch,  train_loader, model, criterion_smooth, optimizer, scheduler, scaler, rng)
+        valid_obj, valid_top1_acc, valid_top5_acc = validate(epoch, val_loader, model, criterion, args, rng)
+        if not finite_stats(running_stats(model)):
+            print('Warning: non-finite batchnorm running statistics after epoch {}'.format(epoch))
 
         is_best = False
         if valid_top1_acc > best_top1_acc:
@@ -152,12 +176,13 @@ def main():
         print('Current Epoch took {} hours {} mins {} secs'.format(cur_epoch_time.tm_hour, cur_epoch_time.tm_min, cur_epoch_time.tm_sec))
         # print(args.save)
 
-        save_checkpoint({
-        'epoch': epoch,
-        'state_dict': model.state_dict(),
-        'best_top1_acc': best_top1_acc,
-        'optimizer' : optimizer.state_dict(),
-        }, is_best, args.save)
+        if is_main_process():
+            save_checkpoint({
+            'epoch': epoch,
+            'state_dict': model.state_dict(),
+            'best_top1_acc': best_top1_acc,
+            'optimizer' : optimizer.state_dict(),
+            }, is_best, args.save)
 
         epoch += 1
 
@@ -168,9 +193,26 @@ def main():
         print('Training took {} hour {} mins {} secs'.format(cur_time.tm_hour, cur_time.tm_min, cur_time.tm_sec))
     else:
         print('Training took {} mins and {} secs'.format(cur_time.tm_min, cur_time.tm_sec))
+    close_distributed()
+
+
+# scale ids of a random sub-network, the arguments of the PruningNet following the images.
+# the output scale ids are shared within a stage, the first block has no mid scale id. with
+# scale_id, those of the sub-network with all its scales at scale_id
+def sample_scale_ids(rng, scale_id=None):
+    if scale_id is None:
+        mid_scale_ids = rng.randint(low=0, high=len(mid_channel_scale), size=sum(stage_repeat))
+        stage_scale_ids = rng.randint(low=0, high=len(overall_channel_scale), size=len(stage_repeat))
+    else:
+        mid_scale_ids = np.full(sum(stage_repeat), scale_id)
+        stage_scale_ids = np.full(len(stage_repeat), scale_id)
+    stage_oup_scale_ids = []
+    for j in range(len(stage_repeat)):
+        stage_oup_scale_ids += [stage_scale_ids[j]]* stage_repeat[j]
+    return mid_scale_ids, stage_oup_scale_ids
 
 
-def train(epoch, train_loader, model, criterion, optimizer, scheduler):
+def train(epoch, train_loader, model, criterion, optimizer, scheduler, scaler, rng):
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
@@ -188,29 +230,29 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
 
     for i, (images, target) in enumerate(train_loader):
         data_time.update(time.time() - end)
-        images = images.cuda()
-        target = target.cuda()
-
-        # compute output
-        mid_scale_ids = np.random.randint(low=0, high=len(channel_scale), size=16)
-        overall_scale_ids = []
-        for j in range(len(stage_repeat)-1):
-            overall_scale_ids += [np.random.randint(low=0, high=len(channel_scale))]* stage_repeat[j]
-        overall_scale_ids += [-1]*(stage_repeat[-1] + 1)
-        logits = model(images, overall_scale_ids, mid_scale_ids)
-        loss = criterion(logits, target)
-
-        # measure accuracy and record loss
-        prec1, prec5 = accuracy(logits, target, topk=(1, 5))
-        n = images.size(0)
-        losses.update(loss.item(), n)   #accumulated loss
-        top1.update(prec1.item(), n)
-        top5.update(prec5.item(), n)
-
-        # compute gradient and do SGD step
+        images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+        target = target.to(device, non_blocking=True)
+
+        # compute output and gradient of every sub-network on the loaded batch, then do one SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        for k, scale_id in enumerate(sandwich_scale_ids(args.num_subnets, len(overall_channel_scale))):
+            mid_scale_ids, stage_oup_scale_ids = sample_scale_ids(rng, scale_id)
+            # the gradients are only averaged over the ranks after the last sub-network
+            with no_sync(model, k < args.num_subnets - 1):
+                with autocast(device, dtype):
+                    logits = model(images, mid_scale_ids, stage_oup_scale_ids)
+                    loss = criterion(logits, target)
+                scaler.scale(loss / args.num_subnets).backward()
+
+            # measure accuracy and record loss
+            prec1, prec5 = accuracy(logits, target, topk=(1, 5))
+            n = images.size(0)
+            losses.update(loss.item(), n)   #accumulated loss
+            top1.update(prec1.item(), n)
+            top5.update(prec5.item(), n)
+        # with fp16, the steps of overflowed gradients are skipped and the loss scale lowered
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -219,10 +261,11 @@ def train(epoch, train_loader, model, criterion, optimizer, scheduler):
         if i % args.print_freq == 0:
             progress.display(i)
 
+    reduce_meters([losses, top1, top5], device)
     return losses.avg, top1.avg, top5.avg, epoch
 
 
-def validate(epoch, val_loader, model, criterion, args):
+def validate(epoch, val_loader, model, criterion, args, rng):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
@@ -235,20 +278,16 @@ def validate(epoch, val_loader, model, criterion, args):
 
     model.eval()
 
-    mid_scale_ids = np.random.randint(low=0, high=len(channel_scale), size=16)
-    overall_scale_ids = []
-    for i in range(len(stage_repeat)-1):
-        overall_scale_ids += [np.random.randint(low=0, high=len(channel_scale))]* stage_repeat[i]
-    overall_scale_ids += [-1] * (stage_repeat[-1] + 1)
+    mid_scale_ids, stage_oup_scale_ids = sample_scale_ids(rng)
 
-    with torch.no_grad():
+    with inference_mode(), autocast(device, dtype):
         end = time.time()
         for i, (images, target) in enumerate(val_loader):
-            images = images.cuda()
-            target = target.cuda()
+            images = images.to(device, non_blocking=True, memory_format=memory_format(args.channels_last))
+            target = target.to(device, non_blocking=True)
 
             # compute output
-            logits = model(images, overall_scale_ids, mid_scale_ids)
+            logits = model(images, mid_scale_ids, stage_oup_scale_ids)
             loss = criterion(logits, target)
 
             # measure accuracy and record loss
@@ -265,6 +304,7 @@ def validate(epoch, val_loader, model, criterion, args):
             if i % args.print_freq == 0:
                 progress.display(i)
 
+        reduce_meters([losses, top1, top5], device)
         print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
               .format(top1=top1, top5=top5))
 
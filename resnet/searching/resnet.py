@@ -1,7 +1,11 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
 import torch.nn.functional as F
+from utils.weight_cache import cached_weight
+from utils.hypernet import generate_weight
+from utils.static_net import static_conv, static_bn, Residual
 
 stage_repeat = [3, 4, 6, 3]
 
@@ -40,16 +44,23 @@ class first_conv_block(nn.Module):
 
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
 
-    def forward(self, x, oup_scale_id):
+    def generate_weights(self, oup_scale_id, device):
 
         oup_scale = channel_scale[oup_scale_id]
         oup = int(self.max_oup * oup_scale)
-        scale_tensor = torch.FloatTensor([oup_scale]).to(x.device)
+        scale_tensor = torch.FloatTensor([oup_scale]).to(device)
+
+        # generated weights are memoized per scale ids when gradients are disabled
+        conv1_weight = cached_weight(self, ('conv1', oup_scale_id), device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup, self.max_inp, 7, 7), oup, self.max_inp))
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup, self.max_inp, 7, 7)
+        return conv1_weight
+
+    def forward(self, x, oup_scale_id):
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=3)
+        conv1_weight = self.generate_weights(oup_scale_id, x.device)
+
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=3)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu(out)
 
@@ -57,6 +68,15 @@ class first_conv_block(nn.Module):
 
         return out
 
+    def materialize(self, oup_scale_id):
+        conv1_weight = self.generate_weights(oup_scale_id, self.fc12.weight.device)
+
+        return nn.Sequential(
+            static_conv(conv1_weight, stride=self.stride, padding=3),
+            static_bn(self.first_bn[oup_scale_id]),
+            nn.ReLU(inplace=True),
+            copy.deepcopy(self.maxpool))
+
 
 class Bottleneck(nn.Module):
     def __init__(self, base_inplanes, base_planes, stride=1, is_downsample=False):
@@ -107,9 +127,7 @@ class Bottleneck(nn.Module):
                 oup = int(self.max_oup * oup_scale)
                 self.bn_downsample.append(nn.BatchNorm2d(oup, affine=False))
 
-    def forward(self, x, mid_scale_id, inp_scale_id, oup_scale_id):
-
-        identity = x
+    def generate_weights(self, mid_scale_id, inp_scale_id, oup_scale_id, device):
 
         mid_scale = channel_scale[mid_scale_id]
         inp_scale = channel_scale[inp_scale_id]
@@ -119,33 +137,46 @@ class Bottleneck(nn.Module):
         inp = int(self.max_inp * inp_scale)
         oup = int(self.max_oup * oup_scale)
 
-        scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(x.device)
+        scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(device)
 
-        fc11_out = F.relu(self.fc11(scale_ratio_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_mid, self.max_inp, 1, 1)
+        # generated weights are memoized per scale ids when gradients are disabled
+        scale_ids = (mid_scale_id, inp_scale_id, oup_scale_id)
+        conv1_weight = cached_weight(self, ('conv1',) + scale_ids, device,
+            lambda: generate_weight(self.fc11, self.fc12, scale_ratio_tensor, (self.max_mid, self.max_inp, 1, 1), mid, inp))
 
-        fc21_out = F.relu(self.fc21(scale_ratio_tensor))
-        conv2_weight = self.fc22(fc21_out).view(self.max_mid, self.max_mid, 3, 3)
+        conv2_weight = cached_weight(self, ('conv2',) + scale_ids, device,
+            lambda: generate_weight(self.fc21, self.fc22, scale_ratio_tensor, (self.max_mid, self.max_mid, 3, 3), mid, mid))
 
-        fc31_out = F.relu(self.fc31(scale_ratio_tensor))
-        conv3_weight = self.fc32(fc31_out).view(self.max_oup, self.max_mid, 1, 1)
+        conv3_weight = cached_weight(self, ('conv3',) + scale_ids, device,
+            lambda: generate_weight(self.fc31, self.fc32, scale_ratio_tensor, (self.max_oup, self.max_mid, 1, 1), oup, mid))
 
-        out = F.conv2d(x, conv1_weight[:mid, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        conv1_downsample_weight = None
+        if self.is_downsample:
+            conv1_downsample_weight = cached_weight(self, ('conv1_downsample',) + scale_ids, device,
+                lambda: generate_weight(self.fc11_downsample, self.fc12_downsample, scale_ratio_tensor, (self.max_oup, self.max_inp, 1, 1), oup, inp))
+
+        return conv1_weight, conv2_weight, conv3_weight, conv1_downsample_weight
+
+    def forward(self, x, mid_scale_id, inp_scale_id, oup_scale_id):
+
+        identity = x
+
+        conv1_weight, conv2_weight, conv3_weight, conv1_downsample_weight = \
+            self.generate_weights(mid_scale_id, inp_scale_id, oup_scale_id, x.device)
+
+        out = F.conv2d(x, conv1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn1[mid_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv2_weight[:mid, :mid, :, :], bias=None, stride=self.stride, padding=1, groups=1)
+        out = F.conv2d(out, conv2_weight, bias=None, stride=self.stride, padding=1, groups=1)
         out = self.bn2[mid_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv3_weight[:oup, :mid, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv3_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn3[oup_scale_id](out)
 
         if self.is_downsample:
-            fc11_downsample_out = F.relu(self.fc11_downsample(scale_ratio_tensor))
-            conv1_downsample_weight = self.fc12_downsample(fc11_downsample_out).view(self.max_oup, self.max_inp, 1, 1)
-
-            identity = F.conv2d(x, conv1_downsample_weight[:oup, :inp, :, :], bias=None, stride=self.stride, padding=0, groups=1)
+            identity = F.conv2d(x, conv1_downsample_weight, bias=None, stride=self.stride, padding=0, groups=1)
 
             identity = self.bn_downsample[oup_scale_id](identity)
 
@@ -154,6 +185,28 @@ class Bottleneck(nn.Module):
 
         return out
 
+    def materialize(self, mid_scale_id, inp_scale_id, oup_scale_id):
+        conv1_weight, conv2_weight, conv3_weight, conv1_downsample_weight = \
+            self.generate_weights(mid_scale_id, inp_scale_id, oup_scale_id, self.fc12.weight.device)
+
+        body = nn.Sequential(
+            static_conv(conv1_weight),
+            static_bn(self.bn1[mid_scale_id]),
+            nn.ReLU(inplace=True),
+            static_conv(conv2_weight, stride=self.stride, padding=1),
+            static_bn(self.bn2[mid_scale_id]),
+            nn.ReLU(inplace=True),
+            static_conv(conv3_weight),
+            static_bn(self.bn3[oup_scale_id]))
+
+        shortcut = None
+        if self.is_downsample:
+            shortcut = nn.Sequential(
+                static_conv(conv1_downsample_weight, stride=self.stride),
+                static_bn(self.bn_downsample[oup_scale_id]))
+
+        return Residual(body, shortcut, relu=True)
+
 class ResNet50(nn.Module):
     def __init__(self, num_classes=1000):
         super(ResNet50, self).__init__()
@@ -185,7 +238,7 @@ class ResNet50(nn.Module):
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.fc = nn.Linear(2048, num_classes)
 
-    def forward(self, x, ids):
+    def block_scale_ids(self, ids):
 
         stage_oup_scale_ids = []
         stage_oup_scale_ids += [ids[0]]
@@ -196,11 +249,15 @@ class ResNet50(nn.Module):
 
         mid_scale_ids = ids[len(stage_repeat):]
 
-        for i, block in enumerate(self.layers):
-            if i == 0:
-                x = block(x, stage_oup_scale_ids[i])
-            else:
-                x = block(x, mid_scale_ids[i-1], stage_oup_scale_ids[i-1], stage_oup_scale_ids[i])
+        block_ids = [(stage_oup_scale_ids[0],)]
+        for i in range(1, len(self.layers)):
+            block_ids += [(mid_scale_ids[i-1], stage_oup_scale_ids[i-1], stage_oup_scale_ids[i])]
+        return block_ids
+
+    def forward(self, x, ids):
+
+        for block, scale_ids in zip(self.layers, self.block_scale_ids(ids)):
+            x = block(x, *scale_ids)
 
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
@@ -208,4 +265,10 @@ class ResNet50(nn.Module):
 
         return x
 
+    def materialize(self, ids):
+        """Static network with the generated weights and current batchnorm statistics of ids"""
+        with torch.no_grad():
+            layers = [block.materialize(*scale_ids) for block, scale_ids in zip(self.layers, self.block_scale_ids(ids))]
+            return nn.Sequential(*layers, copy.deepcopy(self.avgpool), nn.Flatten(), copy.deepcopy(self.fc))
+
 
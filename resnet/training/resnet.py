@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.utils.model_zoo as model_zoo
 import torch.nn.functional as F
+from utils.hypernet import generate_weight
 
 stage_repeat = [3, 4, 6, 3]
 
@@ -46,10 +47,9 @@ class first_conv_block(nn.Module):
         oup = int(self.max_oup * oup_scale)
         scale_tensor = torch.FloatTensor([oup_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_oup, self.max_inp, 7, 7)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_tensor, (self.max_oup, self.max_inp, 7, 7), oup, self.max_inp)
 
-        out = F.conv2d(x, conv1_weight[:oup, :, :, :], bias=None, stride=self.stride, padding=3)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=self.stride, padding=3)
         out = self.first_bn[oup_scale_id](out)
         out = F.relu(out)
 
@@ -121,31 +121,27 @@ class Bottleneck(nn.Module):
 
         scale_ratio_tensor = torch.FloatTensor([mid_scale, inp_scale, oup_scale]).to(x.device)
 
-        fc11_out = F.relu(self.fc11(scale_ratio_tensor))
-        conv1_weight = self.fc12(fc11_out).view(self.max_mid, self.max_inp, 1, 1)
+        conv1_weight = generate_weight(self.fc11, self.fc12, scale_ratio_tensor, (self.max_mid, self.max_inp, 1, 1), mid, inp)
 
-        fc21_out = F.relu(self.fc21(scale_ratio_tensor))
-        conv2_weight = self.fc22(fc21_out).view(self.max_mid, self.max_mid, 3, 3)
+        conv2_weight = generate_weight(self.fc21, self.fc22, scale_ratio_tensor, (self.max_mid, self.max_mid, 3, 3), mid, mid)
 
-        fc31_out = F.relu(self.fc31(scale_ratio_tensor))
-        conv3_weight = self.fc32(fc31_out).view(self.max_oup, self.max_mid, 1, 1)
+        conv3_weight = generate_weight(self.fc31, self.fc32, scale_ratio_tensor, (self.max_oup, self.max_mid, 1, 1), oup, mid)
 
-        out = F.conv2d(x, conv1_weight[:mid, :inp, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(x, conv1_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn1[mid_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv2_weight[:mid, :mid, :, :], bias=None, stride=self.stride, padding=1, groups=1)
+        out = F.conv2d(out, conv2_weight, bias=None, stride=self.stride, padding=1, groups=1)
         out = self.bn2[mid_scale_id](out)
         out = F.relu(out)
 
-        out = F.conv2d(out, conv3_weight[:oup, :mid, :, :], bias=None, stride=1, padding=0, groups=1)
+        out = F.conv2d(out, conv3_weight, bias=None, stride=1, padding=0, groups=1)
         out = self.bn3[oup_scale_id](out)
 
         if self.is_downsample:
-            fc11_downsample_out = F.relu(self.fc11_downsample(scale_ratio_tensor))
-            conv1_downsample_weight = self.fc12_downsample(fc11_downsample_out).view(self.max_oup, self.max_inp, 1, 1)
+            conv1_downsample_weight = generate_weight(self.fc11_downsample, self.fc12_downsample, scale_ratio_tensor, (self.max_oup, self.max_inp, 1, 1), oup, inp)
 
-            identity = F.conv2d(x, conv1_downsample_weight[:oup, :inp, :, :], bias=None, stride=self.stride, padding=0, groups=1)
+            identity = F.conv2d(x, conv1_downsample_weight, bias=None, stride=self.stride, padding=0, groups=1)
 
             identity = self.bn_downsample[oup_scale_id](identity)
 
@@ -0,0 +1,169 @@
+import time
+import argparse
+import importlib
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.flops import channel_scale, arch_layers, layer_columns, mobilenet_v2_stage_repeat
+from utils.bn_calibration import cache_batches, batchnorm_layers, load_bn_stats, recalibrate_bn, finite_stats
+from utils.image_subsets import get_subset, normalize_batch
+from utils.device import add_device_arguments, setup_device, to_device, inference_mode, amp_dtype, autocast, grad_scaler
+
+# numerical stability and speed of the autocast (--amp) paths of the PruningNet training and of
+# the candidate evaluation of the search. for random candidates of an architecture, the weights
+# generated by the hypernetworks, the recalibrated batchnorm statistics and the top-1 accuracy of
+# the static network are compared between fp32 and autocast, and a training step of the
+# PruningNet and the evaluation are timed in both. without --data the images are random and only
+# the agreement of the predictions is meaningful. run from the repository root:
+# python -m utils.amp_benchmark --arch mobilenet_v2 --device cpu --amp bf16 --net_cache mobilenetv2/training/models/checkpoint.pth.tar
+
+
+# module and class of the searching PruningNet of every architecture, and its forward arguments following the images
+pruning_nets = {
+    'resnet50': ('resnet.searching.resnet', 'ResNet50', lambda ids: (ids,)),
+    'mobilenet_v1': ('mobilenetv1.searching.mobilenet_v1', 'MobileNetV1', lambda ids: (ids,)),
+    'mobilenet_v2': ('mobilenetv2.searching.mobilenet_v2', 'MobileNetV2',
+                     lambda ids: (ids[:sum(mobilenet_v2_stage_repeat)], ids[sum(mobilenet_v2_stage_repeat):])),
+}
+
+
+def random_encoding(arch, num_genes, rng):
+    """Random scale ids of arch, the output scale ids of a MobileNetV2 stage are shared"""
+    ids = rng.randint(len(channel_scale), size=num_genes)
+    if arch == 'mobilenet_v2':
+        start = 0
+        for repeat in mobilenet_v2_stage_repeat:
+            ids[start:start+repeat] = ids[start]
+            start += repeat
+    return ids
+
+
+def relative_error(reference, value):
+    reference, value = reference.float(), value.float()
+    return float((value - reference).norm() / reference.norm().clamp_min(1e-12))
+
+
+def bn_errors(stats, amp_stats, eps=1e-5):
+    """Largest shift of the running means in running standard deviations, and largest relative
+    error of the running variances, of the statistics recalibrated under autocast"""
+    mean_error, var_error = 0., 0.
+    for (mean, var), (amp_mean, amp_var) in zip(stats, amp_stats):
+        mean_error = max(mean_error, float(((amp_mean - mean).abs() / (var + eps).sqrt()).max()))
+        var_error = max(var_error, float(((amp_var - var).abs() / (var + eps)).max()))
+    return mean_error, var_error
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def evaluate(model, net_inputs, calib_batches, val_batches, device, dtype, channels_last):
+    """Recalibrate and score the candidate of net_inputs as the search does, in fp32 when dtype is None.
+    Returns its batchnorm statistics, the conv weights of its static network, its top-1 accuracy,
+    its predictions and the seconds taken"""
+    start = time.perf_counter()
+    preprocess = lambda images: normalize_batch(images, device=device, channels_last=channels_last)
+    stats = recalibrate_bn(model, calib_batches, [net_inputs], preprocess, dtype=dtype)[0]
+    load_bn_stats(batchnorm_layers(model), stats)
+    model.eval()
+    with autocast(device, dtype):
+        net = to_device(model.materialize(*net_inputs), device, channels_last).eval()
+
+    predictions, correct, total = [], 0, 0
+    with inference_mode(), autocast(device, dtype):
+        for images, target in val_batches:
+            predictions += [net(preprocess(images)).argmax(1).cpu()]
+            correct += int((predictions[-1] == target).sum())
+            total += len(target)
+    weights = [m.weight.detach() for m in net.modules() if isinstance(m, nn.Conv2d)]
+    return stats, weights, 100. * correct / total, torch.cat(predictions), time.perf_counter() - start
+
+
+def train_step_time(model, net_inputs, images, target, device, dtype, channels_last, steps):
+    """Seconds of a forward and backward pass of the PruningNet on images, after a warm-up one"""
+    criterion = nn.CrossEntropyLoss().to(device)
+    scaler = grad_scaler(device, dtype)
+    images = normalize_batch(images, device=device, channels_last=channels_last)
+    target = target.to(device)
+    model.train()
+    for step in range(steps + 1):
+        if step == 1:
+            synchronize(device)
+            start = time.perf_counter()
+        model.zero_grad(set_to_none=True)
+        with autocast(device, dtype):
+            loss = criterion(model(images, *net_inputs), target)
+        scaler.scale(loss).backward()
+    synchronize(device)
+    model.zero_grad(set_to_none=True)
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Autocast benchmark")
+    parser.add_argument('--arch', type=str, nargs='+', default=sorted(pruning_nets.keys()), help='architectures to benchmark')
+    parser.add_argument('--net_cache', type=str, nargs='*', default=[], help='trained PruningNet checkpoint of every architecture (default: random weights)')
+    parser.add_argument('--data', type=str, default='', help='ImageNet directory of the image subsets (default: random images)')
+    parser.add_argument('--subset_dir', type=str, default='./subsets', help='location of the subset files')
+    parser.add_argument('--input_size', type=int, default=224, help='input resolution')
+    parser.add_argument('--candidates', type=int, default=3, help='random candidates per architecture')
+    parser.add_argument('--batch_size', type=int, default=32, help='images per batch')
+    parser.add_argument('--calib_batches', type=int, default=4, help='batchnorm recalibration batches')
+    parser.add_argument('--val_batches', type=int, default=4, help='scored batches')
+    parser.add_argument('--train_steps', type=int, default=3, help='timed training steps per candidate')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the candidates')
+    add_device_arguments(parser)
+    parser.set_defaults(amp='bf16')
+    args = parser.parse_args()
+    device = setup_device(args)
+    dtype = amp_dtype(args, device)
+
+    shape = (args.batch_size, 3, args.input_size, args.input_size)
+    if args.data:
+        calib = get_subset(args.data + '/ILSVRC2012_img_train', args.subset_dir, 'calib', args.calib_batches*args.batch_size, args.input_size)
+        val = get_subset(args.data + '/ILSVRC2012_img_val', args.subset_dir, 'val', args.val_batches*args.batch_size, args.input_size)
+        calib_batches = cache_batches(calib.batches(args.batch_size), args.calib_batches)
+        val_batches = list(val.batches(args.batch_size))
+    else:
+        calib_batches = [torch.randint(0, 256, shape, dtype=torch.uint8) for _ in range(args.calib_batches)]
+        val_batches = [(torch.randint(0, 256, shape, dtype=torch.uint8), torch.randint(0, 1000, (args.batch_size,)))
+                       for _ in range(args.val_batches)]
+    eval_images = (args.calib_batches + args.val_batches) * args.batch_size
+    print('{} against fp32 on {}, {} candidates of {} calibration and {} scored batches of {} images'.format(
+        args.amp, device, args.candidates, args.calib_batches, args.val_batches, args.batch_size), flush=True)
+
+    for a, arch in enumerate(args.arch):
+        module, name, inputs = pruning_nets[arch]
+        model = to_device(getattr(importlib.import_module(module), name)(), device, args.channels_last)
+        if a < len(args.net_cache):
+            state_dict = torch.load(args.net_cache[a], map_location=device)['state_dict']
+            model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()})
+        num_genes = max(max(layer_columns(specs), default=-1) for _, _, specs in arch_layers[arch](args.input_size)) + 1
+        rng = np.random.RandomState(args.seed)
+
+        rows = []
+        for k in range(args.candidates):
+            net_inputs = inputs(random_encoding(arch, num_genes, rng))
+            stats, weights, top1, predictions, seconds = evaluate(model, net_inputs, calib_batches, val_batches, device, None, args.channels_last)
+            amp_stats, amp_weights, amp_top1, amp_predictions, amp_seconds = evaluate(model, net_inputs, calib_batches, val_batches, device, dtype, args.channels_last)
+            finite = finite_stats(amp_stats) and all(bool(torch.isfinite(w).all()) for w in amp_weights)
+            rows += [[max(relative_error(w, v) for w, v in zip(weights, amp_weights)),
+                      *bn_errors(stats, amp_stats),
+                      float(not finite), top1, amp_top1, 100. * float((predictions == amp_predictions).float().mean()),
+                      eval_images / seconds, eval_images / amp_seconds]]
+            # the training steps update the batchnorm statistics loaded last, they are timed after the comparison
+            rows[-1] += [args.batch_size / train_step_time(model, net_inputs, val_batches[0][0], val_batches[0][1], device, d, args.channels_last, args.train_steps)
+                         for d in (None, dtype)]
+            print('{} candidate {}: weights rel. error {:.2e} | bn mean shift {:.2e} std, var rel. error {:.2e} | top-1 {:.2f} -> {:.2f} | same predictions {:.1f}%{}'.format(
+                arch, k, *rows[-1][:3], *rows[-1][4:7], '' if finite else ' | NON-FINITE'), flush=True)
+        rows = np.array(rows)
+        print('{:<12} {} candidates: max weights rel. error {:.2e} | max bn mean shift {:.2e} std, var rel. error {:.2e} | {} non-finite | '
+              'top-1 {:.2f} -> {:.2f} (delta {:+.2f}) | same predictions {:.1f}%'.format(
+                  arch, len(rows), *rows[:, :3].max(0), int(rows[:, 3].sum()), *rows[:, 4:6].mean(0),
+                  rows[:, 5].mean() - rows[:, 4].mean(), rows[:, 6].mean()), flush=True)
+        print('{:<12} evaluation {:8.1f} -> {:8.1f} images/s (speedup {:.2f}x) | training step {:8.1f} -> {:8.1f} images/s (speedup {:.2f}x)'.format(
+            arch, *rows[:, 7:9].mean(0), rows[:, 8].mean() / rows[:, 7].mean(),
+            *rows[:, 9:11].mean(0), rows[:, 10].mean() / rows[:, 9].mean()), flush=True)
+        del model
@@ -0,0 +1,84 @@
+import torch
+import torch.nn as nn
+
+from utils.device import inference_mode, autocast
+
+# batchnorm recalibration of several pruned networks sharing one pass over a fixed
+# calibration set. the PruningNet keeps one BatchNorm per channel scale, so two
+# candidates using the same scale in a layer share the module: every candidate gets
+# its own running statistics buffers, which are swapped into the BatchNorms before
+# its forward pass and updated in place by it.
+
+
+def cache_batches(loader, num_batches, max_mb=None):
+    """Load the first num_batches image batches of loader once and keep them in memory.
+    The images must be the raw uint8 ones, normalized on the device by the preprocessing
+    of recalibrate_bn. With max_mb, the batches that would take the cache over max_mb
+    megabytes are left out."""
+    batches, cached_bytes = [], 0
+    for i, (images, target) in enumerate(loader):
+        if i >= num_batches:
+            break
+        if images.dtype != torch.uint8:
+            raise TypeError('calibration batches are cached as uint8 images, got {}'.format(images.dtype))
+        batch_bytes = images.numel() * images.element_size()
+        if max_mb is not None and cached_bytes + batch_bytes > max_mb * 2**20:
+            print('Calibration cache limited to {} MB: {} of the {} batches kept'.format(max_mb, len(batches), num_batches), flush=True)
+            break
+        batches += [images]
+        cached_bytes += batch_bytes
+    return batches
+
+
+def batchnorm_layers(model):
+    return [m for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+
+
+def reset_bn_stats(bns):
+    return [(torch.zeros_like(m.running_mean), torch.ones_like(m.running_var)) for m in bns]
+
+
+def load_bn_stats(bns, stats):
+    for m, (running_mean, running_var) in zip(bns, stats):
+        m.running_mean = running_mean
+        m.running_var = running_var
+
+
+def finite_stats(stats):
+    """Whether all the running statistics of stats (of a candidate, or of a network) are finite"""
+    return all(bool(torch.isfinite(mean).all() and torch.isfinite(var).all()) for mean, var in stats)
+
+
+def running_stats(model):
+    return [(m.running_mean, m.running_var) for m in batchnorm_layers(model)]
+
+
+def recalibrate_bn(model, batches, inputs, preprocess=None, momentum=None, dtype=None):
+    """Recalibrate the batchnorm statistics of several candidates with one pass over batches.
+    With the default momentum=None the statistics are the cumulative average over the batches,
+    which does not depend on their order; a momentum weights the last batches the most.
+    inputs holds, for every candidate, the arguments following the images in model(images, ...).
+    preprocess maps a batch to the network input, it defaults to moving it to the gpu. dtype is
+    the autocast dtype of the forward passes, None in fp32; the statistics are kept in fp32.
+    Returns the running statistics of every candidate, to be set with load_bn_stats."""
+    bns = batchnorm_layers(model)
+    for m in bns:
+        m.momentum = momentum
+    stats = [reset_bn_stats(bns) for _ in inputs]
+
+    # we only need to run the forward pass and the statistics of batchnorm will be recalculated
+    model.train()
+    device = next(model.parameters()).device
+    with inference_mode(), autocast(device, dtype):
+        for b, images in enumerate(batches):
+            images = preprocess(images) if preprocess is not None else images.cuda(non_blocking=True)
+            for candidate_inputs, candidate_stats in zip(inputs, stats):
+                load_bn_stats(bns, candidate_stats)
+                if momentum is None:
+                    # the batches counted by the shared BatchNorms are those of this candidate,
+                    # every BatchNorm it uses has seen b batches of it
+                    for m in bns:
+                        m.num_batches_tracked.fill_(b)
+                logits = model(images, *candidate_inputs)
+                del logits
+    return stats
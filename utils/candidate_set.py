@@ -0,0 +1,128 @@
+import numpy as np
+
+# compact set of encoding vectors with one score each. the scale ids (< 32) are packed
+# 5 bits per gene, 12 genes per 64-bit word, and the words of an encoding are hashed to
+# one 64-bit integer. the set keeps its hashes sorted, next to the packed words and the
+# scores, so whole batches of encodings are looked up or inserted with numpy calls. an
+# encoding of MobileNetV2 (35 genes) takes 40 bytes instead of a tuple of 35 floats.
+
+bits_per_gene = 5
+genes_per_word = 64 // bits_per_gene
+gene_shifts = np.arange(genes_per_word, dtype=np.uint64) * np.uint64(bits_per_gene)
+
+
+def pack(ids):
+    """(N, num_words) uint64 packed rows of an (N, num_genes) array of scale ids"""
+    ids = np.asarray(ids)
+    ids = ids.reshape(-1, ids.shape[-1])
+    num_words = -(-ids.shape[1] // genes_per_word)
+    padded = np.zeros((len(ids), num_words * genes_per_word), dtype=np.uint64)
+    padded[:, :ids.shape[1]] = ids
+    return (padded.reshape(len(ids), num_words, genes_per_word) << gene_shifts).sum(axis=2, dtype=np.uint64)
+
+
+def unpack(words, num_genes):
+    """(N, num_genes) int8 scale ids of packed rows"""
+    ids = (words[:, :, None] >> gene_shifts) & np.uint64(2**bits_per_gene - 1)
+    return ids.reshape(len(words), words.shape[1] * genes_per_word)[:, :num_genes].astype(np.int8)
+
+
+def mix64(h):
+    # splitmix64 finalizer
+    h = h ^ (h >> np.uint64(30))
+    h = h * np.uint64(0xbf58476d1ce4e5b9)
+    h = h ^ (h >> np.uint64(27))
+    h = h * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def packed_hash(words):
+    """64-bit hash of every packed row"""
+    h = np.zeros(len(words), dtype=np.uint64)
+    for w in range(words.shape[1]):
+        h = mix64(h ^ words[:, w])
+    return h
+
+
+class CandidateSet(object):
+    """Set of encodings of num_genes scale ids with a score each"""
+    def __init__(self, num_genes):
+        self.num_genes = num_genes
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.words = np.zeros((0, -(-num_genes // genes_per_word)), dtype=np.uint64)
+        self.values = np.zeros(0)
+
+    @classmethod
+    def from_dict(cls, scores, num_genes):
+        """Set of the {encoding tuple: score} dict scores"""
+        candidates = cls(num_genes)
+        if scores:
+            candidates.add(np.array(list(scores.keys())), np.array(list(scores.values()), dtype=np.float64))
+        return candidates
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def find(self, ids):
+        """Position of every encoding of ids in the set, -1 for those not in it"""
+        words = pack(ids)
+        return self.find_packed(words, packed_hash(words))
+
+    def find_packed(self, words, hashes):
+        start = np.searchsorted(self.hashes, hashes, side='left')
+        end = np.searchsorted(self.hashes, hashes, side='right')
+        found = np.full(len(hashes), -1, dtype=np.int64)
+        # encodings sharing a hash are next to each other, compare their words one by one
+        for k in range(int((end - start).max(initial=0))):
+            pos = start + k
+            check = np.flatnonzero((pos < end) & (found < 0))
+            match = (self.words[pos[check]] == words[check]).all(axis=1)
+            found[check[match]] = pos[check[match]]
+        return found
+
+    def contains(self, ids):
+        return self.find(ids) >= 0
+
+    def __contains__(self, ids):
+        return bool(self.contains(ids)[0])
+
+    def __getitem__(self, ids):
+        pos = self.find(ids)[0]
+        if pos < 0:
+            raise KeyError(tuple(np.asarray(ids).astype(int)))
+        return self.values[pos]
+
+    def scores(self, ids, default=np.nan):
+        """Score of every encoding of ids, default for those not in the set"""
+        pos = self.find(ids)
+        return np.where(pos >= 0, self.values[np.maximum(pos, 0)] if len(self) else default, default)
+
+    def add(self, ids, scores=0.):
+        """Insert the encodings of ids, or update their scores if they are already in the set"""
+        words = pack(ids)
+        hashes = packed_hash(words)
+        scores = np.broadcast_to(np.asarray(scores, dtype=np.float64), hashes.shape)
+        found = self.find_packed(words, hashes)
+        self.values[found[found >= 0]] = scores[found >= 0]
+
+        new = np.flatnonzero(found < 0)
+        _, first = np.unique(words[new], axis=0, return_index=True)
+        new = new[first]
+        new = new[np.argsort(hashes[new], kind='stable')]
+        pos = np.searchsorted(self.hashes, hashes[new])
+        self.hashes = np.insert(self.hashes, pos, hashes[new])
+        self.words = np.insert(self.words, pos, words[new], axis=0)
+        self.values = np.insert(self.values, pos, scores[new])
+        return self
+
+    def remove(self, ids):
+        """Remove the encodings of ids that are in the set"""
+        pos = self.find(ids)
+        pos = pos[pos >= 0]
+        self.hashes = np.delete(self.hashes, pos)
+        self.words = np.delete(self.words, pos, axis=0)
+        self.values = np.delete(self.values, pos)
+
+    def encodings(self):
+        """(len, num_genes) scale ids of the encodings in the set"""
+        return unpack(self.words, self.num_genes)
@@ -0,0 +1,68 @@
+import argparse
+import importlib
+import numpy as np
+import torch
+
+from utils.flops import channel_scale, arch_layers, layer_columns, batch_flops, mobilenet_v2_stage_repeat
+
+# checks the closed-form FLOPs of utils/flops.py against the hook-based counter
+# print_model_parm_flops of cal_FLOPs.py, on the static evaluating models built for random
+# encodings of every architecture. a change of the models or of the cost formulas that makes
+# them drift apart fails here. run from the repository root: python -m utils.check_flops
+
+# module and class of the static evaluating model of every architecture, and the encoding vector
+# it is built from for a search encoding. the static MobileNetV1 scales the output of layer i by
+# vector[i-1], while the PruningNet (and the FLOPs tables) scale it by ids[i]
+static_models = {
+    'resnet50': ('resnet.evaluating.resnet', 'ResNet50', lambda ids: ids),
+    'mobilenet_v1': ('mobilenetv1.evaluating.mobilenet_v1', 'MobileNetV1', lambda ids: np.roll(ids, -1)),
+    'mobilenet_v2': ('mobilenetv2.evaluating.mobilenet_v2', 'MobileNetV2', lambda ids: ids),
+}
+
+
+def random_encodings(arch, num, rng):
+    """num random encodings of arch, the output scale ids of a MobileNetV2 stage are shared"""
+    num_genes = max(max(layer_columns(specs), default=-1) for _, _, specs in arch_layers[arch](224)) + 1
+    ids = rng.randint(len(channel_scale), size=(num, num_genes))
+    if arch == 'mobilenet_v2':
+        start = 0
+        for repeat in mobilenet_v2_stage_repeat:
+            ids[:, start:start+repeat] = ids[:, start:start+1]
+            start += repeat
+    # the unpruned and the smallest networks are always checked
+    ids[0], ids[1] = len(channel_scale) - 1, 0
+    return ids
+
+
+def check_arch(arch, num, rng, tolerance=1e-6):
+    """Number of the num encodings of arch whose closed-form FLOPs differ from the hook-based ones"""
+    print_model_parm_flops = importlib.import_module('mobilenetv2.searching.cal_FLOPs').print_model_parm_flops
+    module, name, encoding_vector = static_models[arch]
+    model_class = getattr(importlib.import_module(module), name)
+    ids = random_encodings(arch, num, rng)
+    flops, _ = batch_flops(arch, ids)
+    mismatches = 0
+    for row, closed_form in zip(ids, flops):
+        hooked = print_model_parm_flops(model_class(encoding_vector(row)).eval())
+        if abs(hooked - closed_form) > tolerance * max(hooked, 1):
+            mismatches += 1
+            print('{} {}: closed form {:.4f} MFLOPs, hooks {:.4f} MFLOPs'.format(arch, row.tolist(), closed_form, hooked), flush=True)
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("FLOPs check")
+    parser.add_argument('--arch', type=str, nargs='+', default=sorted(static_models.keys()), help='architectures to check')
+    parser.add_argument('--encodings', type=int, default=5, help='encodings checked per architecture')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    rng = np.random.RandomState(args.seed)
+    failed = 0
+    for arch in args.arch:
+        mismatches = check_arch(arch, args.encodings, rng)
+        print('{:<12} {}/{} encodings match'.format(arch, args.encodings - mismatches, args.encodings), flush=True)
+        failed += mismatches
+    if failed:
+        raise SystemExit('{} encodings do not match'.format(failed))
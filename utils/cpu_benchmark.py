@@ -0,0 +1,132 @@
+import time
+import argparse
+import importlib
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.flops import channel_scale, arch_layers, layer_columns, batch_flops
+from utils.latency import static_network
+from utils.image_subsets import ImageSubset, normalize_batch
+from utils.device import to_device, inference_mode, add_device_arguments, data_parallel
+from utils.weight_cache import set_weight_cache
+from utils.search_engine import Architecture, SearchEngine, add_search_arguments
+from utils.amp_benchmark import pruning_nets, random_encoding
+
+# per-candidate cpu throughput of the evaluation of the search. random candidates of an
+# architecture are built as static networks and score uint8 batches normalized as the image
+# subsets are, with the previous path (torch.no_grad, NCHW) and with the cpu path of
+# --device cpu (torch.inference_mode, then also channels_last). with --pruning_net, the
+# candidates are also evaluated as the search does on the cpu, through
+# SearchEngine.evaluate_group: batchnorm recalibration of the PruningNet, generation of the
+# weights and scoring of the materialized (or dynamic) network. run from the repository root:
+# python -m utils.cpu_benchmark --arch mobilenet_v2 --threads 8 --pruning_net
+
+
+# name, channels_last, inference_mode of every evaluation path timed
+paths = [('no_grad NCHW', False, False),
+         ('inference_mode NCHW', False, True),
+         ('inference_mode channels_last', True, True)]
+
+
+# name, channels_last, dynamic_eval of every search evaluation path timed with --pruning_net
+search_paths = [('search materialized NCHW', False, False),
+                ('search dynamic NCHW', False, True),
+                ('search materialized channels_last', True, False)]
+
+
+def score_time(net, batches, channels_last, inference):
+    """Seconds taken by net to score batches on the cpu, after one warm-up batch"""
+    net = to_device(net, 'cpu', channels_last).eval()
+    with inference_mode() if inference else torch.no_grad():
+        net(normalize_batch(batches[0], device='cpu', channels_last=channels_last))
+        start = time.perf_counter()
+        for images in batches:
+            net(normalize_batch(images, device='cpu', channels_last=channels_last))
+    return time.perf_counter() - start
+
+
+def search_engine(arch, num_genes, calib_batches, val_batches, batch_size, channels_last, dynamic_eval):
+    """SearchEngine evaluating the candidates of arch on the cpu, with the search defaults but no
+    proxy subsets and an in-memory result store, recalibrated on calib_batches and scored on the
+    (images, target) val_batches. The reward is not reported, the base accuracy is a placeholder."""
+    module, name, net_inputs = pruning_nets[arch]
+    net_class = getattr(importlib.import_module(module), name)
+    parser = add_device_arguments(add_search_arguments(argparse.ArgumentParser(), net_cache='', save_dict_name='', pareto_budgets=''))
+    args = parser.parse_args(['--device', 'cpu', '--proxy_per_class', '', '--latency_runs', '0', '--batch_size', str(batch_size),
+                              '--result_store', ':memory:', '--flops_table_dir', ''])
+    args.channels_last, args.dynamic_eval = channels_last, dynamic_eval
+    base_flops = batch_flops(arch, np.full((1, num_genes), len(channel_scale) - 1))[0][0]
+    # the candidates of the search hold float scale ids followed by their reward
+    architecture = Architecture(name, arch, net_class, lambda ids: net_inputs(ids.astype(int)),
+                                ba=100., bf=base_flops, min_FLOPs=0, max_FLOPs=base_flops)
+    val_dataset = ImageSubset(torch.cat([images for images, _ in val_batches]).numpy(), torch.cat([target for _, target in val_batches]))
+    return SearchEngine(architecture, args, torch.device('cpu'), calib_batches=calib_batches, val_dataset=val_dataset)
+
+
+def search_time(engine, model, criterion, can):
+    """Seconds taken by the search to recalibrate and score the candidate can"""
+    start = time.perf_counter()
+    next(engine.evaluate_group((model, criterion), ([can], -np.inf)))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CPU evaluation benchmark")
+    parser.add_argument('--arch', type=str, nargs='+', default=sorted(arch_layers.keys()), help='architectures to benchmark')
+    parser.add_argument('--input_size', type=int, default=224, help='input resolution')
+    parser.add_argument('--candidates', type=int, default=5, help='random candidates scored per architecture')
+    parser.add_argument('--batch_size', type=int, default=50, help='images per batch')
+    parser.add_argument('--batches', type=int, default=4, help='timed batches per candidate')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op cpu threads (0: all the cores)')
+    parser.add_argument('--pruning_net', action='store_true', help='also time the evaluation of the search on the PruningNet')
+    parser.add_argument('--net_cache', type=str, nargs='*', default=[], help='trained PruningNet checkpoint of every architecture (default: random weights)')
+    parser.add_argument('--calib_batches', type=int, default=2, help='batchnorm recalibration batches of the search evaluation')
+    parser.add_argument('--weight_cache_mb', type=int, default=4096, help='memory for the generated conv weights of the search evaluation (0 disables)')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print('{} threads, {} candidates of {} x {} images'.format(torch.get_num_threads(), args.candidates, args.batches, args.batch_size), flush=True)
+    batches = [torch.randint(0, 256, (args.batch_size, 3, args.input_size, args.input_size), dtype=torch.uint8)
+               for _ in range(args.batches)]
+
+    for a, arch in enumerate(args.arch):
+        num_genes = max(max(layer_columns(specs), default=-1) for _, _, specs in arch_layers[arch](args.input_size)) + 1
+        rng = np.random.RandomState(0)
+        ids = rng.randint(len(channel_scale), size=(args.candidates, num_genes))
+        seconds = np.zeros((len(paths), args.candidates))
+        for k, row in enumerate(ids):
+            net = static_network(arch, row, args.input_size)
+            for p, (_, channels_last, inference) in enumerate(paths):
+                seconds[p, k] = score_time(net, batches, channels_last, inference)
+        images = args.batches * args.batch_size
+        for p, (name, _, _) in enumerate(paths):
+            print('{:<12} {:<33}: {:8.1f} images/s | {:.3f} secs per candidate and 1000 images | speedup {:.2f}x'.format(
+                arch, name, images / seconds[p].mean(), 1000 * seconds[p].mean() / images, seconds[0].sum() / seconds[p].sum()), flush=True)
+
+        if not args.pruning_net:
+            continue
+        calib_batches = batches[:args.calib_batches]
+        val_batches = [(images, torch.randint(0, 1000, (len(images),))) for images in batches]
+        criterion = nn.CrossEntropyLoss()
+        model = getattr(importlib.import_module(pruning_nets[arch][0]), pruning_nets[arch][1])()
+        if a < len(args.net_cache):
+            state_dict = torch.load(args.net_cache[a], map_location='cpu')['state_dict']
+            model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()})
+        model = data_parallel(model, torch.device('cpu'))
+        cans = [np.append(random_encoding(arch, num_genes, rng), 0.) for _ in range(args.candidates + 1)]
+        seconds = np.zeros((len(search_paths), args.candidates))
+        for p, (_, channels_last, dynamic_eval) in enumerate(search_paths):
+            engine = search_engine(arch, num_genes, calib_batches, val_batches, args.batch_size, channels_last, dynamic_eval)
+            to_device(model, 'cpu', channels_last)
+            set_weight_cache(model.module, args.weight_cache_mb)
+            # the first candidate warms up the path
+            search_time(engine, model, criterion, cans[0])
+            for k, can in enumerate(cans[1:]):
+                seconds[p, k] = search_time(engine, model, criterion, can)
+        images = (args.calib_batches + args.batches) * args.batch_size
+        for p, (name, _, _) in enumerate(search_paths):
+            print('{:<12} {:<33}: {:8.1f} images/s | {:.3f} secs per candidate ({} calibration and {} scored batches) | speedup {:.2f}x'.format(
+                arch, name, images / seconds[p].mean(), seconds[p].mean(), args.calib_batches, args.batches, seconds[0].sum() / seconds[p].sum()), flush=True)
+        del model
@@ -0,0 +1,92 @@
+import os
+import torch
+import torch.nn as nn
+
+# device the training, search and evaluation scripts run on. the gpus are only made visible
+# when a cuda device is used, the cpu runs with multi-threaded intra-op parallelism. with
+# channels_last, the networks and their inputs are laid out NHWC, which the cpu convolution
+# kernels (oneDNN) run without reordering every activation. with --amp, the forward passes
+# run under autocast: bf16 on the cpu, fp16 (with a GradScaler in training) or bf16 on cuda.
+# the parameters, their gradients and the batchnorm statistics stay in fp32.
+
+
+def add_device_arguments(parser, gpus=''):
+    """Arguments of the device, gpus is the default CUDA_VISIBLE_DEVICES of the script"""
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu', 'cuda'], help='device to run on (auto: cuda when available)')
+    parser.add_argument('--gpus', type=str, default=gpus, help='CUDA_VISIBLE_DEVICES of the cuda device (empty: unchanged)')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads on the cpu (0: all the cores)')
+    parser.add_argument('--channels_last', action='store_true', help='NHWC memory format of the networks and their inputs')
+    parser.add_argument('--amp', type=str, default='', choices=['', 'bf16', 'fp16'], help='autocast precision of the forward passes (empty: fp32, fp16 needs cuda)')
+    return parser
+
+
+def setup_device(args):
+    """torch.device of the arguments of add_device_arguments. Must run before cuda is initialized."""
+    if args.device != 'cpu' and args.gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+    if args.device == 'cuda' or (args.device == 'auto' and torch.cuda.is_available()):
+        print("Using GPU No:", os.environ.get("CUDA_VISIBLE_DEVICES", 'all'))
+        return torch.device('cuda')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print("Using the CPU with {} threads".format(torch.get_num_threads()))
+    return torch.device('cpu')
+
+
+amp_dtypes = {'': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def amp_dtype(args, device):
+    """autocast dtype of --amp on device, None in fp32"""
+    dtype = amp_dtypes[args.amp]
+    if dtype == torch.float16 and device.type != 'cuda':
+        raise ValueError('--amp=fp16 needs a cuda device, use --amp=bf16 on the cpu')
+    return dtype
+
+
+def autocast(device, dtype):
+    """torch.autocast to dtype on the device type of device, disabled when dtype is None"""
+    return torch.autocast(torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+def grad_scaler(device, dtype):
+    """Loss scaler of the training in dtype. Only fp16 needs one, the scaler passes through otherwise"""
+    enabled = dtype == torch.float16
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(torch.device(device).type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def memory_format(channels_last):
+    return torch.channels_last if channels_last else torch.contiguous_format
+
+
+def to_device(module, device, channels_last=False):
+    """Module moved to device, in the channels_last memory format if asked"""
+    return module.to(device, memory_format=memory_format(channels_last))
+
+
+class SingleDevice(nn.Module):
+    """Runs module on the device of its parameters, with the attributes of nn.DataParallel
+    the scripts use (module, device_ids), so the checkpoints keep their keys"""
+    def __init__(self, module):
+        super(SingleDevice, self).__init__()
+        self.module = module
+        self.device_ids = []
+
+    def forward(self, *inputs, **kwargs):
+        return self.module(*inputs, **kwargs)
+
+
+def data_parallel(module, device, device_ids=None):
+    """module split over the gpus by nn.DataParallel on a cuda device, kept whole on the cpu"""
+    if device.type == 'cuda':
+        return nn.DataParallel(module, device_ids=device_ids)
+    return SingleDevice(module)
+
+
+def inference_mode():
+    """torch.inference_mode where it exists (no version counters nor views tracking), no_grad otherwise"""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
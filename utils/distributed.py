@@ -0,0 +1,88 @@
+import os
+import builtins
+import contextlib
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+# data-parallel training over several processes (one per gpu, or several on cpus) launched by
+# torchrun, e.g. torchrun --nproc_per_node=4 train.py --dist_backend=gloo, which sets RANK,
+# LOCAL_RANK and WORLD_SIZE. every rank trains the same sub-network of the PruningNet at every
+# step: the scale ids are drawn from generators seeded identically on all of them, so the
+# gradients averaged by DistributedDataParallel belong to one encoding. only rank 0 prints and
+# writes the checkpoints.
+
+
+def add_distributed_arguments(parser):
+    parser.add_argument('--dist_backend', type=str, default='', choices=['', 'gloo', 'nccl'], help='backend of the torchrun launches (default: nccl on gpus, gloo on the cpu)')
+    parser.add_argument('--seed', type=int, default=-1, help='seed of the sampled scale ids, shared by all the ranks (-1: drawn by rank 0)')
+    return parser
+
+
+def init_distributed(args, device):
+    """Join the process group when launched by torchrun, and set args.rank, args.world_size,
+    args.distributed and the shared args.seed. Returns the device of this rank."""
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    if args.distributed:
+        if device.type == 'cuda':
+            device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+            torch.cuda.set_device(device)
+        dist.init_process_group(args.dist_backend or ('nccl' if device.type == 'cuda' else 'gloo'), init_method='env://')
+        if args.rank > 0:
+            # the other ranks only print what is printed with force=True
+            print_all = builtins.print
+            builtins.print = lambda *a, force=False, **kw: print_all(*a, **kw) if force else None
+    args.seed = shared_seed(args.seed, device)
+    return device
+
+
+def shared_seed(seed, device):
+    """seed, or one drawn by rank 0 when it is negative, the same on every rank"""
+    if seed < 0:
+        seed = np.random.randint(2**31)
+    if dist.is_initialized():
+        seed = torch.tensor([seed], dtype=torch.int64, device=device)
+        dist.broadcast(seed, 0)
+        seed = int(seed.item())
+    return seed
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def distributed_model(model, device, find_unused_parameters=False):
+    """DistributedDataParallel of model on device. Every sub-network slices the weights of the
+    same hypernetworks, so all their parameters get a gradient at every step; only affine
+    batchnorms kept per channel scale leave the parameters of the other scales unused, which
+    find_unused_parameters must then be set for. The gradients are views of the allreduce
+    buckets, the hypernetworks are too large to keep both."""
+    return DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                   find_unused_parameters=find_unused_parameters, gradient_as_bucket_view=True)
+
+
+def no_sync(model, accumulate):
+    """Context of a forward and backward pass whose gradients are accumulated locally, without
+    the allreduce of DistributedDataParallel, when accumulate is set"""
+    if accumulate and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def reduce_meters(meters, device):
+    """Sum the AverageMeters of meters over the ranks, their avg becomes the average over all the samples"""
+    if not dist.is_initialized():
+        return
+    totals = torch.tensor([[float(m.sum), float(m.count)] for m in meters], dtype=torch.float64, device=device)
+    dist.all_reduce(totals)
+    for m, (total, count) in zip(meters, totals.tolist()):
+        m.sum, m.count = total, count
+        m.avg = total / max(count, 1)
+
+
+def close_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,110 @@
+import os
+import time
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+# parallel candidate evaluation. one worker process is started per device, it builds its
+# own state once (e.g. a PruningNet replica) with init_worker(device) and then takes tasks
+# from a shared queue, so a fast worker simply takes more of them. tasks are either run as
+# a batch, or submitted one at a time to keep a fixed number of them in flight.
+# evaluate(state, task) is a generator, each of its results is sent back as soon as it is
+# produced. workers are forked by default: they inherit the datasets already loaded by the
+# parent, which must not have initialized cuda yet.
+
+
+def worker_devices(num_workers, device_type='cuda'):
+    """Devices of num_workers workers, spread over the gpus or all on the cpu"""
+    if device_type == 'cuda' and torch.cuda.is_available():
+        return ['cuda:{}'.format(i % torch.cuda.device_count()) for i in range(num_workers)]
+    return ['cpu'] * num_workers
+
+
+def worker_loop(worker_id, num_workers, device, init_worker, evaluate, tasks, results):
+    try:
+        if device == 'cpu' and hasattr(os, 'sched_setaffinity'):
+            # contiguous blocks of cores, one per worker (one per socket with a worker per socket)
+            cores = sorted(os.sched_getaffinity(0))
+            block = max(1, len(cores) // num_workers)
+            cores = cores[worker_id*block:(worker_id+1)*block] or cores
+            os.sched_setaffinity(0, cores)
+            torch.set_num_threads(len(cores))
+        elif device.startswith('cuda'):
+            torch.cuda.set_device(device)
+        state = init_worker(device)
+        results.put((worker_id, None, True, None, 0.))
+
+        for task_index, task in iter(tasks.get, None):
+            start = time.time()
+            for result in evaluate(state, task):
+                results.put((worker_id, task_index, False, result, time.time() - start))
+                start = time.time()
+            results.put((worker_id, task_index, True, None, time.time() - start))
+    except Exception:
+        results.put((worker_id, None, False, traceback.format_exc(), 0.))
+
+
+class EvalScheduler(object):
+    def __init__(self, devices, init_worker, evaluate, context='fork'):
+        ctx = mp.get_context(context)
+        self.devices = devices
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=worker_loop, daemon=True,
+                                    args=(i, len(devices), device, init_worker, evaluate, self.tasks, self.results))
+                        for i, device in enumerate(devices)]
+        for worker in self.workers:
+            worker.start()
+        # wait for the workers to be ready, their initialization does not count in their utilization
+        for _ in self.workers:
+            self.get()
+        self.busy = [0.] * len(devices)
+        self.num_tasks = 0
+        self.start_time = time.time()
+
+    def get(self):
+        worker_id, task_index, finished, result, busy = self.results.get()
+        if task_index is None and not finished:
+            self.close()
+            raise RuntimeError('evaluation worker {} failed:\n{}'.format(worker_id, result))
+        return worker_id, task_index, finished, result, busy
+
+    def submit(self, task):
+        """Queue a task, returns its index"""
+        task_index = self.num_tasks
+        self.num_tasks += 1
+        self.tasks.put((task_index, task))
+        return task_index
+
+    def next_result(self):
+        """Next (task index, result, finished) sent back by a worker, a task ends with finished = True"""
+        worker_id, task_index, finished, result, busy = self.get()
+        self.busy[worker_id] += busy
+        return task_index, result, finished
+
+    def run(self, tasks):
+        """Evaluate the tasks on the workers, yields (task index, result) in completion order"""
+        first = self.num_tasks
+        for task in tasks:
+            self.submit(task)
+        remaining = len(tasks)
+        while remaining > 0:
+            task_index, result, finished = self.next_result()
+            if finished:
+                remaining -= 1
+            else:
+                yield task_index - first, result
+
+    def utilization(self):
+        """Fraction of the time every worker spent evaluating since the workers were ready"""
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return [busy / elapsed for busy in self.busy]
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,533 @@
+# closed-form FLOPs of the pruned networks, driven only by the channel lists.
+# the counting rules follow print_model_parm_flops in cal_FLOPs.py: a conv costs
+# oup * k * k * (inp / groups) * H_out * W_out, a BatchNorm2d or nn.ReLU costs the
+# number of elements of its input, a pooling layer costs oup * k * k * H_out * W_out
+# and a Linear layer costs in * out + out. Functional activations (F.relu, F.relu6)
+# and adaptive pooling are not counted by the hooks and are not counted here either.
+# parameter counts follow the static evaluating models (affine BatchNorm2d).
+import os
+import argparse
+import numpy as np
+
+channel_scale = []
+for i in range(31):
+    channel_scale += [(10 + i * 3)/100]
+
+
+def conv_out_size(size, kernel_size, stride, padding):
+    return (size + 2 * padding - kernel_size) // stride + 1
+
+
+def conv_flops(inp, oup, kernel_size, stride, padding, size, groups=1):
+    """FLOPs and output size of a bias-free square conv"""
+    out_size = conv_out_size(size, kernel_size, stride, padding)
+    flops = oup * kernel_size * kernel_size * (inp // groups) * out_size * out_size
+    return flops, out_size
+
+
+def bn_flops(channels, size):
+    return channels * size * size
+
+
+def pool_flops(channels, kernel_size, stride, padding, size):
+    """FLOPs and output size of a MaxPool2d/AvgPool2d"""
+    out_size = conv_out_size(size, kernel_size, stride, padding)
+    return channels * kernel_size * kernel_size * out_size * out_size, out_size
+
+
+def linear_flops(inp, oup):
+    return inp * oup + oup
+
+
+def conv_params(inp, oup, kernel_size, groups=1):
+    return oup * kernel_size * kernel_size * (inp // groups)
+
+
+def bn_params(channels):
+    return 2 * channels
+
+
+def linear_params(inp, oup):
+    return inp * oup + oup
+
+
+#ResNet50
+resnet50_stage_repeat = [3, 4, 6, 3]
+resnet50_stage_out_channel = [64] + [256] * 3 + [512] * 4 + [1024] * 6 + [2048] * 3
+
+
+def resnet50_adapt_channel(ids):
+    stage_oup_scale_ids = []
+    stage_oup_scale_ids += [ids[0]]
+    for i in range(len(resnet50_stage_repeat)-1):
+        stage_oup_scale_ids += [ids[i+1]] * resnet50_stage_repeat[i]
+    stage_oup_scale_ids += [-1] * resnet50_stage_repeat[-1]
+
+    mid_scale_ids = ids[len(resnet50_stage_repeat):]
+
+    overall_channel = []
+    mid_channel = []
+    for i in range(len(resnet50_stage_out_channel)):
+        overall_channel += [int(resnet50_stage_out_channel[i] * channel_scale[stage_oup_scale_ids[i]])]
+        if i > 0:
+            mid_channel += [int(resnet50_stage_out_channel[i]//4 * channel_scale[mid_scale_ids[i-1]])]
+
+    return overall_channel, mid_channel
+
+
+def resnet50_first_conv_flops(oup, size):
+    # conv 7x7 -> bn -> relu -> maxpool
+    flops, size = conv_flops(3, oup, 7, 2, 3, size)
+    flops += 2 * bn_flops(oup, size)
+    pooling, size = pool_flops(oup, 3, 2, 1, size)
+    return flops + pooling, size
+
+
+def resnet50_bottleneck_flops(inp, mid, oup, stride, is_downsample, size):
+    flops, _ = conv_flops(inp, mid, 1, 1, 0, size)
+    flops += 2 * bn_flops(mid, size)
+    conv2, out_size = conv_flops(mid, mid, 3, stride, 1, size)
+    flops += conv2 + 2 * bn_flops(mid, out_size)
+    conv3, _ = conv_flops(mid, oup, 1, 1, 0, out_size)
+    flops += conv3 + bn_flops(oup, out_size)
+    if is_downsample:
+        downsample, _ = conv_flops(inp, oup, 1, stride, 0, size)
+        flops += downsample + bn_flops(oup, out_size)
+    # the final relu after the residual addition
+    flops += bn_flops(oup, out_size)
+    return flops, out_size
+
+
+def resnet50_first_conv_params(oup):
+    return conv_params(3, oup, 7) + bn_params(oup)
+
+
+def resnet50_bottleneck_params(inp, mid, oup, is_downsample):
+    params = conv_params(inp, mid, 1) + conv_params(mid, mid, 3) + conv_params(mid, oup, 1)
+    params += 2 * bn_params(mid) + bn_params(oup)
+    if is_downsample:
+        params += conv_params(inp, oup, 1) + bn_params(oup)
+    return params
+
+
+def resnet50_flops(network_encoding_vector, input_size=224, num_classes=1000):
+    """MFLOPs of the pruned ResNet50 identified by its network encoding vector"""
+    overall_channel, mid_channel = resnet50_adapt_channel(network_encoding_vector)
+
+    flops, size = resnet50_first_conv_flops(overall_channel[0], input_size)
+    layer_num = 1
+    for i in range(len(resnet50_stage_repeat)):
+        for j in range(resnet50_stage_repeat[i]):
+            stride = 2 if (j == 0 and i > 0) else 1
+            block_flops, size = resnet50_bottleneck_flops(overall_channel[layer_num-1], mid_channel[layer_num-1],
+                                                          overall_channel[layer_num], stride, j == 0, size)
+            flops += block_flops
+            layer_num += 1
+
+    flops += linear_flops(overall_channel[-1], num_classes)
+    return flops / 1e6
+
+
+#MobileNetV1
+mobilenet_v1_stage_out_channel = [32] + [64] + [128] * 2 + [256] * 2 + [512] * 6 + [1024] * 2
+
+
+def mobilenet_v1_adapt_channel(ids):
+    # same layout as the PruningNet: ids[i] scales the output of layer i and the last layer is unpruned
+    channel = []
+    for i in range(len(mobilenet_v1_stage_out_channel)):
+        if i == len(mobilenet_v1_stage_out_channel) - 1:
+            channel += [mobilenet_v1_stage_out_channel[i]]
+        else:
+            channel += [int(mobilenet_v1_stage_out_channel[i] * channel_scale[ids[i]])]
+    return channel
+
+
+def mobilenet_v1_stride(i):
+    if i == 0:
+        return 2
+    if mobilenet_v1_stage_out_channel[i-1] != mobilenet_v1_stage_out_channel[i] and mobilenet_v1_stage_out_channel[i] != 64:
+        return 2
+    return 1
+
+
+def mobilenet_v1_first_conv_flops(oup, size):
+    flops, size = conv_flops(3, oup, 3, 2, 1, size)
+    return flops + bn_flops(oup, size), size
+
+
+def mobilenet_v1_dw3x3_pw1x1_flops(inp, oup, stride, size):
+    flops, size = conv_flops(inp, inp, 3, stride, 1, size, groups=inp)
+    flops += bn_flops(inp, size)
+    pw, _ = conv_flops(inp, oup, 1, 1, 0, size)
+    flops += pw + bn_flops(oup, size)
+    return flops, size
+
+
+def mobilenet_v1_first_conv_params(oup):
+    return conv_params(3, oup, 3) + bn_params(oup)
+
+
+def mobilenet_v1_dw3x3_pw1x1_params(inp, oup):
+    return conv_params(inp, inp, 3, groups=inp) + bn_params(inp) + conv_params(inp, oup, 1) + bn_params(oup)
+
+
+def mobilenet_v1_flops(network_encoding_vector, input_size=224, num_classes=1000):
+    """MFLOPs of the pruned MobileNetV1 identified by its network encoding vector"""
+    channel = mobilenet_v1_adapt_channel(network_encoding_vector)
+
+    flops, size = mobilenet_v1_first_conv_flops(channel[0], input_size)
+    for i in range(1, len(channel)):
+        block_flops, size = mobilenet_v1_dw3x3_pw1x1_flops(channel[i-1], channel[i], mobilenet_v1_stride(i), size)
+        flops += block_flops
+
+    pooling, size = pool_flops(channel[-1], 7, 7, 0, size)
+    flops += pooling + linear_flops(channel[-1], num_classes)
+    return flops / 1e6
+
+
+#MobileNetV2
+mobilenet_v2_stage_repeat = [1, 1, 2, 3, 4, 3, 3, 1]
+mobilenet_v2_stage_out_channel = [44] + [22] + [33] * 2 + [44] * 3 + [88] * 4 + [132] * 3 + [224] * 3 + [448]
+mobilenet_v2_last_channel = 1280
+
+
+def mobilenet_v2_adapt_channel(overall_channel_ids, mid_channel_ids):
+    overall_channel = []
+    mid_channel = []
+    for i in range(len(mobilenet_v2_stage_out_channel)):
+        overall_channel += [int(mobilenet_v2_stage_out_channel[i] * channel_scale[overall_channel_ids[i]])]
+
+    for i in range(len(mobilenet_v2_stage_out_channel)-1):
+        if i == 0:
+            mid_channel += [int(mobilenet_v2_stage_out_channel[i] * channel_scale[mid_channel_ids[i]])]
+        else:
+            mid_channel += [int(6 * mobilenet_v2_stage_out_channel[i] * channel_scale[mid_channel_ids[i]])]
+    return overall_channel, mid_channel
+
+
+def mobilenet_v2_stride(i):
+    if i == 0:
+        return 2
+    if i == 1:
+        return 1
+    if mobilenet_v2_stage_out_channel[i-1] != mobilenet_v2_stage_out_channel[i] and mobilenet_v2_stage_out_channel[i] != 132 and mobilenet_v2_stage_out_channel[i] != 448:
+        return 2
+    return 1
+
+
+def mobilenet_v2_first_conv_flops(oup, size):
+    flops, size = conv_flops(3, oup, 3, 2, 1, size)
+    return flops + bn_flops(oup, size), size
+
+
+def mobilenet_v2_bottleneck_flops(inp, mid, oup, stride, size):
+    flops, _ = conv_flops(inp, mid, 1, 1, 0, size)
+    flops += bn_flops(mid, size)
+    dw, size = conv_flops(mid, mid, 3, stride, 1, size, groups=mid)
+    flops += dw + bn_flops(mid, size)
+    conv3, _ = conv_flops(mid, oup, 1, 1, 0, size)
+    flops += conv3 + bn_flops(oup, size)
+    return flops, size
+
+
+def mobilenet_v2_first_conv_params(oup):
+    return conv_params(3, oup, 3) + bn_params(oup)
+
+
+def mobilenet_v2_bottleneck_params(inp, mid, oup):
+    params = conv_params(inp, mid, 1) + conv_params(mid, mid, 3, groups=mid) + conv_params(mid, oup, 1)
+    return params + 2 * bn_params(mid) + bn_params(oup)
+
+
+def mobilenet_v2_last_conv_flops(inp, size, num_classes=1000):
+    # conv 1x1 -> bn -> avgpool -> fc
+    flops, size = conv_flops(inp, mobilenet_v2_last_channel, 1, 1, 0, size)
+    flops += bn_flops(mobilenet_v2_last_channel, size)
+    pooling, size = pool_flops(mobilenet_v2_last_channel, 7, 7, 0, size)
+    return flops + pooling + linear_flops(mobilenet_v2_last_channel, num_classes)
+
+
+def mobilenet_v2_last_conv_params(inp, num_classes=1000):
+    params = conv_params(inp, mobilenet_v2_last_channel, 1) + bn_params(mobilenet_v2_last_channel)
+    return params + linear_params(mobilenet_v2_last_channel, num_classes)
+
+
+def mobilenet_v2_flops(network_encoding_vector, input_size=224, num_classes=1000):
+    """MFLOPs of the pruned MobileNetV2 identified by its network encoding vector
+    (the overall channel ids followed by the mid channel ids)"""
+    num_overall = sum(mobilenet_v2_stage_repeat)
+    overall_channel, mid_channel = mobilenet_v2_adapt_channel(network_encoding_vector[:num_overall],
+                                                              network_encoding_vector[num_overall:])
+
+    flops, size = mobilenet_v2_first_conv_flops(overall_channel[0], input_size)
+    for i in range(1, len(overall_channel)):
+        block_flops, size = mobilenet_v2_bottleneck_flops(overall_channel[i-1], mid_channel[i-1], overall_channel[i],
+                                                          mobilenet_v2_stride(i), size)
+        flops += block_flops
+
+    flops += mobilenet_v2_last_conv_flops(overall_channel[-1], size, num_classes)
+    return flops / 1e6
+
+
+# batched evaluation over a whole population of network encoding vectors.
+# the cost of every layer only depends on the scale ids of its input, mid and
+# output channels, so it is tabulated once over all scale ids and a population
+# of encodings is evaluated by fancy indexing into the tables.
+#
+# an architecture is described by its layers, each given as
+# (flops_cost, params_cost, specs) where specs holds one (gene column, base channel)
+# per channel argument of the cost functions, the column being None for an
+# unpruned argument.
+
+def scaled_channels(base):
+    return (base * np.asarray(channel_scale)).astype(int)
+
+
+def layer_columns(specs):
+    return tuple(column for column, _ in specs if column is not None)
+
+
+def layer_table(cost, specs):
+    """Tabulate cost over all scale ids of its pruned channel arguments"""
+    num_axes = len(layer_columns(specs))
+    table_shape = [len(channel_scale)] * num_axes
+    args = []
+    axis = 0
+    for column, base in specs:
+        if column is None:
+            args += [base]
+        else:
+            shape = [1] * num_axes
+            shape[axis] = len(channel_scale)
+            args += [np.broadcast_to(scaled_channels(base).reshape(shape), table_shape)]
+            axis += 1
+    table = np.broadcast_to(np.asarray(cost(*args), dtype=np.int64), table_shape)
+    return np.array(table)
+
+
+def resnet50_layers(input_size=224, num_classes=1000):
+    # gene column holding the output scale id of every layer, the last stage is unpruned
+    oup_columns = [0]
+    for i in range(len(resnet50_stage_repeat)-1):
+        oup_columns += [i+1] * resnet50_stage_repeat[i]
+    oup_columns += [None] * resnet50_stage_repeat[-1]
+
+    size = input_size
+    layers = [(lambda oup, size=size: resnet50_first_conv_flops(oup, size)[0],
+               resnet50_first_conv_params,
+               [(oup_columns[0], resnet50_stage_out_channel[0])])]
+    _, size = resnet50_first_conv_flops(1, size)
+
+    layer_num = 1
+    for i in range(len(resnet50_stage_repeat)):
+        for j in range(resnet50_stage_repeat[i]):
+            stride = 2 if (j == 0 and i > 0) else 1
+            is_downsample = j == 0
+            specs = [(oup_columns[layer_num-1], resnet50_stage_out_channel[layer_num-1]),
+                     (len(resnet50_stage_repeat) + layer_num - 1, resnet50_stage_out_channel[layer_num]//4),
+                     (oup_columns[layer_num], resnet50_stage_out_channel[layer_num])]
+            layers += [(lambda inp, mid, oup, stride=stride, is_downsample=is_downsample, size=size:
+                            resnet50_bottleneck_flops(inp, mid, oup, stride, is_downsample, size)[0],
+                        lambda inp, mid, oup, is_downsample=is_downsample:
+                            resnet50_bottleneck_params(inp, mid, oup, is_downsample),
+                        specs)]
+            _, size = resnet50_bottleneck_flops(1, 1, 1, stride, is_downsample, size)
+            layer_num += 1
+
+    layers += [(lambda inp: linear_flops(inp, num_classes), lambda inp: linear_params(inp, num_classes),
+                [(oup_columns[-1], resnet50_stage_out_channel[-1])])]
+    return layers
+
+
+def mobilenet_v1_layers(input_size=224, num_classes=1000):
+    num_layers = len(mobilenet_v1_stage_out_channel)
+    oup_columns = list(range(num_layers - 1)) + [None]
+
+    size = input_size
+    layers = [(lambda oup, size=size: mobilenet_v1_first_conv_flops(oup, size)[0],
+               mobilenet_v1_first_conv_params,
+               [(oup_columns[0], mobilenet_v1_stage_out_channel[0])])]
+    _, size = mobilenet_v1_first_conv_flops(1, size)
+
+    for i in range(1, num_layers):
+        stride = mobilenet_v1_stride(i)
+        specs = [(oup_columns[i-1], mobilenet_v1_stage_out_channel[i-1]),
+                 (oup_columns[i], mobilenet_v1_stage_out_channel[i])]
+        layers += [(lambda inp, oup, stride=stride, size=size: mobilenet_v1_dw3x3_pw1x1_flops(inp, oup, stride, size)[0],
+                    mobilenet_v1_dw3x3_pw1x1_params, specs)]
+        _, size = mobilenet_v1_dw3x3_pw1x1_flops(1, 1, stride, size)
+
+    last_channel = mobilenet_v1_stage_out_channel[-1]
+    pooling, _ = pool_flops(last_channel, 7, 7, 0, size)
+    layers += [(lambda: pooling + linear_flops(last_channel, num_classes),
+                lambda: linear_params(last_channel, num_classes), [])]
+    return layers
+
+
+def mobilenet_v2_layers(input_size=224, num_classes=1000):
+    num_overall = sum(mobilenet_v2_stage_repeat)
+
+    size = input_size
+    layers = [(lambda oup, size=size: mobilenet_v2_first_conv_flops(oup, size)[0],
+               mobilenet_v2_first_conv_params,
+               [(0, mobilenet_v2_stage_out_channel[0])])]
+    _, size = mobilenet_v2_first_conv_flops(1, size)
+
+    for i in range(1, num_overall):
+        stride = mobilenet_v2_stride(i)
+        expand_ratio = 1 if i == 1 else 6
+        specs = [(i-1, mobilenet_v2_stage_out_channel[i-1]),
+                 (num_overall + i - 1, expand_ratio * mobilenet_v2_stage_out_channel[i-1]),
+                 (i, mobilenet_v2_stage_out_channel[i])]
+        layers += [(lambda inp, mid, oup, stride=stride, size=size: mobilenet_v2_bottleneck_flops(inp, mid, oup, stride, size)[0],
+                    mobilenet_v2_bottleneck_params, specs)]
+        _, size = mobilenet_v2_bottleneck_flops(1, 1, 1, stride, size)
+
+    layers += [(lambda inp, size=size: mobilenet_v2_last_conv_flops(inp, size, num_classes),
+                lambda inp: mobilenet_v2_last_conv_params(inp, num_classes),
+                [(num_overall - 1, mobilenet_v2_stage_out_channel[-1])])]
+    return layers
+
+
+arch_layers = {
+    'resnet50': resnet50_layers,
+    'mobilenet_v1': mobilenet_v1_layers,
+    'mobilenet_v2': mobilenet_v2_layers,
+}
+
+
+def build_cost_tables(layers):
+    tables = []
+    for flops_cost, params_cost, specs in layers:
+        tables += [(layer_columns(specs), layer_table(flops_cost, specs), layer_table(params_cost, specs))]
+    return tables
+
+
+# on disk, all flops tables of an architecture are flattened into the first row of
+# one int64 .npy file and all params tables into the second row. the layer layout
+# gives the offset of every table, so a memory-mapped file is sliced into per-layer
+# views without being read. a .npz sidecar records what the tables were built for:
+# the input size, the channel scales, the (gene column, base channels) arguments of
+# every layer and cost_table_version, to be bumped when a cost formula changes. tables
+# whose sidecar is missing or differs are rebuilt.
+cost_table_version = 1
+
+
+def cost_table_filename(table_dir, arch, input_size):
+    return os.path.join(table_dir, '{}_{}.npy'.format(arch, input_size))
+
+
+def cost_table_meta_filename(filename):
+    return os.path.splitext(filename)[0] + '_meta.npz'
+
+
+def cost_table_meta(layers, input_size):
+    """Arrays identifying the tables of layers at input_size"""
+    layout = [(k, -1 if column is None else column, base)
+              for k, (_, _, specs) in enumerate(layers) for column, base in specs]
+    return {'version': np.asarray(cost_table_version), 'input_size': np.asarray(input_size),
+            'channel_scale': np.asarray(channel_scale), 'layout': np.asarray(layout, dtype=np.int64).reshape(-1, 3)}
+
+
+def save_cost_tables(tables, filename, meta):
+    data = np.stack([np.concatenate([flops_table.ravel() for _, flops_table, _ in tables]),
+                     np.concatenate([params_table.ravel() for _, _, params_table in tables])])
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    np.save(filename, data)
+    # the sidecar is written last, tables interrupted while being saved have none
+    np.savez(cost_table_meta_filename(filename), **meta)
+
+
+def cost_table_meta_matches(filename, meta):
+    meta_filename = cost_table_meta_filename(filename)
+    if not os.path.exists(meta_filename):
+        return False
+    with np.load(meta_filename) as saved:
+        return set(saved.files) == set(meta) and all(
+            saved[name].shape == value.shape and np.array_equal(saved[name], value) for name, value in meta.items())
+
+
+def load_cost_tables_file(layers, filename, meta):
+    """Map the saved tables of layers from filename, None if the file was not built for meta"""
+    if not cost_table_meta_matches(filename, meta):
+        return None
+    data = np.load(filename, mmap_mode='r')
+    table_sizes = [len(channel_scale) ** len(layer_columns(specs)) for _, _, specs in layers]
+    if data.shape != (2, sum(table_sizes)):
+        return None
+    tables = []
+    offset = 0
+    for (_, _, specs), table_size in zip(layers, table_sizes):
+        columns = layer_columns(specs)
+        table_shape = [len(channel_scale)] * len(columns)
+        tables += [(columns, data[0, offset:offset+table_size].reshape(table_shape),
+                    data[1, offset:offset+table_size].reshape(table_shape))]
+        offset += table_size
+    return tables
+
+
+# cost tables are built (or mapped from disk) on first use and shared by all later calls
+cost_tables = {}
+
+
+def get_cost_tables(arch, input_size=224, table_dir=None):
+    """Cost tables of arch at input_size. With table_dir, the tables are memory-mapped
+    from table_dir and written there first if they are missing or stale."""
+    key = (arch, input_size)
+    if key not in cost_tables:
+        layers = arch_layers[arch](input_size)
+        tables = None
+        if table_dir is not None:
+            filename = cost_table_filename(table_dir, arch, input_size)
+            meta = cost_table_meta(layers, input_size)
+            if os.path.exists(filename):
+                tables = load_cost_tables_file(layers, filename, meta)
+            if tables is None:
+                save_cost_tables(build_cost_tables(layers), filename, meta)
+                tables = load_cost_tables_file(layers, filename, meta)
+        if tables is None:
+            tables = build_cost_tables(layers)
+        cost_tables[key] = tables
+    return cost_tables[key]
+
+
+def batch_flops(arch, ids, input_size=224):
+    """MFLOPs and million parameters of every row of an (N, num_states) array of scale ids"""
+    ids = np.asarray(ids).astype(int)
+    flops = np.zeros(ids.shape[0], dtype=np.int64)
+    params = np.zeros(ids.shape[0], dtype=np.int64)
+    for columns, flops_table, params_table in get_cost_tables(arch, input_size):
+        index = tuple(ids[:, column] for column in columns)
+        flops += flops_table[index]
+        params += params_table[index]
+    return flops / 1e6, params / 1e6
+
+
+def resnet50_batch_flops(ids, input_size=224):
+    return batch_flops('resnet50', ids, input_size)
+
+
+def mobilenet_v1_batch_flops(ids, input_size=224):
+    return batch_flops('mobilenet_v1', ids, input_size)
+
+
+def mobilenet_v2_batch_flops(ids, input_size=224):
+    return batch_flops('mobilenet_v2', ids, input_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("FLOPs tables")
+    parser.add_argument('--arch', type=str, nargs='+', default=sorted(arch_layers.keys()), help='architectures to tabulate')
+    parser.add_argument('--input_size', type=int, nargs='+', default=[224], help='input resolutions to tabulate')
+    parser.add_argument('--table_dir', type=str, default='./flops_tables', help='where the tables are saved')
+    args = parser.parse_args()
+
+    for arch in args.arch:
+        for input_size in args.input_size:
+            filename = cost_table_filename(args.table_dir, arch, input_size)
+            layers = arch_layers[arch](input_size)
+            save_cost_tables(build_cost_tables(layers), filename, cost_table_meta(layers, input_size))
+            print('Saved {} ({:.2f} MB)'.format(filename, os.path.getsize(filename) / 2**20))
@@ -0,0 +1,240 @@
+import numpy as np
+
+from utils.flops import channel_scale, get_cost_tables, batch_flops
+
+# sampling of network encoding vectors inside a FLOPs window [min_FLOPs, max_FLOPs].
+#
+# every layer cost depends on a few genes (see utils/flops.py). the genes shared by
+# several layers (stage output scales) form a chain where each layer touches one gene
+# or two consecutive genes of the chain, and the remaining genes (mid scales) only
+# feed a single layer. a forward pass over the layers counts, for every value of the
+# current chain gene and every discretized FLOPs bin, the prior mass of the partial
+# encodings reaching it. encodings are then drawn backwards layer by layer so that
+# their total lands in the window. the discretization can put a few encodings right
+# at the edges of the window out of it, so every draw is checked with the exact FLOPs.
+
+
+def sample_rows(weights):
+    """Draw one column index per row of weights, with probability proportional to the row"""
+    cumsum = weights.cumsum(1)
+    u = np.random.rand(len(weights)) * cumsum[:, -1]
+    return np.minimum((cumsum <= u[:, None]).sum(1), weights.shape[1] - 1)
+
+
+def shifted_gather(alpha, rows, shifts):
+    """out[..., x] = alpha[rows, x - shifts], zero where x - shifts < 0"""
+    index = np.arange(alpha.shape[1]) - shifts[..., None]
+    return alpha[rows[..., None], np.maximum(index, 0)] * (index >= 0)
+
+
+class FLOPsSampler(object):
+    def __init__(self, arch, min_FLOPs, max_FLOPs, prior=None, tied_columns=None,
+                 num_bins=2048, input_size=224):
+        """prior weights the scale ids of every gene (uniform by default), tied_columns
+        lists groups of gene columns that always share the same scale id."""
+        self.arch = arch
+        self.min_FLOPs = min_FLOPs
+        self.max_FLOPs = max_FLOPs
+        self.input_size = input_size
+        self.tables = get_cost_tables(arch, input_size)
+
+        if prior is None:
+            prior = np.ones(len(channel_scale))
+        self.prior = np.asarray(prior, dtype=np.float64) / np.sum(prior)
+
+        self.num_genes = max(max(columns) for columns, _, _ in self.tables if columns) + 1
+        # a variable is a group of tied columns, untied columns are variables on their own
+        self.var_columns = []
+        column_var = {}
+        for columns in (tied_columns or []):
+            for column in columns:
+                column_var[column] = len(self.var_columns)
+            self.var_columns += [list(columns)]
+        for column in range(self.num_genes):
+            if column not in column_var:
+                column_var[column] = len(self.var_columns)
+                self.var_columns += [[column]]
+        self.column_var = column_var
+
+        self.resolution = max_FLOPs * 1e6 / num_bins
+        self.build()
+
+    def layer_cost(self, columns, flops_table, layer_vars):
+        # cost of the layer over all values of its distinct variables, one axis per variable
+        grids = np.meshgrid(*[np.arange(len(channel_scale))] * len(layer_vars), indexing='ij')
+        index = tuple(grids[layer_vars.index(self.column_var[column])] for column in columns)
+        return flops_table[index]
+
+    def build(self):
+        var_layers = {}
+        for columns, _, _ in self.tables:
+            for var in set(self.column_var[column] for column in columns):
+                var_layers[var] = var_layers.get(var, 0) + 1
+        chain_vars = set(var for var, count in var_layers.items() if count > 1)
+
+        num_bins = int(np.floor(self.max_FLOPs * 1e6 / self.resolution)) + 1
+        self.constant = 0
+        self.steps = []
+        self.seen = []
+        alpha = None
+        frontier = None
+        for columns, flops_table, _ in self.tables:
+            layer_vars = []
+            for column in columns:
+                if self.column_var[column] not in layer_vars:
+                    layer_vars += [self.column_var[column]]
+            chain = [var for var in layer_vars if var in chain_vars]
+            free = [var for var in layer_vars if var not in chain_vars]
+            if len(free) > 1 or len(chain) > 2 or (free and not chain and frontier is None):
+                raise ValueError('layer on genes {} does not fit the chain structure'.format(columns))
+
+            cost = self.layer_cost(columns, flops_table, layer_vars)
+            if not layer_vars:
+                self.constant += int(cost)
+                continue
+            if not chain:
+                # a layer on a single gene of its own, added on top of the current chain gene
+                chain = [frontier]
+                cost = np.broadcast_to(cost[None, :], (len(channel_scale), len(cost)))
+                layer_vars = [frontier] + layer_vars
+
+            # bring the cost to (chain..., free) axis order and discretize it
+            order = [layer_vars.index(var) for var in chain + free]
+            shifts = np.rint(np.transpose(cost, order) / self.resolution).astype(int)
+            if not free:
+                shifts = shifts[..., None]
+            free_prior = self.prior if free else np.ones(1)
+            free_var = free[0] if free else None
+
+            if frontier is None:
+                frontier = chain[0]
+                self.seen += [frontier]
+                alpha = np.zeros((len(channel_scale), num_bins))
+                alpha[:, 0] = self.prior
+
+            if len(chain) == 2 and chain[1] == frontier and chain[0] not in self.seen:
+                chain = chain[::-1]
+                shifts = np.transpose(shifts, (1, 0, 2))
+            if (len(chain) == 2 and (chain[0] != frontier or chain[1] in self.seen)) or \
+                    (len(chain) == 1 and chain[0] != frontier and chain[0] in self.seen):
+                raise ValueError('layer on genes {} does not fit the chain structure'.format(columns))
+
+            if len(chain) == 1 and chain[0] != frontier:
+                # a new chain gene independent of the previous one
+                self.steps += [('new', alpha, chain[0])]
+                alpha = self.prior[:, None] * alpha.sum(0)[None, :]
+                frontier = chain[0]
+                self.seen += [frontier]
+
+            rows = np.arange(len(channel_scale))
+            if len(chain) == 1:
+                self.steps += [('unary', alpha, shifts, free_var)]
+                gathered = shifted_gather(alpha, rows[:, None], shifts)
+                alpha = (gathered * free_prior[None, :, None]).sum(1)
+            else:
+                self.steps += [('pair', alpha, shifts, free_var, chain[1])]
+                new_alpha = np.zeros_like(alpha)
+                for b in range(len(channel_scale)):
+                    gathered = shifted_gather(alpha, rows[:, None], shifts[:, b, :])
+                    new_alpha[b] = self.prior[b] * (gathered * free_prior[None, :, None]).sum((0, 1))
+                alpha = new_alpha
+                frontier = chain[1]
+                self.seen += [frontier]
+
+        self.alpha = alpha
+        self.frontier = frontier
+        self.low_bin = max(int(np.ceil((self.min_FLOPs * 1e6 - self.constant) / self.resolution)), 0)
+        self.high_bin = min(int(np.floor((self.max_FLOPs * 1e6 - self.constant) / self.resolution)), num_bins - 1)
+        if self.low_bin > self.high_bin or self.alpha[:, self.low_bin:self.high_bin+1].sum() <= 0:
+            raise ValueError('no encoding has FLOPs in [{}, {}]'.format(self.min_FLOPs, self.max_FLOPs))
+
+    def draw(self, num):
+        """Draw num encodings from the discretized distribution, without the exact FLOPs check"""
+        var_values = np.zeros((num, len(self.var_columns)), dtype=int)
+        # genes that no layer depends on
+        for var in range(len(self.var_columns)):
+            var_values[:, var] = np.random.choice(len(channel_scale), num, p=self.prior)
+
+        window = self.alpha[:, self.low_bin:self.high_bin+1]
+        index = np.random.choice(window.size, num, p=window.ravel() / window.sum())
+        v = index // window.shape[1]
+        r = index % window.shape[1] + self.low_bin
+        samples = np.arange(num)
+        for step in reversed(self.steps):
+            if step[0] == 'new':
+                _, alpha, var = step
+                var_values[:, var] = v
+                v = sample_rows(alpha[:, r].T)
+            elif step[0] == 'unary':
+                _, alpha, shifts, free_var = step
+                row_shifts = shifts[v]
+                index = r[:, None] - row_shifts
+                free_prior = self.prior if free_var is not None else np.ones(1)
+                weights = alpha[v[:, None], np.maximum(index, 0)] * (index >= 0) * free_prior[None, :]
+                m = sample_rows(weights)
+                if free_var is not None:
+                    var_values[:, free_var] = m
+                r = r - row_shifts[samples, m]
+            else:
+                _, alpha, shifts, free_var, var = step
+                var_values[:, var] = v
+                pair_shifts = np.transpose(shifts[:, v, :], (1, 0, 2))
+                index = r[:, None, None] - pair_shifts
+                free_prior = self.prior if free_var is not None else np.ones(1)
+                weights = alpha[np.arange(len(channel_scale))[None, :, None], np.maximum(index, 0)] * (index >= 0)
+                weights = (weights * free_prior[None, None, :]).reshape(num, -1)
+                am = sample_rows(weights)
+                a, m = am // shifts.shape[2], am % shifts.shape[2]
+                if free_var is not None:
+                    var_values[:, free_var] = m
+                r = r - pair_shifts[samples, a, m]
+                v = a
+        var_values[:, self.seen[0]] = v
+
+        ids = np.zeros((num, self.num_genes), dtype=int)
+        for var, columns in enumerate(self.var_columns):
+            ids[:, columns] = var_values[:, var][:, None]
+        return ids
+
+    def in_band(self, flops):
+        return (flops >= self.min_FLOPs) & (flops <= self.max_FLOPs)
+
+    def sample(self, num, max_tries=10):
+        """Draw num encodings whose exact FLOPs lie in [min_FLOPs, max_FLOPs].
+        Returns the (num, num_genes) scale ids and their MFLOPs."""
+        ids = np.zeros((0, self.num_genes), dtype=int)
+        flops = np.zeros(0)
+        for i in range(max_tries):
+            new_ids = self.draw(num - len(ids))
+            new_flops, _ = batch_flops(self.arch, new_ids, self.input_size)
+            is_valid = self.in_band(new_flops)
+            ids = np.concatenate([ids, new_ids[is_valid]])
+            flops = np.concatenate([flops, new_flops[is_valid]])
+            if len(ids) == num:
+                break
+        return ids, flops
+
+    def repair(self, ids, max_edits=2):
+        """Move the encoding ids into [min_FLOPs, max_FLOPs] by changing as few genes
+        (tied groups count as one) by as little as possible. Returns the repaired
+        scale ids, or None if more than max_edits changes would be needed."""
+        ids = np.asarray(ids).astype(int).copy()
+        num_scales = len(channel_scale)
+        for edit in range(max_edits + 1):
+            flops, _ = batch_flops(self.arch, ids[None, :], self.input_size)
+            if self.in_band(flops)[0]:
+                return ids
+            if edit == max_edits:
+                break
+            # every encoding one variable away from ids
+            neighbours = np.repeat(ids[None, :], len(self.var_columns) * num_scales, axis=0)
+            change = np.zeros(len(neighbours), dtype=int)
+            for var, columns in enumerate(self.var_columns):
+                neighbours[var*num_scales:(var+1)*num_scales, columns] = np.arange(num_scales)[:, None]
+                change[var*num_scales:(var+1)*num_scales] = np.abs(np.arange(num_scales) - ids[columns[0]])
+            flops, _ = batch_flops(self.arch, neighbours, self.input_size)
+            distance = np.maximum(np.maximum(self.min_FLOPs - flops, flops - self.max_FLOPs), 0)
+            distance[change == 0] = np.inf
+            best = np.lexsort((change, distance))[0]
+            ids = neighbours[best]
+        return None
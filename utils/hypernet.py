@@ -0,0 +1,15 @@
+import torch.nn.functional as F
+
+# weight generation of the PruningNet layers. a layer generates its max-size conv
+# weight as fc2(relu(fc1(scale))) viewed as (max_oup, max_inp, kh, kw) and only keeps
+# [:oup, :inp]. the rows of fc2 are laid out in the same order as the weight elements,
+# so only the rows of the kept elements are evaluated.
+
+
+def generate_weight(fc1, fc2, scale_tensor, shape, oup, inp):
+    """fc2(relu(fc1(scale_tensor))).view(shape)[:oup, :inp], computing only the kept rows of fc2"""
+    max_oup, max_inp, kh, kw = shape
+    hidden = F.relu(fc1(scale_tensor))
+    weight = fc2.weight.view(max_oup, max_inp, kh * kw, -1)[:oup, :inp]
+    bias = fc2.bias.view(max_oup, max_inp, kh * kw)[:oup, :inp]
+    return F.linear(hidden, weight.reshape(-1, weight.size(-1)), bias.reshape(-1)).view(oup, inp, kh, kw)
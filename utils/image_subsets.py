@@ -0,0 +1,111 @@
+import os
+import argparse
+import numpy as np
+import torch
+import torch.utils.data
+from torchvision import datasets, transforms
+
+# fixed image subsets decoded once into memory-mapped uint8 NCHW files, so that the
+# candidate evaluation of the search does not go through JPEG decoding any more.
+# <name>_<num_images>_<input_size>_seed<seed>_images.npy holds the center-cropped images and
+# <name>_<num_images>_<input_size>_seed<seed>_labels.npy their labels. the images of a subset
+# are drawn with a fixed seed, all of them are kept if num_images covers the dataset. they are
+# stored in the order of the draw, not in class order, so that every contiguous batch (and
+# the first batches kept by a capped cache) covers all the classes.
+
+imagenet_mean = [0.485, 0.456, 0.406]
+imagenet_std = [0.229, 0.224, 0.225]
+
+
+def subset_filenames(subset_dir, name, num_images, input_size=224, seed=0):
+    prefix = os.path.join(subset_dir, '{}_{}_{}_seed{}'.format(name, num_images, input_size, seed))
+    return prefix + '_images.npy', prefix + '_labels.npy'
+
+
+def write_subset(image_dir, subset_dir, name, num_images, input_size=224, seed=0, workers=8):
+    """Decode num_images images of the ImageFolder image_dir into the uint8 files of the subset"""
+    dataset = datasets.ImageFolder(image_dir, transforms.Compose([
+        transforms.Resize(int(input_size / 0.875)),
+        transforms.CenterCrop(input_size),
+        transforms.PILToTensor(),
+    ]))
+    indices = np.random.RandomState(seed).permutation(len(dataset))[:num_images]
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices.tolist()), batch_size=256, shuffle=False,
+        num_workers=workers)
+
+    os.makedirs(subset_dir, exist_ok=True)
+    images_file, labels_file = subset_filenames(subset_dir, name, num_images, input_size, seed)
+    images = np.lib.format.open_memmap(images_file + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(indices), 3, input_size, input_size))
+    labels = np.zeros(len(indices), dtype=np.int64)
+    start = 0
+    for batch_images, batch_labels in loader:
+        images[start:start+len(batch_images)] = batch_images.numpy()
+        labels[start:start+len(batch_images)] = batch_labels.numpy()
+        start += len(batch_images)
+    images.flush()
+    del images
+    np.save(labels_file, labels)
+    # the images file only shows up once it is complete
+    os.replace(images_file + '.tmp', images_file)
+
+
+class ImageSubset(torch.utils.data.Dataset):
+    """uint8 NCHW images of a subset and their labels, memory-mapped from the files written by
+    write_subset (see get_subset) or held in memory"""
+    def __init__(self, images, labels):
+        self.images = images
+        self.labels = torch.as_tensor(labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.images[index]), self.labels[index]
+
+    def batches(self, batch_size, indices=None):
+        """Iterate over the subset in order, every batch is a view of the mapped file.
+        With indices, iterate over these images only (the batches are then copies)."""
+        if indices is None:
+            for start in range(0, len(self), batch_size):
+                yield self[start:start+batch_size]
+        else:
+            for start in range(0, len(indices), batch_size):
+                yield self[indices[start:start+batch_size]]
+
+
+def get_subset(image_dir, subset_dir, name, num_images, input_size=224, seed=0, workers=8):
+    """Load the subset, it is written on the first call"""
+    images_file, labels_file = subset_filenames(subset_dir, name, num_images, input_size, seed)
+    if not os.path.exists(images_file):
+        print('Writing the {} subset to {}'.format(name, images_file), flush=True)
+        write_subset(image_dir, subset_dir, name, num_images, input_size, seed, workers)
+    # copy-on-write mapping, the tensors share its pages without copying them
+    return ImageSubset(np.load(images_file, mmap_mode='c'), np.load(labels_file))
+
+
+def normalize_batch(images, mean=imagenet_mean, std=imagenet_std, device='cuda', channels_last=False):
+    """Move a uint8 batch to device and normalize it as transforms.Normalize does"""
+    images = images.to(device, non_blocking=True).float()
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    mean = torch.tensor(mean, device=images.device).view(1, -1, 1, 1) * 255
+    std = torch.tensor(std, device=images.device).view(1, -1, 1, 1) * 255
+    return (images - mean) / std
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("image subsets")
+    parser.add_argument('--data', type=str, default='./ImageNet2012', help='location of the data corpus')
+    parser.add_argument('--subset_dir', type=str, default='./subsets', help='location of the subset files')
+    parser.add_argument('--calib_images', type=int, default=100000, help='number of training images for batchnorm recalibration')
+    parser.add_argument('--val_images', type=int, default=50000, help='number of validation images')
+    parser.add_argument('--input_size', type=int, default=224)
+    parser.add_argument('-j', '--workers', default=40, type=int, metavar='N')
+    args = parser.parse_args()
+
+    get_subset(os.path.join(args.data, 'ILSVRC2012_img_train'), args.subset_dir, 'calib',
+               args.calib_images, args.input_size, workers=args.workers)
+    get_subset(os.path.join(args.data, 'ILSVRC2012_img_val'), args.subset_dir, 'val',
+               args.val_images, args.input_size, workers=args.workers)
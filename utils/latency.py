@@ -0,0 +1,317 @@
+# cpu latency of the pruned networks, measured or predicted from a per-layer lookup table.
+#
+# measure_latency times a whole static (materialized) network: a few warm-up passes are
+# run first, then the median of the timed passes is kept, which is less sensitive to the
+# other processes than the mean.
+#
+# the lookup tables follow the layout of the FLOPs cost tables: one table per layer of the
+# static network over the scale ids of the gene columns its channels depend on, and the
+# latency of a population of encodings is the sum of its table entries. timing all the
+# 31^3 channel combinations of a bottleneck is out of reach, so every layer is timed on a
+# grid of scale ids (every grid_step-th one and the last one) and its table is filled by
+# multilinear interpolation between the grid points. layers of the same shape are timed once.
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.flops import channel_scale, scaled_channels, arch_layers, resnet50_stage_repeat, resnet50_stage_out_channel, \
+    resnet50_first_conv_flops, resnet50_bottleneck_flops, mobilenet_v1_stage_out_channel, mobilenet_v1_stride, \
+    mobilenet_v1_first_conv_flops, mobilenet_v1_dw3x3_pw1x1_flops, mobilenet_v2_stage_repeat, \
+    mobilenet_v2_stage_out_channel, mobilenet_v2_last_channel, mobilenet_v2_stride, mobilenet_v2_first_conv_flops, \
+    mobilenet_v2_bottleneck_flops
+from utils.static_net import Residual
+from utils.device import to_device, memory_format, inference_mode
+
+
+def measure_latency(net, input_size=224, batch_size=1, runs=10, warmup=3, num_threads=None, in_channels=3, channels_last=False):
+    """Median latency in ms of a forward pass of net on the cpu, net is moved to the cpu"""
+    net = to_device(net, 'cpu', channels_last).eval()
+    images = torch.randn(batch_size, in_channels, input_size, input_size).contiguous(memory_format=memory_format(channels_last))
+    threads = torch.get_num_threads()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    times = []
+    with inference_mode():
+        for k in range(warmup + runs):
+            start = time.perf_counter()
+            net(images)
+            if k >= warmup:
+                times += [time.perf_counter() - start]
+    torch.set_num_threads(threads)
+    return 1000 * float(np.median(times))
+
+
+# layers of the static networks, as built by materialize. every builder returns the
+# module and its number of input channels
+
+def conv_bn(inp, oup, kernel_size, stride=1, padding=0, groups=1):
+    return [nn.Conv2d(inp, oup, kernel_size, stride, padding, groups=groups, bias=False), nn.BatchNorm2d(oup)]
+
+
+def classifier(inp, pool_size, num_classes):
+    return [nn.AvgPool2d(pool_size), nn.Flatten(), nn.Linear(inp, num_classes)]
+
+
+def resnet50_first_conv(oup):
+    return nn.Sequential(*conv_bn(3, oup, 7, 2, 3), nn.ReLU(inplace=True), nn.MaxPool2d(3, 2, 1)), 3
+
+
+def resnet50_bottleneck(inp, mid, oup, stride, is_downsample):
+    body = nn.Sequential(*conv_bn(inp, mid, 1), nn.ReLU(inplace=True),
+                         *conv_bn(mid, mid, 3, stride, 1), nn.ReLU(inplace=True),
+                         *conv_bn(mid, oup, 1))
+    shortcut = nn.Sequential(*conv_bn(inp, oup, 1, stride)) if is_downsample else None
+    return Residual(body, shortcut, relu=True), inp
+
+
+def resnet50_classifier(inp, pool_size, num_classes):
+    return nn.Sequential(*classifier(inp, pool_size, num_classes)), inp
+
+
+def mobilenet_v1_first_conv(oup):
+    return nn.Sequential(*conv_bn(3, oup, 3, 2, 1), nn.ReLU(inplace=True)), 3
+
+
+def mobilenet_v1_dw3x3_pw1x1(inp, oup, stride):
+    return nn.Sequential(*conv_bn(inp, inp, 3, stride, 1, groups=inp), nn.ReLU(inplace=True),
+                         *conv_bn(inp, oup, 1), nn.ReLU(inplace=True)), inp
+
+
+def mobilenet_v1_classifier(inp, pool_size, num_classes):
+    return nn.Sequential(*classifier(inp, pool_size, num_classes)), inp
+
+
+def mobilenet_v2_first_conv(oup):
+    return nn.Sequential(*conv_bn(3, oup, 3, 2, 1), nn.ReLU6(inplace=True)), 3
+
+
+def mobilenet_v2_bottleneck(inp, mid, oup, stride, residual):
+    body = nn.Sequential(*conv_bn(inp, mid, 1), nn.ReLU6(inplace=True),
+                         *conv_bn(mid, mid, 3, stride, 1, groups=mid), nn.ReLU6(inplace=True),
+                         *conv_bn(mid, oup, 1))
+    # the input and output of a residual block share their tied scale id in a valid encoding
+    return (Residual(body) if residual and inp == oup else body), inp
+
+
+def mobilenet_v2_last_conv(inp, pool_size, num_classes):
+    return nn.Sequential(*conv_bn(inp, mobilenet_v2_last_channel, 1), nn.ReLU6(inplace=True),
+                         *classifier(mobilenet_v2_last_channel, pool_size, num_classes)), inp
+
+
+# the layers of an architecture in the order of its cost tables, each given as
+# (builder, keyword arguments of the builder, input size)
+
+def resnet50_latency_layers(input_size=224, num_classes=1000):
+    size = input_size
+    layers = [(resnet50_first_conv, {}, size)]
+    _, size = resnet50_first_conv_flops(1, size)
+    for i in range(len(resnet50_stage_repeat)):
+        for j in range(resnet50_stage_repeat[i]):
+            stride = 2 if (j == 0 and i > 0) else 1
+            layers += [(resnet50_bottleneck, {'stride': stride, 'is_downsample': j == 0}, size)]
+            _, size = resnet50_bottleneck_flops(1, 1, 1, stride, j == 0, size)
+    layers += [(resnet50_classifier, {'pool_size': size, 'num_classes': num_classes}, size)]
+    return layers
+
+
+def mobilenet_v1_latency_layers(input_size=224, num_classes=1000):
+    size = input_size
+    layers = [(mobilenet_v1_first_conv, {}, size)]
+    _, size = mobilenet_v1_first_conv_flops(1, size)
+    for i in range(1, len(mobilenet_v1_stage_out_channel)):
+        stride = mobilenet_v1_stride(i)
+        layers += [(mobilenet_v1_dw3x3_pw1x1, {'stride': stride}, size)]
+        _, size = mobilenet_v1_dw3x3_pw1x1_flops(1, 1, stride, size)
+    # the last layer is unpruned, its classifier does not depend on the encoding
+    layers += [(mobilenet_v1_classifier, {'inp': mobilenet_v1_stage_out_channel[-1], 'pool_size': 7,
+                                          'num_classes': num_classes}, size)]
+    return layers
+
+
+def mobilenet_v2_latency_layers(input_size=224, num_classes=1000):
+    size = input_size
+    layers = [(mobilenet_v2_first_conv, {}, size)]
+    _, size = mobilenet_v2_first_conv_flops(1, size)
+    for i in range(1, sum(mobilenet_v2_stage_repeat)):
+        stride = mobilenet_v2_stride(i)
+        residual = mobilenet_v2_stage_out_channel[i-1] == mobilenet_v2_stage_out_channel[i]
+        layers += [(mobilenet_v2_bottleneck, {'stride': stride, 'residual': residual}, size)]
+        _, size = mobilenet_v2_bottleneck_flops(1, 1, 1, stride, size)
+    layers += [(mobilenet_v2_last_conv, {'pool_size': 7, 'num_classes': num_classes}, size)]
+    return layers
+
+
+arch_latency_layers = {
+    'resnet50': resnet50_latency_layers,
+    'mobilenet_v1': mobilenet_v1_latency_layers,
+    'mobilenet_v2': mobilenet_v2_latency_layers,
+}
+
+
+def latency_columns(specs):
+    """Distinct gene columns of the channel arguments of a layer, in order"""
+    return tuple(dict.fromkeys(column for column, _ in specs if column is not None))
+
+
+def layer_channels(specs, columns, scale_ids):
+    """Channel arguments of a layer when its gene columns hold scale_ids"""
+    column_ids = dict(zip(columns, scale_ids))
+    return tuple(base if column is None else int(scaled_channels(base)[column_ids[column]]) for column, base in specs)
+
+
+def scale_id_grid(grid_step):
+    grid = list(range(0, len(channel_scale), grid_step))
+    if grid[-1] != len(channel_scale) - 1:
+        grid += [len(channel_scale) - 1]
+    return np.array(grid)
+
+
+def interpolate_table(grid, values):
+    """Table over all scale ids of the values on the grid points, multilinear in between"""
+    table = values
+    for axis in range(values.ndim):
+        table = np.apply_along_axis(lambda v: np.interp(np.arange(len(channel_scale)), grid, v), axis, table)
+    return table
+
+
+def build_latency_tables(arch, input_size=224, grid_step=5, batch_size=1, runs=5, num_threads=None, verbose=True, channels_last=False):
+    """Time every layer of arch on the grid of scale ids, returns the (columns, table) of every layer"""
+    grid = scale_id_grid(grid_step)
+    timings = {}
+    tables = []
+    layers = zip(arch_layers[arch](input_size), arch_latency_layers[arch](input_size))
+    for k, ((_, _, specs), (builder, kwargs, size)) in enumerate(layers):
+        start_time = time.time()
+        columns = latency_columns(specs)
+        values = np.zeros([len(grid)] * len(columns))
+        for point in np.ndindex(values.shape):
+            channels = layer_channels(specs, columns, grid[list(point)])
+            key = (builder.__name__, tuple(sorted(kwargs.items())), size, channels)
+            if key not in timings:
+                module, in_channels = builder(*channels, **kwargs)
+                timings[key] = measure_latency(module, size, batch_size, runs, num_threads=num_threads, in_channels=in_channels,
+                                               channels_last=channels_last)
+            values[point] = timings[key]
+        tables += [(columns, interpolate_table(grid, values))]
+        if verbose:
+            print('{} layer {}: {} grid points in {:.1f} secs, {:.3f} to {:.3f} ms'.format(
+                arch, k, values.size, time.time() - start_time, values.min(), values.max()), flush=True)
+    return tables
+
+
+def static_network(arch, ids, input_size=224):
+    """Static network of the encoding ids assembled from the timed layers, with random weights"""
+    layers = []
+    for (_, _, specs), (builder, kwargs, size) in zip(arch_layers[arch](input_size), arch_latency_layers[arch](input_size)):
+        columns = latency_columns(specs)
+        layers += [builder(*layer_channels(specs, columns, [ids[column] for column in columns]), **kwargs)[0]]
+    return nn.Sequential(*layers)
+
+
+# on disk, the tables of an architecture are saved in one .npz file with the timing settings
+# and the torch version they were measured with. the tables are only used with the settings
+# they were measured with, since the cpu kernels differ between layouts, thread counts and
+# torch releases: they must be rebuilt otherwise.
+
+def latency_table_filename(table_dir, arch, input_size):
+    return os.path.join(table_dir, '{}_{}_latency.npz'.format(arch, input_size))
+
+
+def torch_version():
+    """major.minor version of torch, the cpu kernels may change between them"""
+    return '.'.join(torch.__version__.split('+')[0].split('.')[:2])
+
+
+def save_latency_tables(tables, filename, **settings):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    arrays = {'table{}'.format(k): table for k, (_, table) in enumerate(tables)}
+    arrays.update({name: np.asarray(value) for name, value in dict(settings, torch_version=torch_version()).items()})
+    np.savez(filename, **arrays)
+
+
+# latency tables are loaded on first use and shared by all later calls
+latency_tables = {}
+
+
+def get_latency_tables(arch, input_size=224, table_dir='./latency_tables', **settings):
+    """Latency tables of arch at input_size, which must have been measured with the timing
+    settings given (e.g. threads, channels_last) and the torch version running"""
+    key = (arch, input_size, table_dir, tuple(sorted(settings.items())))
+    if key not in latency_tables:
+        filename = latency_table_filename(table_dir, arch, input_size)
+        if not os.path.exists(filename):
+            raise IOError('no latency table {}, build it with python -m utils.latency --arch {} from the repository root'.format(filename, arch))
+        data = np.load(filename)
+        for name, value in dict(settings, input_size=input_size, torch_version=torch_version()).items():
+            if name not in data.files or data[name].item() != value:
+                raise ValueError('latency table {} was measured with {} = {}, not {}: rebuild it with python -m utils.latency --arch {} '
+                                 'from the repository root'.format(filename, name, data[name].item() if name in data.files else 'unknown', value, arch))
+        tables = []
+        for k, (_, _, specs) in enumerate(arch_layers[arch](input_size)):
+            columns = latency_columns(specs)
+            table = data['table{}'.format(k)]
+            if table.shape != (len(channel_scale),) * len(columns):
+                raise ValueError('latency table {} does not match the layers of {}'.format(filename, arch))
+            tables += [(columns, table)]
+        latency_tables[key] = tables
+    return latency_tables[key]
+
+
+def tables_latency(tables, ids):
+    """Sum of the table entries of every row of an (N, num_states) array of scale ids"""
+    ids = np.asarray(ids).astype(int)
+    latency = np.zeros(ids.shape[0])
+    for columns, table in tables:
+        latency += table[tuple(ids[:, column] for column in columns)]
+    return latency
+
+
+def batch_latency(arch, ids, input_size=224, table_dir='./latency_tables', **settings):
+    """Predicted cpu latency in ms of every row of an (N, num_states) array of scale ids,
+    from the tables measured with the timing settings given"""
+    return tables_latency(get_latency_tables(arch, input_size, table_dir, **settings), ids)
+
+
+if __name__ == '__main__':
+    from utils.proxy_evaluation import rank_correlation
+
+    parser = argparse.ArgumentParser("Latency tables")
+    parser.add_argument('--arch', type=str, nargs='+', default=sorted(arch_layers.keys()), help='architectures to time')
+    parser.add_argument('--input_size', type=int, default=224, help='input resolution')
+    parser.add_argument('--table_dir', type=str, default='./latency_tables', help='where the tables are saved')
+    parser.add_argument('--grid_step', type=int, default=5, help='scale ids between two timed grid points')
+    parser.add_argument('--batch_size', type=int, default=1, help='images per timed forward pass')
+    parser.add_argument('--runs', type=int, default=5, help='timed passes per layer shape')
+    parser.add_argument('--threads', type=int, default=1, help='cpu threads of the timed passes')
+    parser.add_argument('--channels_last', action='store_true', help='time the layers in the NHWC memory format, as the searches with --channels_last')
+    parser.add_argument('--calib_networks', type=int, default=10, help='random networks timed whole to calibrate the tables (0 disables)')
+    args = parser.parse_args()
+
+    for arch in args.arch:
+        tables = build_latency_tables(arch, args.input_size, args.grid_step, args.batch_size, args.runs, args.threads,
+                                      channels_last=args.channels_last)
+
+        # the layers timed alone miss part of the cost of a whole network (cache misses between layers),
+        # the tables are scaled by the median ratio of measured to summed latency of random networks
+        scale = 1.
+        if args.calib_networks > 0:
+            num_genes = max(max(columns) for columns, _ in tables if columns) + 1
+            ids = np.random.randint(len(channel_scale), size=(args.calib_networks, num_genes))
+            summed = tables_latency(tables, ids)
+            measured = np.array([measure_latency(static_network(arch, row, args.input_size), args.input_size,
+                                                 args.batch_size, args.runs, num_threads=args.threads,
+                                                 channels_last=args.channels_last) for row in ids])
+            scale = float(np.median(measured / summed))
+            tables = [(columns, scale * table) for columns, table in tables]
+            print('{}: measured / summed latency = {:.3f} +- {:.3f} | rank correlation = {:.3f} over {} networks'.format(
+                arch, np.mean(measured / summed), np.std(measured / summed), rank_correlation(summed, measured), len(ids)), flush=True)
+
+        filename = latency_table_filename(args.table_dir, arch, args.input_size)
+        save_latency_tables(tables, filename, input_size=args.input_size, grid_step=args.grid_step, batch_size=args.batch_size,
+                            runs=args.runs, threads=args.threads, scale=scale, channels_last=args.channels_last)
+        print('Saved {}'.format(filename), flush=True)
@@ -0,0 +1,70 @@
+import numpy as np
+
+# NSGA-II selection over several objectives, all of them minimized (negate an accuracy).
+# the non-dominated sorting follows ENS-BS: once the solutions are sorted
+# lexicographically, no solution can be dominated by a later one, and a solution
+# dominated by a member of front k is dominated by a member of every front before k,
+# so its front is found by a binary search over the fronts, every test being one
+# vectorized comparison with the members of a front.
+
+
+def non_dominated_sort(objectives):
+    """Front index (0 for the Pareto front) of every row of the (N, M) objectives"""
+    objectives = np.asarray(objectives, dtype=np.float64)
+    order = np.lexsort(objectives.T[::-1])
+    rank = np.zeros(len(objectives), dtype=int)
+    fronts = []
+    for i in order:
+        x = objectives[i]
+        low, high = 0, len(fronts)
+        while low < high:
+            mid = (low + high) // 2
+            front = objectives[fronts[mid]]
+            dominated = np.any(np.all(front <= x, axis=1) & np.any(front < x, axis=1))
+            if dominated:
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(fronts):
+            fronts += [[]]
+        fronts[low] += [i]
+        rank[i] = low
+    return rank
+
+
+def crowding_distance(objectives):
+    """Crowding distance of every row of the objectives of one front, inf at the extremes"""
+    objectives = np.asarray(objectives, dtype=np.float64)
+    n = len(objectives)
+    distance = np.zeros(n)
+    if n <= 2:
+        return np.full(n, np.inf)
+    for m in range(objectives.shape[1]):
+        order = np.argsort(objectives[:, m], kind='stable')
+        values = objectives[order, m]
+        span = values[-1] - values[0]
+        distance[order[0]] = distance[order[-1]] = np.inf
+        if span > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / span
+    return distance
+
+
+def nsga2_select(objectives, num):
+    """Indices of num rows kept by NSGA-II: whole fronts first, then the least crowded
+    rows of the first front that does not fit. Also returns the rank and crowding
+    distance of every row."""
+    rank = non_dominated_sort(objectives)
+    crowding = np.zeros(len(rank))
+    for r in range(rank.max(initial=-1) + 1):
+        members = np.flatnonzero(rank == r)
+        crowding[members] = crowding_distance(np.asarray(objectives)[members])
+    order = np.lexsort((-crowding, rank))
+    return order[:num], rank, crowding
+
+
+def tournament(rank, crowding, num):
+    """num winners of binary tournaments, the lower rank then the larger crowding wins"""
+    a = np.random.randint(len(rank), size=num)
+    b = np.random.randint(len(rank), size=num)
+    a_wins = (rank[a] < rank[b]) | ((rank[a] == rank[b]) & (crowding[a] >= crowding[b]))
+    return np.where(a_wins, a, b)
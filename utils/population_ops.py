@@ -0,0 +1,84 @@
+import numpy as np
+
+from utils.flops import channel_scale, batch_flops
+from utils.candidate_set import CandidateSet
+
+# operators of the evolutionary search working on whole populations, stored as (N, L)
+# int8 arrays of scale ids. the FLOPsSampler of the search provides the FLOPs window and
+# the tied gene groups (the stage scales of MobileNetV2), which are mutated and crossed
+# over as one gene. the duplicates of a batch and the encodings already seen are filtered
+# with CandidateSet lookups of the whole batch instead of dict lookups of float tuples, and
+# the encodings scored by earlier runs are set apart so the generation budget goes to new ones.
+
+
+def gene_groups(sampler):
+    """Group index of every gene, tied genes share theirs"""
+    return np.array([sampler.column_var[column] for column in range(sampler.num_genes)])
+
+
+def mutate(parents, num, m_prob, groups):
+    """num children of parents picked at random, every gene group is moved to another
+    scale with probability m_prob"""
+    num_scales = len(channel_scale)
+    seeds = parents[np.random.randint(len(parents), size=num)].astype(int)
+    is_m = np.random.rand(num, groups.max() + 1) < m_prob
+    mu_val = np.random.randint(1, num_scales, size=is_m.shape) * is_m
+    return ((seeds + mu_val[:, groups]) % num_scales).astype(np.int8)
+
+
+def crossover(parents, num, groups):
+    """num children of two distinct parents, every gene group comes from one of them"""
+    id1 = np.random.randint(len(parents), size=num)
+    id2 = (id1 + np.random.randint(1, len(parents), size=num)) % len(parents)
+    mask = np.random.randint(0, 2, size=(num, groups.max() + 1)).astype(bool)[:, groups]
+    return np.where(mask, parents[id1], parents[id2]).astype(np.int8)
+
+
+def make_feasible(ids, sampler, max_edits):
+    """FLOPs of the rows of ids, the rows out of the FLOPs window of sampler are repaired
+    with at most max_edits changes or dropped. Returns the kept rows and their FLOPs."""
+    ids = np.array(ids, dtype=np.int8)
+    flops, _ = batch_flops(sampler.arch, ids, sampler.input_size)
+    keep = sampler.in_band(flops)
+    for i in np.flatnonzero(~keep):
+        repaired = sampler.repair(ids[i], max_edits) if max_edits > 0 else None
+        if repaired is not None:
+            ids[i] = repaired
+            flops[i] = batch_flops(sampler.arch, repaired[None, :], sampler.input_size)[0][0]
+            keep[i] = True
+    return ids[keep], flops[keep]
+
+
+def breed(generate, num, sampler, max_edits, seen=(), max_rounds=10, accept=None, known=None):
+    """Collect num feasible children of generate(n), distinct from each other and from the
+    CandidateSets of seen. accept(ids) is an extra constraint returning a mask of the rows
+    to keep. The children found in the CandidateSet known (already scored) do not count
+    towards num, they are set apart. Returns (ids, flops, known ids), fewer than num rows
+    only if max_rounds calls of generate could not find them."""
+    children = CandidateSet(sampler.num_genes)
+    found = CandidateSet(sampler.num_genes)
+    ids = np.zeros((0, sampler.num_genes), dtype=np.int8)
+    flops = np.zeros(0)
+    for _ in range(max_rounds):
+        need = num - len(ids)
+        if need <= 0:
+            break
+        # a few more than needed, some are infeasible or already seen
+        new_ids, new_flops = make_feasible(generate(2 * need), sampler, max_edits)
+        if accept is not None:
+            keep = accept(new_ids)
+            new_ids, new_flops = new_ids[keep], new_flops[keep]
+        _, first = np.unique(new_ids, axis=0, return_index=True)
+        new = np.sort(first)
+        for candidates in list(seen) + [children]:
+            new = new[~candidates.contains(new_ids[new])]
+        if known is not None and len(known) > 0:
+            is_known = known.contains(new_ids[new])
+            if is_known.any():
+                found.add(new_ids[new[is_known]])
+            new = new[~is_known]
+        new = new[:need]
+        children.add(new_ids[new])
+        ids = np.concatenate([ids, new_ids[new]])
+        flops = np.concatenate([flops, new_flops[new]])
+    return ids, flops, found.encodings()
@@ -0,0 +1,42 @@
+import zlib
+import numpy as np
+
+# successive-halving evaluation of the candidates: a candidate is first scored on small
+# class-stratified validation subsets (rungs) of growing size, and it only reaches the
+# full validation set while the upper confidence bound of its reward on every rung can
+# still enter the kept top candidates.
+
+
+def stratified_indices(labels, per_class, seed=0):
+    """Pick per_class images of every class in labels, the picks for a smaller per_class
+    are a subset of those for a larger one"""
+    rng = np.random.RandomState(seed)
+    labels = np.asarray(labels)
+    indices = []
+    for c in np.unique(labels):
+        indices += [rng.permutation(np.flatnonzero(labels == c))[:per_class]]
+    return np.sort(np.concatenate(indices))
+
+
+def accuracy_upper_bound(acc, n, z=2.0):
+    """Wilson upper confidence bound (in %) of an accuracy acc (in %) measured on n images"""
+    p = acc / 100.0
+    center = p + z**2 / (2*n)
+    margin = z * np.sqrt(p*(1-p)/n + z**2 / (4*n**2))
+    return 100.0 * min((center + margin) / (1 + z**2 / n), 1.0)
+
+
+def rank_correlation(x, y):
+    """Spearman rank correlation of x and y"""
+    if len(x) < 2:
+        return float('nan')
+    rank_x = np.argsort(np.argsort(x))
+    rank_y = np.argsort(np.argsort(y))
+    return np.corrcoef(rank_x, rank_y)[0, 1]
+
+
+def control_candidate(ids, fraction):
+    """Whether the encoding ids belongs to the control sample, a fraction of the candidates drawn
+    from a hash of the encoding: it does not depend on their proxy scores, and every worker and
+    resumed search draws the same candidates"""
+    return zlib.crc32(np.asarray(ids, dtype=np.int64).tobytes()) < fraction * 2**32
@@ -0,0 +1,124 @@
+import time
+import sqlite3
+import numpy as np
+
+from utils.candidate_set import CandidateSet
+
+# append-only store of the evaluated candidates, shared by all the runs of a search.
+# every result is committed to an SQLite file as soon as it is added, so a crash loses
+# at most the candidate being evaluated. the rewards are also kept in a dict keyed by
+# the encoding vector, which answers the lookups of the search without a query, and in a
+# CandidateSet for the lookups of whole generated populations.
+# the columns added since a store was created are appended to its table when it is opened.
+# the reward stored with a candidate is the one of the search that evaluated it. a search with
+# another reward definition passes a reward function, which recomputes the rewards of the
+# stored candidates from their records when the store is opened.
+
+fields = ['top1', 'top5', 'loss', 'flops', 'params', 'reward', 'eval_time', 'latency']
+
+
+def encoding_key(ids):
+    return tuple(int(v) for v in ids)
+
+
+class ResultStore(object):
+    def __init__(self, filename, reward=None):
+        """reward(ids, record) maps the stored record (a dict of fields) of the encoding ids to its
+        reward in this search, None leaves the candidate out as if it was never evaluated. By
+        default the stored rewards are used."""
+        self.reward = reward
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (encoding TEXT PRIMARY KEY, {}, created REAL)'.format(
+            ', '.join('{} REAL'.format(field) for field in fields)))
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(results)')]
+        for field in fields:
+            if field not in columns:
+                self.db.execute('ALTER TABLE results ADD COLUMN {} REAL'.format(field))
+        self.db.commit()
+        self.rewards = {}
+        for row in self.db.execute('SELECT encoding, {} FROM results'.format(', '.join(fields))):
+            key = encoding_key(row[0].split(','))
+            reward = self.stored_reward(key, dict(zip(fields, row[1:])))
+            if reward is not None:
+                self.rewards[key] = reward
+        self.index = None
+
+    def stored_reward(self, key, record):
+        if self.reward is None:
+            return record['reward']
+        return self.reward(np.array(key), record)
+
+    def __len__(self):
+        return len(self.rewards)
+
+    def __contains__(self, ids):
+        return encoding_key(ids) in self.rewards
+
+    def __getitem__(self, ids):
+        """Reward of the encoding ids"""
+        return self.rewards[encoding_key(ids)]
+
+    def encodings(self, num_genes):
+        """CandidateSet of the stored encodings scored with their reward, kept up to date by add"""
+        if self.index is None:
+            self.index = CandidateSet.from_dict(self.rewards, num_genes)
+        return self.index
+
+    def get(self, ids):
+        """Full record of the encoding ids as a dict, None if it was not evaluated"""
+        key = encoding_key(ids)
+        if key not in self.rewards:
+            return None
+        row = self.db.execute('SELECT {} FROM results WHERE encoding = ?'.format(', '.join(fields)),
+                              (','.join(map(str, key)),)).fetchone()
+        return dict(zip(fields, row))
+
+    def table(self, names):
+        """Encodings and values of the candidates with all the fields of names recorded,
+        as an (N, num_genes) int array and an (N, len(names)) float array"""
+        rows = self.db.execute('SELECT encoding, {} FROM results WHERE {}'.format(
+            ', '.join(names), ' AND '.join('{} IS NOT NULL'.format(name) for name in names))).fetchall()
+        ids = np.array([[int(v) for v in row[0].split(',')] for row in rows], dtype=int)
+        values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(-1, len(names))
+        return ids, values
+
+    def add(self, ids, reward, **record):
+        """Record the result of the encoding ids, the other fields default to NULL. A stored
+        encoding evaluated again only gets the fields it was missing (e.g. its latency)."""
+        key = encoding_key(ids)
+        if key in self.rewards:
+            names = [field for field in fields if field != 'reward' and record.get(field) is not None]
+            if names:
+                self.db.execute('UPDATE results SET {} WHERE encoding = ?'.format(
+                                    ', '.join('{0} = COALESCE({0}, ?)'.format(name) for name in names)),
+                                [float(record[name]) for name in names] + [','.join(map(str, key))])
+                self.db.commit()
+            return
+        record['reward'] = float(reward)
+        values = [None if record.get(field) is None else float(record[field]) for field in fields]
+        # a candidate left out by the reward function is evaluated again and replaces its record
+        self.db.execute('INSERT OR REPLACE INTO results (encoding, {}, created) VALUES (?, {}, ?)'.format(
+                            ', '.join(fields), ', '.join(['?'] * len(fields))),
+                        [','.join(map(str, key))] + values + [time.time()])
+        self.db.commit()
+        self.rewards[key] = record['reward']
+        if self.index is not None:
+            self.index.add(np.array(key), record['reward'])
+
+    def import_rewards(self, rewards):
+        """Add the rewards of a {encoding: reward} dict, as pickled by earlier searches"""
+        for ids, reward in rewards.items():
+            key = encoding_key(ids)
+            if key not in self.rewards:
+                self.db.execute('INSERT OR IGNORE INTO results (encoding, reward, created) VALUES (?, ?, ?)',
+                                (','.join(map(str, key)), float(reward), time.time()))
+                reward = self.stored_reward(key, dict({field: None for field in fields}, reward=float(reward)))
+                if reward is None:
+                    continue
+                self.rewards[key] = reward
+                if self.index is not None:
+                    self.index.add(np.array(key), reward)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,816 @@
+import os
+import time
+import pickle
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.utils import AverageMeter, accuracy, save_snapshot
+from utils.flops import channel_scale, batch_flops, get_cost_tables
+from utils.flops_sampler import FLOPsSampler
+from utils.bn_calibration import cache_batches, batchnorm_layers, load_bn_stats, recalibrate_bn, finite_stats
+from utils.image_subsets import get_subset, normalize_batch
+from utils.proxy_evaluation import stratified_indices, accuracy_upper_bound, rank_correlation, control_candidate
+from utils.weight_cache import set_weight_cache
+from utils.result_store import ResultStore
+from utils.eval_scheduler import EvalScheduler, worker_devices
+from utils.surrogate import RidgeSurrogate
+from utils.population_ops import gene_groups, mutate, crossover, breed
+from utils.candidate_set import CandidateSet
+from utils.pareto import nsga2_select, tournament
+from utils.latency import measure_latency, batch_latency
+from utils.device import data_parallel, to_device, inference_mode, amp_dtype, autocast
+
+# evolutionary search of the pruned networks of a PruningNet, shared by ResNet50, MobileNetV1
+# and MobileNetV2. everything that differs between them is held by an Architecture: the
+# PruningNet class, how an encoding vector is split into its forward arguments, the reward
+# constants, the FLOPs window and the gene columns tied together. searching/search.py of every
+# network only describes its Architecture and its argument defaults.
+
+
+class Architecture(object):
+    def __init__(self, name, arch, pruning_net, net_inputs, ba, bf, min_FLOPs, max_FLOPs, prior=None, tied_columns=None):
+        """arch is the key of the FLOPs and latency tables, pruning_net() builds the PruningNet,
+        net_inputs(ids) splits an encoding vector into the arguments of its forward pass
+        following the images (and of materialize). ba and bf are the base accuracy and FLOPs of
+        the reward, prior and tied_columns are passed on to the FLOPsSampler of the window."""
+        self.name = name
+        self.arch = arch
+        self.pruning_net = pruning_net
+        self.net_inputs = net_inputs
+        self.ba = ba
+        self.bf = bf
+        self.min_FLOPs = min_FLOPs
+        self.max_FLOPs = max_FLOPs
+        self.prior = prior
+        self.tied_columns = tied_columns
+
+
+def add_search_arguments(parser, net_cache, save_dict_name, pareto_budgets, snapshot='./searching_snapshot.pkl', initial_candidates=''):
+    """Arguments of the search, the given ones are the defaults that differ between the networks"""
+    parser.add_argument('--max_iters', type=int, default=20)
+    parser.add_argument('--net_cache', type=str, default=net_cache, help='model to be loaded')
+    parser.add_argument('--data', type=str, default='../data', help='location of the data corpus')
+    parser.add_argument('--batch_size', type=int, default=1000, help='batch size')
+    parser.add_argument('--result_store', type=str, default='results.db', help='SQLite file of the evaluated candidates')
+    parser.add_argument('--save_dict_name', type=str, default=save_dict_name, help='pickled rewards of an earlier search, imported into the result store')
+    parser.add_argument('--load_dict', type=str, default=True)
+    parser.add_argument('--snapshot', type=str, default=snapshot, help='snapshot of the generational search, the steady-state and Pareto ones get a _steady and _pareto suffix')
+    parser.add_argument('--initial_candidates', type=str, default=initial_candidates, help='pickled first population (empty draws it at random)')
+    parser.add_argument('--repair_edits', type=int, default=2, help='max genes changed to move a child into the FLOPs window (0 disables)')
+    parser.add_argument('--calib_batches', type=int, default=100, help='number of training batches cached for batchnorm recalibration')
+    parser.add_argument('--val_images', type=int, default=50000, help='number of validation images the candidates are evaluated on')
+    parser.add_argument('--subset_dir', type=str, default='./subsets', help='location of the decoded calibration and validation subsets')
+    parser.add_argument('--calib_cache_mb', type=int, default=16384, help='memory for the cached calibration batches, the batches beyond it are left out')
+    parser.add_argument('--calib_group', type=int, default=10, help='number of candidates recalibrated in one pass over the cached batches')
+    parser.add_argument('--proxy_per_class', type=str, default='5,20', help='validation images per class of the successive-halving proxy subsets (empty disables)')
+    parser.add_argument('--proxy_z', type=float, default=2.0, help='z-score of the accuracy upper bound used to reject candidates on a proxy subset')
+    parser.add_argument('--proxy_control', type=float, default=0.05, help='fraction of the candidates always evaluated on the full validation set, to measure the proxy rank correlation')
+    parser.add_argument('--proxy_full_eval', action='store_true', help='evaluate every candidate on the full validation set, to measure the proxy rank correlation')
+    parser.add_argument('--weight_cache_mb', type=int, default=4096, help='memory for the generated conv weights memoized by the PruningNet (0 disables)')
+    parser.add_argument('--dynamic_eval', action='store_true', help='evaluate the candidates through the PruningNet instead of a materialized static network')
+    parser.add_argument('--eval_workers', type=int, default=0, help='number of evaluation processes, one PruningNet replica each (0 evaluates in this process)')
+    parser.add_argument('--steady_state', action='store_true', help='breed a child as soon as an evaluation slot is free instead of evaluating whole populations')
+    parser.add_argument('--surrogate_pool', type=int, default=1, help='children generated per evaluated one, only those with the best predicted reward are evaluated (1 disables)')
+    parser.add_argument('--surrogate_min_samples', type=int, default=100, help='evaluated candidates needed before the reward predictor is used')
+    parser.add_argument('--pareto', action='store_true', help='NSGA-II search of the Pareto front of top-1 accuracy, FLOPs and cpu latency')
+    parser.add_argument('--pareto_flops', type=str, default='', help='FLOPs window of the Pareto search as min,max (default: 0 to the base FLOPs)')
+    parser.add_argument('--pareto_budgets', type=str, default=pareto_budgets, help='FLOPs budgets the best candidates of the Pareto front are reported for')
+    parser.add_argument('--latency_runs', type=int, default=None, help='timed cpu passes of a fully evaluated candidate, 0 disables the latency measurement '
+                        '(default: 10 with --pareto, --max_latency or a latency --reward_cost, 0 otherwise)')
+    parser.add_argument('--latency_threads', type=int, default=1, help='cpu threads the latency is measured with, and the latency tables were built with')
+    parser.add_argument('--latency_table_dir', type=str, default='./latency_tables', help='location of the per-layer cpu latency tables')
+    parser.add_argument('--max_latency', type=float, default=0, help='bound in ms on the predicted cpu latency of the generated candidates (0 disables)')
+    parser.add_argument('--reward_cost', type=str, default='flops', choices=['flops', 'latency', 'both'], help='cost traded against the accuracy by the reward, FLOPs and/or predicted cpu latency')
+    parser.add_argument('--flops_table_dir', type=str, default='./flops_tables', help='location of the per-layer FLOPs tables (empty: built in memory)')
+    parser.add_argument('-j', '--workers', default=40, type=int, metavar='N',
+                        help='number of data loading workers (default: 4)')
+    return parser
+
+
+def variant_snapshot(snapshot, name):
+    """Snapshot file of the name search next to the --snapshot of the generational one"""
+    root, ext = os.path.splitext(snapshot)
+    return '{}_{}{}'.format(root, name, ext)
+
+
+class SearchEngine(object):
+    # objectives of the Pareto search, all of them minimized
+    objective_names = ['top1', 'flops', 'latency']
+    objective_signs = np.array([-1., 1., 1.])
+
+    def __init__(self, architecture, args, device, calib_batches=None, val_dataset=None):
+        """Load everything the evaluation of the candidates shares: the FLOPs tables, the result
+        store and the image subsets. calib_batches (uint8 image batches) and val_dataset (an
+        ImageSubset) replace the subsets of args.data when given, e.g. in the benchmarks.
+        Evaluation workers are forked from this process later, so cuda must not be initialized here."""
+        self.architecture = architecture
+        self.args = args
+        # device of the search process, the evaluation workers get theirs from the scheduler
+        self.device = device
+        # autocast dtype of the recalibration and evaluation passes, None in fp32
+        self.amp_dtype = amp_dtype(args, device)
+        a = architecture
+
+        # map the per-layer FLOPs tables from disk, they are written on the first run
+        get_cost_tables(a.arch, table_dir=args.flops_table_dir or None)
+
+        # draws encodings directly inside the FLOPs window
+        self.flops_sampler = FLOPsSampler(a.arch, a.min_FLOPs, a.max_FLOPs, prior=a.prior, tied_columns=a.tied_columns)
+        self.num_genes = self.flops_sampler.num_genes
+        # gene groups mutated and crossed over as one gene
+        self.tied_genes = gene_groups(self.flops_sampler)
+
+        # the measured latency is only an objective of the Pareto search and a check of the latency
+        # predictions, the reward search does not pay for it otherwise
+        if args.latency_runs is None:
+            args.latency_runs = 10 if args.pareto or args.max_latency > 0 or args.reward_cost != 'flops' else 0
+
+        # predicted latency of the unpruned network, the latency counterpart of bf
+        self.bl = None
+        if args.reward_cost != 'flops':
+            self.bl = self.predicted_latency(np.full(self.num_genes, len(channel_scale) - 1))[0]
+
+        # file for save the intermediate searched results
+        self.results = ResultStore(args.result_store, reward=self.stored_reward)
+        if os.path.exists(args.save_dict_name):
+            f = open(args.save_dict_name, 'rb')
+            self.results.import_rewards(pickle.load(f))
+            f.close()
+        print('{} candidates in the result store'.format(len(self.results)), flush=True)
+
+        # reward predictor fitted on the result store, ranks the generated children before they are evaluated
+        self.surrogate = RidgeSurrogate([len(channel_scale)] * self.num_genes)
+
+        # fixed calibration (training) and validation subsets, decoded into uint8 files on the first run
+        if calib_batches is None:
+            traindir = os.path.join(args.data, 'ILSVRC2012_img_train')
+            calib_dataset = get_subset(traindir, args.subset_dir, 'calib', args.calib_batches*args.batch_size, workers=args.workers)
+            # the batchnorm recalibration set is loaded once and shared by all candidates
+            calib_batches = cache_batches(calib_dataset.batches(args.batch_size), args.calib_batches, args.calib_cache_mb)
+        self.calib_batches = calib_batches
+        if val_dataset is None:
+            valdir = os.path.join(args.data, 'ILSVRC2012_img_val')
+            val_dataset = get_subset(valdir, args.subset_dir, 'val', args.val_images, workers=args.workers)
+        self.val_dataset = val_dataset
+
+        # class-stratified proxy subsets of the validation set for the successive-halving evaluation
+        self.proxy_per_class = [int(k) for k in args.proxy_per_class.split(',') if k]
+        self.proxy_batches = [list(self.val_dataset.batches(args.batch_size, stratified_indices(self.val_dataset.labels.numpy(), k)))
+                              for k in self.proxy_per_class]
+        # proxy and full top-1 accuracies of the control candidates, evaluated on both whatever their
+        # proxy scores. the survivors of the proxies would only measure the correlation among the best
+        self.proxy_records = [[] for _ in self.proxy_per_class]
+
+    # batch of the subsets moved to the device of the model and normalized
+    def preprocess(self, images, device=None):
+        return normalize_batch(images, device=device or self.device, channels_last=self.args.channels_last)
+
+    # cpu latency of encodings predicted from the per-layer latency tables, which are only
+    # loaded when --max_latency or --reward_cost needs them
+    def predicted_latency(self, ids):
+        return batch_latency(self.architecture.arch, np.asarray(ids).reshape(-1, self.num_genes), table_dir=self.args.latency_table_dir,
+                             threads=self.args.latency_threads, channels_last=self.args.channels_last)
+
+    # the candidates generated must satisfy the latency bound, if any
+    def within_latency(self, ids):
+        if self.args.max_latency <= 0:
+            return np.ones(len(ids), dtype=bool)
+        return self.predicted_latency(ids) <= self.args.max_latency
+
+    # infer the accuracy of a selected pruned net (identidyed with ids), under autocast to dtype unless it is None
+    def infer(self, model, criterion, ids, bn_stats, batches, dtype=None):
+
+        batch_time = AverageMeter('Time', ':6.3f')
+        losses = AverageMeter('Loss', ':.4e')
+        top1 = AverageMeter('Acc@1', ':6.2f')
+        top5 = AverageMeter('Acc@5', ':6.2f')
+        net_inputs = self.architecture.net_inputs(ids)
+
+        # batchnorm statistics recalibrated by test_candidates_model
+        load_bn_stats(batchnorm_layers(model), bn_stats)
+
+        # evaluate the corresponding pruned network, as a static network with the generated weights
+        model.eval()
+        net = model
+        device = next(model.parameters()).device
+        if not self.args.dynamic_eval:
+            # the weights generated under autocast are those the batchnorms were recalibrated with
+            with autocast(device, dtype):
+                static_net = to_device(model.module.materialize(*net_inputs), device, self.args.channels_last)
+            net = data_parallel(static_net, device, device_ids=model.device_ids or None).eval()
+        with inference_mode(), autocast(device, dtype):
+            end = time.time()
+            for i, (images, target) in enumerate(batches):
+                images = self.preprocess(images, device)
+                target = target.to(device, non_blocking=True)
+
+                # compute output
+                logits = net(images) if net is not model else model(images, *net_inputs)
+                loss = criterion(logits, target)
+
+                # measure accuracy and record loss
+                pred1, pred5 = accuracy(logits, target, topk=(1, 5))
+                n = images.size(0)
+                losses.update(loss.item(), n)
+                top1.update(pred1[0], n)
+                top5.update(pred5[0], n)
+
+                # measure elapsed time
+                batch_time.update(time.time() - end)
+                end = time.time()
+
+        return top1.avg, top5.avg, losses.avg
+
+    # reward in this search of a candidate of the result store. the stored reward follows the
+    # --reward_cost of the search that evaluated it, so it is recomputed from the stored accuracy
+    # and FLOPs. the pickled rewards of earlier searches have no accuracy, they are FLOPs rewards
+    def stored_reward(self, ids, record):
+        if record['top1'] is None or record['flops'] is None:
+            return record['reward'] if self.args.reward_cost == 'flops' else None
+        latency = self.predicted_latency(ids)[0] if self.args.reward_cost != 'flops' else None
+        return float(self.get_reward(record['top1'], record['flops'], latency))
+
+    # reward of a pruned network from its top-1 accuracy and FLOPs, or its predicted latency with --reward_cost
+    def get_reward(self, top1_acc, flops, latency=None):
+        ba, bf = self.architecture.ba, self.architecture.bf
+        psi = (ba / (ba - top1_acc)) ** 2
+        rho = -np.log(flops / bf)
+        if self.args.reward_cost == 'latency':
+            rho = -np.log(latency / self.bl)
+        elif self.args.reward_cost == 'both':
+            rho = -(np.log(flops / bf) + np.log(latency / self.bl)) / 2
+        return psi * rho
+
+    # score of a candidate: successive halving on the proxy subsets, then the full validation set.
+    # the candidate is rejected as soon as even the upper bound of its reward can not enter the
+    # kept top candidates, nothing can be rejected before keep_top_50 is full
+    def evaluate_candidate(self, model, criterion, can, bn_stats, threshold, dtype=None):
+        args = self.args
+        start_time = time.time()
+        flops, params = batch_flops(self.architecture.arch, can[None, :-1])
+        flops = flops[0]
+        latency = self.predicted_latency(can[:-1])[0] if args.reward_cost != 'flops' else None
+        record = {'flops': float(flops), 'params': float(params[0]), 'proxy_acc': [], 'proxy_images': []}
+        rungs = self.proxy_batches if threshold > -np.inf or args.proxy_full_eval else []
+        # the control candidates are scored on the proxies but never rejected by them
+        record['control'] = bool(rungs) and (args.proxy_full_eval or control_candidate(can[:-1], args.proxy_control))
+        for batches in rungs:
+            Top1_acc, _, _ = self.infer(model, criterion, can[:-1], bn_stats, batches, dtype)
+            n = sum(len(target) for _, target in batches)
+            record['proxy_acc'] += [float(Top1_acc)]
+            record['proxy_images'] += [n]
+            acc_bound = accuracy_upper_bound(float(Top1_acc), n, args.proxy_z)
+            if not record['control'] and acc_bound < self.architecture.ba and self.get_reward(acc_bound, flops, latency) < threshold:
+                # its reward bound keeps it out of the top candidates
+                record['reward'] = float(self.get_reward(acc_bound, flops, latency))
+                break
+        else:
+            Top1_acc, Top5_acc, loss = self.infer(model, criterion, can[:-1], bn_stats, self.val_dataset.batches(args.batch_size), dtype)
+            record.update(top1=float(Top1_acc), top5=float(Top5_acc), loss=float(loss),
+                          reward=float(self.get_reward(float(Top1_acc), flops, latency)))
+            if args.latency_runs > 0:
+                # cpu latency of the static network on one image
+                with torch.no_grad():
+                    net = model.module.materialize(*self.architecture.net_inputs(can[:-1]))
+                record['latency'] = measure_latency(net, runs=args.latency_runs, num_threads=args.latency_threads,
+                                                    channels_last=args.channels_last)
+        record['eval_time'] = time.time() - start_time
+        return record
+
+    # recalibrate batchnorm of a group of candidates in one pass over the cached batches, then score them
+    def evaluate_group(self, state, task):
+        model, criterion = state
+        cans, threshold = task
+        device = next(model.parameters()).device
+        inputs = [self.architecture.net_inputs(can[:-1]) for can in cans]
+        dtype = self.amp_dtype
+        bn_stats = recalibrate_bn(model, self.calib_batches, inputs, lambda images: self.preprocess(images, device), dtype=dtype)
+        if dtype is not None and not all(finite_stats(stats) for stats in bn_stats):
+            # the activations overflowed the autocast dtype, the group is recalibrated and scored in fp32
+            print('Non-finite batchnorm statistics under autocast, {} candidates evaluated in fp32'.format(len(cans)), flush=True)
+            dtype = None
+            bn_stats = recalibrate_bn(model, self.calib_batches, inputs, lambda images: self.preprocess(images, device))
+        for k, can in enumerate(cans):
+            yield k, self.evaluate_candidate(model, criterion, can, bn_stats[k], threshold, dtype)
+
+    # PruningNet replica of an evaluation worker, on the device set by the scheduler
+    def init_worker(self, device):
+        device = torch.device(device)
+        criterion = nn.CrossEntropyLoss().to(device)
+        model = to_device(self.architecture.pruning_net(), device, self.args.channels_last)
+        model = data_parallel(model, device, device_ids=[device.index] if device.type == 'cuda' else None)
+        checkpoint = torch.load(self.args.net_cache, map_location=device)
+        model.load_state_dict(checkpoint['state_dict'])
+        set_weight_cache(model.module, self.args.weight_cache_mb)
+        return model, criterion
+
+    # print the score of a candidate and append it to the result store when it was fully evaluated
+    def record_candidate(self, can, record, cnt):
+        print('\nTesting Model {}'.format(cnt), flush=True)
+        print(list(can[:-1].astype(int)))
+        print('FLOPs = {:.2f}M'.format(record['flops']), flush=True)
+        for acc, n in zip(record['proxy_acc'], record['proxy_images']):
+            print('Proxy Top-1 Accuracy = {:.2f} on {} images'.format(acc, n), flush=True)
+        if 'top1' in record:
+            if record.get('control'):
+                for records, acc in zip(self.proxy_records, record['proxy_acc']):
+                    records += [(acc, record['top1'])]
+            print('Top-1 Accuracy = {:.2f} | Top-5 Accuracy = {:.2f} | Loss = {:.4f}'.format(record['top1'], record['top5'], record['loss']), flush=True)
+            if 'latency' in record:
+                print('CPU Latency = {:.2f} ms'.format(record['latency']), flush=True)
+            self.results.add(can[:-1], record['reward'], top1=record['top1'], top5=record['top5'], loss=record['loss'],
+                             flops=record['flops'], params=record['params'], eval_time=record['eval_time'], latency=record.get('latency'))
+        else:
+            print('Rejected on the proxy subset. Reward <= {:.2f}'.format(record['reward']), flush=True)
+        now = time.gmtime(record['eval_time'])
+        print('Testing Model {} took {} mins and {} secs'.format(cnt, now.tm_min, now.tm_sec))
+
+    # proxy rank correlations and utilization of the evaluation workers
+    def print_evaluation_stats(self, scheduler=None):
+        for k, records in zip(self.proxy_per_class, self.proxy_records):
+            if len(records) > 1:
+                acc, full_acc = zip(*records)
+                print('Proxy rank correlation with {} images per class = {:.3f} over {} control candidates'.format(k, rank_correlation(acc, full_acc), len(records)), flush=True)
+        if scheduler is not None:
+            for worker_id, (device, utilization) in enumerate(zip(scheduler.devices, scheduler.utilization())):
+                print('Evaluation worker {} on {} busy {:.1f}% of the time'.format(worker_id, device, 100 * utilization), flush=True)
+
+    # score a candidate already in the result store
+    def known_reward(self, can, cnt):
+        print('\nTesting Model {}'.format(cnt), flush=True)
+        print(list(can[:-1].astype(int)))
+        print('Already tested. Reward = {:.2f}'.format(self.results[can[:-1]]))
+        return self.results[can[:-1]]
+
+    # prepare ids for testing, threshold is the reward needed to enter the kept top candidates.
+    # scored holds the indices of the candidates scored before the search was resumed
+    def test_candidates_model(self, model, criterion, candidates, cnt, test_dict, threshold=-np.inf, scored=(), checkpoint=None, scheduler=None):
+        scored = set(scored)
+
+        def set_reward(i, reward):
+            nonlocal cnt
+            can = candidates[i]
+            can[-1] = reward
+            test_dict.add(can[:-1], can[-1])
+            scored.add(i)
+            cnt += 1
+            if checkpoint is not None:
+                checkpoint(scored, cnt)
+
+        known = self.known_encodings()
+        untested = []
+        for i, can in enumerate(candidates):
+            if i in scored:
+                # can[-1] already holds the reward
+                test_dict.add(can[:-1], can[-1])
+                continue
+            assert can[:-1] not in test_dict
+            if can[:-1] in known:
+                set_reward(i, self.known_reward(can, cnt))
+            else:
+                untested += [i]
+
+        # groups of candidates recalibrated together, small enough to keep every worker busy
+        num_workers = 1 if scheduler is None else len(scheduler.workers)
+        group_size = max(1, min(self.args.calib_group, int(np.ceil(len(untested) / num_workers))))
+        groups = [untested[k:k+group_size] for k in range(0, len(untested), group_size)]
+        tasks = [([candidates[i] for i in group], threshold) for group in groups]
+        if scheduler is None:
+            evaluations = ((task_index, result) for task_index, task in enumerate(tasks) for result in self.evaluate_group((model, criterion), task))
+        else:
+            evaluations = scheduler.run(tasks)
+
+        # the candidates are recorded as soon as they are scored, in completion order
+        for task_index, (k, record) in evaluations:
+            i = groups[task_index][k]
+            self.record_candidate(candidates[i], record, cnt)
+            set_reward(i, record['reward'])
+
+        self.print_evaluation_stats(scheduler)
+        return candidates, cnt
+
+    # keep the num candidates of cans with the best predicted reward, the others are dropped from untest_dict.
+    # the surrogate is refitted on the result store whenever it grew, it is only trusted after surrogate_min_samples
+    def prescreen(self, cans, num, untest_dict):
+        args, results, surrogate = self.args, self.results, self.surrogate
+        if args.surrogate_pool > 1 and len(results) >= max(args.surrogate_min_samples, surrogate.num_samples + 1):
+            start_time = time.time()
+            surrogate.fit(np.array(list(results.rewards.keys())), list(results.rewards.values()))
+            print('Surrogate fitted on {} candidates in {:.2f} secs: leave-one-out RMSE = {:.4f} | rank correlation = {:.3f}'.format(
+                surrogate.num_samples, time.time() - start_time, surrogate.error, surrogate.rank_correlation), flush=True)
+        order = np.arange(len(cans))
+        if surrogate.num_samples > 0 and len(cans) > num:
+            order = np.argsort(-surrogate.predict(np.array([can[:-1] for can in cans])), kind='stable')
+        if len(cans) > num:
+            untest_dict.remove(np.array([cans[i][:-1] for i in order[num:]]))
+        return [cans[i] for i in order[:num]]
+
+    # encodings of the result store that are not evaluated again. the Pareto search needs their
+    # three objectives: those stored without a measured latency (--latency_runs=0) are evaluated
+    # again, which records it, instead of being left out of the archive for good
+    def known_encodings(self):
+        if not self.args.pareto:
+            return self.results.encodings(self.num_genes)
+        ids, _ = self.results.table(self.objective_names)
+        return CandidateSet.from_dict({tuple(row): self.results[row] for row in ids}, self.num_genes)
+
+    # children already in the result store are not evaluated again, nor counted in the number of
+    # children generated. they are added to test_dict with their reward, and to free (if given)
+    # as scored candidates, which join the selection as free evaluations
+    def known_candidates(self, ids, test_dict, free):
+        if len(ids) == 0:
+            return
+        rewards = self.results.encodings(self.num_genes).scores(ids)
+        test_dict.add(ids, rewards)
+        if free is not None:
+            free.extend(np.concatenate([ids, rewards[:, None]], axis=1).astype(np.float32))
+        print('{} known candidates generated, best reward = {:.2f}'.format(len(ids), rewards.max()), flush=True)
+
+    # mutation operation in evolution algorithm
+    def get_mutation(self, keep_top_k, mutation_num, m_prob, test_dict, untest_dict, sampler=None, free=None):
+        print('> Mutation', flush=True)
+        sampler = sampler or self.flops_sampler
+        parents = np.array(keep_top_k)[:, :-1].astype(np.int8)
+        ids, flops, known = breed(lambda n: mutate(parents, n, m_prob, self.tied_genes), mutation_num,
+                                  sampler, self.args.repair_edits, (test_dict, untest_dict), accept=self.within_latency,
+                                  known=self.known_encodings())
+        res = list(np.concatenate([ids, flops[:, None]], axis=1).astype(np.float32))
+        untest_dict.add(ids, flops)
+        self.known_candidates(known, test_dict, free)
+        print('mutation_num = {}'.format(len(res)), flush=True)
+        return res
+
+    # crossover operation in evolution algorithm
+    def get_crossover(self, keep_top_k, crossover_num, test_dict, untest_dict, sampler=None, free=None):
+        print('> Crossover', flush=True)
+        sampler = sampler or self.flops_sampler
+        parents = np.array(keep_top_k)[:, :-1].astype(np.int8)
+        ids, flops, known = breed(lambda n: crossover(parents, n, self.tied_genes), crossover_num,
+                                  sampler, self.args.repair_edits, (test_dict, untest_dict), accept=self.within_latency,
+                                  known=self.known_encodings())
+        res = list(np.concatenate([ids, flops[:, None]], axis=1).astype(np.float32))
+        untest_dict.add(ids, -1)
+        self.known_candidates(known, test_dict, free)
+        print('crossover_num = {}'.format(len(res)), flush=True)
+        return res
+
+    # random operation in evolution algorithm
+    def random_can(self, num, test_dict, untest_dict, sampler=None, free=None):
+        print('> Random Select', flush=True)
+        sampler = sampler or self.flops_sampler
+        ids, flops, known = breed(lambda n: sampler.sample(n)[0], num,
+                                  sampler, 0, (test_dict, untest_dict), accept=self.within_latency,
+                                  known=self.known_encodings())
+        candidates = list(np.concatenate([ids, flops[:, None]], axis=1).astype(np.float32))
+        untest_dict.add(ids, -1)
+        self.known_candidates(known, test_dict, free)
+        print('Number of Candidates = {}'.format(len(candidates)), flush=True)
+        return candidates
+
+    # select topk
+    def select(self, candidates, keep_top_k, select_num):
+        print('\n> Select', flush=True)
+        keep_top_k.extend(candidates)
+        keep_top_k = sorted(keep_top_k, key=lambda can:can[-1], reverse=True)
+        return keep_top_k[:select_num]
+
+    # first population of the search, from --initial_candidates or drawn at random
+    def initial_candidates(self, population_num, test_dict, untest_dict, free=None):
+        if self.args.initial_candidates:
+            return pickle.load(open(self.args.initial_candidates, 'rb'))
+        return self.random_can(population_num, test_dict, untest_dict, free=free)
+
+    def search(self, model, criterion, scheduler=None):
+        args = self.args
+        cnt = 1
+        select_num = 50
+        population_num = 50
+        mutation_num = 25
+        m_prob = 0.1
+        crossover_num = 25
+
+        # encodings scored (with their reward) and generated but not scored yet
+        test_dict = CandidateSet(self.num_genes)
+        untest_dict = CandidateSet(self.num_genes)
+        keep_top_k = []
+        keep_top_50 = []
+        print('population_num = {} select_num = {} mutation_num = {} crossover_num = {} max_iters = {}'.format(population_num, select_num, mutation_num, crossover_num, args.max_iters))
+
+        # the known candidates generated are scored for free, they join keep_top_50 right away
+        free = []
+        candidates = self.initial_candidates(population_num, test_dict, untest_dict, free)
+        keep_top_50 = self.select(free, keep_top_50, select_num)
+
+        start_iter = 0
+        scored = []
+        filename = args.snapshot
+        if os.path.exists(filename) and args.load_dict:
+            print("Loading from " + filename)
+            data = pickle.load(open(filename, 'rb'))
+            candidates = data['candidates']
+            keep_top_k = data['keep_top_k']
+            keep_top_50 = data['keep_top_50']
+            start_iter = data['iter'] + 1
+            # snapshots written in the middle of an iteration hold the indices of the scored candidates
+            scored = data.get('scored', [])
+            test_dict = data.get('test_dict', test_dict)
+            if isinstance(test_dict, dict):
+                test_dict = CandidateSet.from_dict(test_dict, self.num_genes)
+            cnt = data.get('cnt', cnt)
+
+        print('Starting from ' + str(start_iter))
+        # snapshot after every scored candidate, iter - 1 is the last finished iteration
+        def checkpoint(scored, cnt):
+            snap = {'candidates':candidates, 'keep_top_k':keep_top_k, 'keep_top_50':keep_top_50, 'iter':iter - 1,
+                    'scored':sorted(scored), 'test_dict':test_dict, 'cnt':cnt}
+            save_snapshot(snap, filename)
+
+        for iter in range(start_iter, args.max_iters):
+            start_time = time.time()
+
+            # reward a candidate needs to enter keep_top_50
+            threshold = keep_top_50[-1][-1] if len(keep_top_50) == select_num else -np.inf
+            candidates, cnt = self.test_candidates_model(model, criterion, candidates, cnt, test_dict, threshold, scored, checkpoint, scheduler)
+            scored = []
+            keep_top_50 = self.select(candidates, keep_top_50, select_num)
+            keep_top_k = keep_top_50[0:10]
+
+            print('Iteration {} : Showing Top {} results'.format(iter, select_num), flush=True)
+            for i in range(select_num):
+                res = keep_top_50[i]
+                print('{}. {} \nReward = {}'.format(i+1, res[:-1], res[-1]))
+
+            untest_dict = CandidateSet(self.num_genes)
+            free = []
+            # surrogate_pool times more children than evaluated, pre-screened by the surrogate
+            mutation = self.get_mutation(keep_top_k, mutation_num * args.surrogate_pool, m_prob, test_dict, untest_dict, free=free)
+            mutation = self.prescreen(mutation, mutation_num, untest_dict)
+            crossover = self.get_crossover(keep_top_k, crossover_num * args.surrogate_pool, test_dict, untest_dict, free=free)
+            crossover = self.prescreen(crossover, crossover_num, untest_dict)
+            remaining_num = population_num - len(mutation) -len(crossover)
+            random_cans = self.random_can(remaining_num * args.surrogate_pool, test_dict, untest_dict, free=free)
+            random_cans = self.prescreen(random_cans, remaining_num, untest_dict)
+            if free:
+                keep_top_50 = self.select(free, keep_top_50, select_num)
+
+            candidates = []
+            candidates.extend(mutation)
+            candidates.extend(crossover)
+            candidates.extend(random_cans)
+
+            snap = {'candidates':candidates, 'keep_top_k':keep_top_k, 'keep_top_50':keep_top_50, 'iter':iter,
+                    'scored':[], 'test_dict':test_dict, 'cnt':cnt}
+            save_snapshot(snap, filename)
+
+            now = time.gmtime(time.time() - start_time)
+            if int(now.tm_hour) > 2:
+                print('\nIteration {} took {} hours {} mins {} secs\n\n'.format(iter, now.tm_hour, now.tm_min, now.tm_sec))
+            elif int(now.tm_hour) == 1:
+                print('\nIteration {} took {} hour {} mins {} secs\n\n'.format(iter, now.tm_hour, now.tm_min, now.tm_sec))
+            else:
+                print('\nIteration {} took {} mins and {} secs\n\n'.format(iter, now.tm_min, now.tm_sec))
+
+        for can in keep_top_k:
+            print(list(can[:-1].astype(int)))
+        print('\n\nFinished!')
+
+    # steady-state evolution: instead of waiting for a whole population, a child is bred from the
+    # current top candidates as soon as an evaluation slot frees up, and joins keep_top_50 as soon
+    # as it is scored. the budget is the number of candidates of the generational search
+    def search_steady_state(self, model, criterion, scheduler=None):
+        args = self.args
+        cnt = 1
+        select_num = 50
+        population_num = 50
+        m_prob = 0.1
+        budget = args.max_iters * population_num
+        # a few candidates per worker in flight, so no worker waits for the next one
+        num_slots = 1 if scheduler is None else 2 * len(scheduler.workers)
+
+        # encodings scored (with their reward) and generated but not scored yet
+        test_dict = CandidateSet(self.num_genes)
+        untest_dict = CandidateSet(self.num_genes)
+        keep_top_50 = []
+        print('population_num = {} select_num = {} budget = {} slots = {}'.format(population_num, select_num, budget, num_slots))
+
+        # the first population is evaluated before any child is bred. the known candidates generated
+        # are scored for free: they join keep_top_50 and do not count in the budget
+        free = []
+        queue = self.initial_candidates(population_num, test_dict, untest_dict, free)
+        keep_top_50 = self.select(free, keep_top_50, select_num)
+
+        filename = variant_snapshot(args.snapshot, 'steady')
+        if os.path.exists(filename) and args.load_dict:
+            print('Loading from ' + filename)
+            data = pickle.load(open(filename, 'rb'))
+            queue = data['queue']
+            keep_top_50 = data['keep_top_50']
+            test_dict = data['test_dict']
+            if isinstance(test_dict, dict):
+                test_dict = CandidateSet.from_dict(test_dict, self.num_genes)
+            cnt = data['cnt']
+        untest_dict.add(np.array([can[:-1] for can in queue]).reshape(-1, self.num_genes), -1)
+
+        # candidates being evaluated by task index
+        in_flight = {}
+        # set once no new child can be bred, the candidates in flight are then drained
+        exhausted = False
+        while cnt <= budget:
+            # fill the free slots, children are bred from the candidates scored so far
+            while not exhausted and len(in_flight) < num_slots and cnt + len(in_flight) <= budget:
+                if queue:
+                    can = queue.pop(0)
+                else:
+                    keep_top_k = keep_top_50[0:10]
+                    children = []
+                    free = []
+                    if len(keep_top_k) > 1 and np.random.rand() < 0.5:
+                        children = self.get_crossover(keep_top_k, args.surrogate_pool, test_dict, untest_dict, free=free)
+                    elif len(keep_top_k) > 0:
+                        children = self.get_mutation(keep_top_k, args.surrogate_pool, m_prob, test_dict, untest_dict, free=free)
+                    if not children:
+                        children = self.random_can(args.surrogate_pool, test_dict, untest_dict, free=free)
+                    if free:
+                        keep_top_50 = self.select(free, keep_top_50, select_num)
+                    if not children:
+                        # the known children were scored for free, new ones may still be bred from them
+                        exhausted = not free
+                        continue
+                    can = self.prescreen(children, 1, untest_dict)[0]
+                if can[:-1] in self.results:
+                    # a queued candidate scored by an earlier run, free as the known children
+                    can[-1] = self.known_reward(can, cnt)
+                    test_dict.add(can[:-1], can[-1])
+                    untest_dict.remove(can[:-1])
+                    keep_top_50 = sorted(keep_top_50 + [can], key=lambda can:can[-1], reverse=True)[:select_num]
+                    continue
+                # reward a candidate needs to enter keep_top_50
+                threshold = keep_top_50[-1][-1] if len(keep_top_50) == select_num else -np.inf
+                if scheduler is None:
+                    in_flight[cnt] = (can, threshold)
+                else:
+                    in_flight[scheduler.submit(([can], threshold))] = (can, threshold)
+            if not in_flight:
+                if exhausted:
+                    print('No new candidate can be bred, {} of the {} candidates scored'.format(cnt - 1, budget), flush=True)
+                    break
+                continue
+
+            if scheduler is None:
+                task_index, (can, threshold) = in_flight.popitem()
+                _, record = next(self.evaluate_group((model, criterion), ([can], threshold)))
+            else:
+                task_index, result, finished = scheduler.next_result()
+                if finished:
+                    continue
+                can, _ = in_flight.pop(task_index)
+                _, record = result
+            self.record_candidate(can, record, cnt)
+
+            can[-1] = record['reward']
+            test_dict.add(can[:-1], can[-1])
+            untest_dict.remove(can[:-1])
+            keep_top_50 = sorted(keep_top_50 + [can], key=lambda can:can[-1], reverse=True)[:select_num]
+            cnt += 1
+
+            # the candidates in flight are evaluated again after a restart
+            snap = {'queue':queue + [c for c, _ in in_flight.values()], 'keep_top_50':keep_top_50, 'test_dict':test_dict, 'cnt':cnt}
+            save_snapshot(snap, filename)
+
+            if (cnt - 1) % population_num == 0:
+                print('\n{} candidates scored : Showing Top {} results'.format(cnt - 1, len(keep_top_50)), flush=True)
+                for i, res in enumerate(keep_top_50):
+                    print('{}. {} \nReward = {}'.format(i+1, res[:-1], res[-1]))
+                self.print_evaluation_stats(scheduler)
+
+        for can in keep_top_50[0:10]:
+            print(list(can[:-1].astype(int)))
+        print('\n\nFinished!')
+
+    # the Pareto front of the archive sorted by FLOPs, and its most accurate candidate under every FLOPs budget
+    def print_pareto_front(self, ids, values, rank):
+        front = np.flatnonzero(rank == 0)
+        front = front[np.argsort(values[front, 1])]
+        print('Pareto front : {} of {} candidates'.format(len(front), len(ids)), flush=True)
+        for i in front:
+            print('{} \nTop-1 Accuracy = {:.2f} | FLOPs = {:.2f}M | CPU Latency = {:.2f} ms'.format(ids[i].tolist(), *values[i]))
+        for budget in [float(b) for b in self.args.pareto_budgets.split(',') if b]:
+            fits = front[values[front, 1] <= budget]
+            if len(fits) > 0:
+                best = fits[np.argmax(values[fits, 0])]
+                print('Best under {:.0f}M FLOPs : {} \nTop-1 Accuracy = {:.2f} | FLOPs = {:.2f}M | CPU Latency = {:.2f} ms'.format(
+                    budget, ids[best].tolist(), *values[best]), flush=True)
+
+    # NSGA-II search of the Pareto front of top-1 accuracy, FLOPs and cpu latency over a wide FLOPs
+    # window, so that one run yields candidates for several budgets. the archive is every candidate
+    # of the result store in the window with the three objectives recorded, earlier runs included.
+    # the parents are its population_num best candidates by front and crowding distance, mated
+    # through binary tournaments. there is no single reward to reject a candidate on a proxy subset,
+    # every candidate is evaluated on the full validation set
+    def search_pareto(self, model, criterion, scheduler=None):
+        args = self.args
+        a = self.architecture
+        cnt = 1
+        population_num = 50
+        mutation_num = 25
+        m_prob = 0.1
+        crossover_num = 25
+
+        min_flops, max_flops = [float(v) for v in args.pareto_flops.split(',')] if args.pareto_flops else (0, a.bf)
+        sampler = FLOPsSampler(a.arch, min_flops, max_flops, tied_columns=a.tied_columns)
+        print('population_num = {} mutation_num = {} crossover_num = {} max_iters = {} FLOPs window = [{}, {}]'.format(
+            population_num, mutation_num, crossover_num, args.max_iters, min_flops, max_flops))
+
+        test_dict = CandidateSet(self.num_genes)
+        start_iter = 0
+        scored = []
+        filename = variant_snapshot(args.snapshot, 'pareto')
+        if os.path.exists(filename) and args.load_dict:
+            print('Loading from ' + filename)
+            data = pickle.load(open(filename, 'rb'))
+            candidates = data['candidates']
+            start_iter = data['iter'] + 1
+            scored = data['scored']
+            test_dict = data['test_dict']
+            cnt = data['cnt']
+        else:
+            # the first population is drawn from the whole FLOPs window
+            candidates = self.random_can(population_num, test_dict, CandidateSet(self.num_genes), sampler)
+
+        print('Starting from ' + str(start_iter))
+        # snapshot after every scored candidate, iter - 1 is the last finished iteration
+        def checkpoint(scored, cnt):
+            snap = {'candidates':candidates, 'iter':iter - 1, 'scored':sorted(scored), 'test_dict':test_dict, 'cnt':cnt}
+            save_snapshot(snap, filename)
+
+        for iter in range(start_iter, args.max_iters):
+            start_time = time.time()
+
+            candidates, cnt = self.test_candidates_model(model, criterion, candidates, cnt, test_dict, -np.inf, scored, checkpoint, scheduler)
+            scored = []
+
+            ids, values = self.results.table(self.objective_names)
+            in_window = (values[:, 1] >= min_flops) & (values[:, 1] <= max_flops)
+            ids, values = ids[in_window], values[in_window]
+            sort_time = time.time()
+            parents, rank, crowding = nsga2_select(values * self.objective_signs, population_num)
+            print('Iteration {} : non-dominated sorting of {} candidates took {:.2f} secs'.format(iter, len(ids), time.time() - sort_time), flush=True)
+            self.print_pareto_front(ids, values, rank)
+
+            untest_dict = CandidateSet(self.num_genes)
+            mutation, crossover = [], []
+            if len(ids) > 1:
+                # mating pool of binary tournaments between the parents
+                pool = parents[tournament(rank[parents], crowding[parents], population_num)]
+                pool = list(np.concatenate([ids[pool], values[pool, 1:2]], axis=1).astype(np.float32))
+                mutation = self.get_mutation(pool, mutation_num, m_prob, test_dict, untest_dict, sampler)
+                crossover = self.get_crossover(pool, crossover_num, test_dict, untest_dict, sampler)
+            random_cans = self.random_can(population_num - len(mutation) - len(crossover), test_dict, untest_dict, sampler)
+            candidates = mutation + crossover + random_cans
+
+            snap = {'candidates':candidates, 'iter':iter, 'scored':[], 'test_dict':test_dict, 'cnt':cnt}
+            save_snapshot(snap, filename)
+
+            now = time.gmtime(time.time() - start_time)
+            print('\nIteration {} took {} hours {} mins {} secs\n\n'.format(iter, now.tm_hour, now.tm_min, now.tm_sec))
+
+        print('\n\nFinished!')
+
+    def run(self):
+        args = self.args
+        run_start = time.time()
+        print('net_cache : ', args.net_cache)
+
+        search_fn = self.search_pareto if args.pareto else self.search_steady_state if args.steady_state else self.search
+        if args.eval_workers > 0:
+            if not os.path.exists(args.net_cache):
+                print('Cannot find {} '.format(args.net_cache))
+                return
+            # every worker loads its own replica, they are forked before cuda is initialized here
+            scheduler = EvalScheduler(worker_devices(args.eval_workers, self.device.type), self.init_worker, self.evaluate_group)
+            search_fn(None, None, scheduler)
+            scheduler.close()
+        else:
+            criterion = nn.CrossEntropyLoss()
+            criterion = criterion.to(self.device)
+            model = to_device(self.architecture.pruning_net(), self.device, args.channels_last)
+            model = data_parallel(model, self.device)
+
+            if os.path.exists(args.net_cache):
+                print('Loading checkpoint {} ..........'.format(args.net_cache))
+                checkpoint = torch.load(args.net_cache, map_location=self.device)
+                model.load_state_dict(checkpoint['state_dict'])
+                print("Loaded checkpoint {} epoch = {}" .format(args.net_cache, checkpoint['epoch']))
+
+                # memoize the generated weights once the parameters are loaded
+                set_weight_cache(model.module, args.weight_cache_mb)
+
+            else:
+                print('Cannot find {} '.format(args.net_cache))
+                return
+
+            search_fn(model, criterion)
+
+        run_time = time.time() - run_start
+        print('Total Searching time = {:.2f} hours'.format(run_time/3600), flush=True)
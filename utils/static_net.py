@@ -0,0 +1,35 @@
+import copy
+import torch
+import torch.nn as nn
+
+# building blocks of the static networks materialized from a PruningNet for one
+# encoding vector: plain Conv2d layers holding contiguous copies of the generated
+# (sliced) weights, and BatchNorms holding the statistics of the chosen scale.
+
+
+def static_conv(weight, stride=1, padding=0, groups=1):
+    oup, inp_per_group, k, _ = weight.shape
+    conv = nn.Conv2d(inp_per_group * groups, oup, kernel_size=k, stride=stride,
+                     padding=padding, groups=groups, bias=False)
+    conv.weight.data.copy_(weight)
+    return conv.to(weight.device)
+
+
+def static_bn(bn):
+    return copy.deepcopy(bn)
+
+
+class Residual(nn.Module):
+    """body(x) + shortcut(x) (x itself without shortcut), followed by a relu if relu"""
+    def __init__(self, body, shortcut=None, relu=False):
+        super(Residual, self).__init__()
+        self.body = body
+        self.shortcut = shortcut
+        self.relu = relu
+
+    def forward(self, x):
+        identity = x if self.shortcut is None else self.shortcut(x)
+        out = self.body(x) + identity
+        if self.relu:
+            out = torch.relu(out)
+        return out
@@ -0,0 +1,45 @@
+import numpy as np
+from utils.proxy_evaluation import rank_correlation
+
+# cheap reward predictor used to pre-screen generated candidates: ridge regression on
+# the one-hot scale ids of an encoding vector plus the normalized ids themselves, fitted
+# in closed form on the candidates evaluated so far. its leave-one-out error comes for
+# free from the hat matrix, so the search can tell how far the predictions can be trusted.
+
+
+class RidgeSurrogate(object):
+    def __init__(self, num_choices, alpha=1.0):
+        """num_choices holds the number of scales of every gene of the encoding vector"""
+        self.num_choices = np.asarray(num_choices)
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_choices)[:-1]])
+        self.alpha = alpha
+        self.weight = None
+        self.num_samples = 0
+        self.error = np.inf
+        self.rank_correlation = 0.
+
+    def features(self, ids):
+        ids = np.asarray(ids, dtype=int).reshape(-1, len(self.num_choices))
+        one_hot = np.zeros((len(ids), self.num_choices.sum()))
+        np.put_along_axis(one_hot, ids + self.offsets, 1, axis=1)
+        return np.concatenate([one_hot, ids / (self.num_choices - 1.), np.ones((len(ids), 1))], axis=1)
+
+    def fit(self, ids, rewards):
+        x = self.features(ids)
+        y = np.asarray(rewards, dtype=np.float64)
+        # the bias (last feature) is not penalized
+        penalty = self.alpha * np.eye(x.shape[1])
+        penalty[-1, -1] = 0
+        inv = np.linalg.inv(x.T @ x + penalty)
+        self.weight = inv @ (x.T @ y)
+        self.num_samples = len(y)
+
+        # leave-one-out residuals of ridge regression: e_i / (1 - h_ii)
+        hat = np.sum((x @ inv) * x, axis=1)
+        loo = y - (y - x @ self.weight) / np.maximum(1 - hat, 1e-6)
+        self.error = np.sqrt(np.mean((loo - y) ** 2))
+        self.rank_correlation = rank_correlation(loo, y)
+        return self
+
+    def predict(self, ids):
+        return self.features(ids) @ self.weight
@@ -1,6 +1,7 @@
 import os
 import sys
 import shutil
+import pickle
 import numpy as np
 import time, datetime
 import torch
@@ -123,6 +124,25 @@ def save_checkpoint(state, is_best, save):
         shutil.copyfile(filename, best_filename)
 
 
+def save_snapshot(state, filename):
+    # pickle to a temporary file and rename it over the snapshot, a crash while
+    # writing leaves the previous snapshot in place instead of a truncated one
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def sandwich_scale_ids(num_subnets, num_scales):
+    """Scale id of every sub-network trained on one batch: the largest and the smallest
+    networks first (the sandwich rule), None for the randomly sampled ones"""
+    if num_subnets < 2:
+        return [None] * num_subnets
+    return [num_scales - 1, 0] + [None] * (num_subnets - 2)
+
+
 def adjust_learning_rate(optimizer, epoch, args):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = args.lr * (0.1 ** (epoch // 30))
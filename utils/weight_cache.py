@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+import torch
+
+# memoization of the conv weights generated by the PruningNet hypernetworks. while the
+# candidates are recalibrated and evaluated, the scale ids of a layer stay the same for
+# hundreds of batches and the hypernetwork parameters do not change. a generated (and
+# already sliced) weight is cached per (layer, weight, scale ids, device, autocast dtype) as long as
+# gradients are disabled. a forward with gradients enabled empties the cache, since the
+# parameters may be updated after it. the cache must be cleared by hand after loading
+# new parameters into a model whose cache is already filled.
+
+
+class WeightCache(object):
+    """LRU cache of generated weights holding at most max_bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.weights = OrderedDict()
+        self.nbytes = 0
+        # DataParallel runs the replicas of a layer in several threads
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            weight = self.weights.get(key)
+            if weight is not None:
+                self.weights.move_to_end(key)
+            return weight
+
+    def put(self, key, weight):
+        nbytes = weight.numel() * weight.element_size()
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.weights:
+                return
+            self.weights[key] = weight
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self.weights.popitem(last=False)
+                self.nbytes -= old.numel() * old.element_size()
+
+    def clear(self):
+        with self.lock:
+            self.weights.clear()
+            self.nbytes = 0
+
+
+def autocast_dtype(device):
+    """dtype of the autocast enabled on the device type of device, None without autocast"""
+    device_type = torch.device(device).type
+    if hasattr(torch, 'get_autocast_dtype'):
+        enabled, dtype = torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    elif device_type == 'cuda':
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    else:
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return dtype if enabled else None
+
+
+def cached_weight(layer, key, device, generate):
+    """Weight returned by generate(), memoized in the cache of layer under key and device"""
+    cache = getattr(layer, 'weight_cache', None)
+    if cache is None:
+        return generate()
+    if torch.is_grad_enabled():
+        cache.clear()
+        return generate()
+
+    key = (layer.weight_cache_key,) + key + (device, autocast_dtype(device))
+    weight = cache.get(key)
+    if weight is None:
+        # never keep a view of a larger generated tensor alive
+        weight = generate().contiguous()
+        cache.put(key, weight)
+    return weight
+
+
+def set_weight_cache(model, max_mb):
+    """Share one cache of at most max_mb megabytes between the hypernetwork layers of model,
+    max_mb = 0 disables the cache"""
+    cache = WeightCache(max_mb * 2**20) if max_mb > 0 else None
+    for i, m in enumerate(model.modules()):
+        if hasattr(m, 'fc11'):
+            m.weight_cache = cache
+            m.weight_cache_key = i
+    return cache